@@ -0,0 +1,569 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+#
+# Imports
+#
+
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+from optparse import OptionParser
+import fetch
+import hiera
+import mockserver
+import pfile
+import ptags
+import puppetize
+import skeleton
+import spacewalk
+import verify
+
+#
+# Constants
+#
+
+USAGE = '%prog <options>'
+
+DESCRIPTION = 'Benchmarks for the puppetize conversion pipeline.  Results can be saved as a baseline and ' \
+              'later runs compared against it to flag regressions.'
+
+START = '{|'
+END = '|}'
+
+SUITES = ['substitute', 'footprint', 'filemanager', 'manifest', 'jobs', 'client', 'systems', 'verify', 'main']
+
+CONFIG = """[Spacewalk]
+server = %(url)s
+user = admin
+password = redhat
+
+[Puppet]
+working_dir = %(working_dir)s
+output_dir = %(working_dir)s
+mapping = %(mapping)s
+"""
+
+
+class Results(object):
+    """
+    The measurements of a benchmark run, by case.
+    """
+
+    def __init__(self):
+        self.cases = {}
+
+    def add(self, case, seconds, count=0, size=0, rss=None, unit='files'):
+        """
+        Record and print the throughput of a case.
+
+        :param count: The number of `unit` processed.
+        :param size: The number of bytes processed.
+        :param rss: The peak RSS, in KB, when measured in a process of its own.
+        """
+        seconds = max(seconds, 1e-9)
+        metrics = {'seconds': seconds, '%s_per_s' % unit: count / seconds}
+        line = '%-32s %9.3fs  %10.0f %s/s' % (case, seconds, count / seconds, unit)
+        if size:
+            metrics['mb_per_s'] = size / seconds / 1024 / 1024
+            line += '  %8.1f MB/s' % metrics['mb_per_s']
+        if rss:
+            metrics['peak_rss_mb'] = rss / 1024.0
+            line += '  peak RSS %7.1f MB' % metrics['peak_rss_mb']
+        self.cases[case] = metrics
+        print line
+
+    def add_footprint(self, case, count, rss):
+        """
+        Record and print the memory held per entry, given the RSS growth in KB.
+        """
+        self.cases[case] = {'bytes_per_entry': rss * 1024.0 / count}
+        print '%-32s %10d entries  %8.0f bytes/entry' % (case, count, rss * 1024.0 / count)
+
+    def add_size(self, case, size):
+        """
+        Record and print the size of an output, in bytes.
+        """
+        self.cases[case] = {'kb': size / 1024.0}
+        print '%-32s %10.1f KB' % (case, size / 1024.0)
+
+    def save(self, path, knobs):
+        fh = open(path, "w")
+        json.dump({'knobs': knobs, 'results': self.cases}, fh, indent=2, sort_keys=True)
+        fh.close()
+
+    def compare(self, path, knobs, tolerance):
+        """
+        Print the change of every metric against the baseline at path.
+
+        :return: The number of metrics that regressed by more than tolerance.
+        :rtype: int
+        """
+        fh = open(path, "r")
+        baseline = json.load(fh)
+        fh.close()
+        if baseline['knobs'] != knobs:
+            print 'warning: the baseline was run with other knobs: %s' % baseline['knobs']
+
+        regressions = 0
+        print
+        print '%-32s %-14s %12s %12s %8s' % ('CASE', 'METRIC', 'BASELINE', 'CURRENT', 'CHANGE')
+        for case, metrics in sorted(self.cases.iteritems()):
+            for metric, value in sorted(metrics.iteritems()):
+                old = baseline['results'].get(case, {}).get(metric)
+                if not old or metric == 'seconds':
+                    continue
+                change = value / old - 1
+                # throughputs should not drop, memory should not grow
+                if metric.endswith('_per_s'):
+                    regressed = change < -tolerance
+                else:
+                    regressed = change > tolerance
+                regressions += regressed
+                print '%-32s %-14s %12.1f %12.1f %+7.1f%%%s' % (case, metric, old, value, change * 100,
+                                                              regressed and '  REGRESSION' or '')
+        return regressions
+
+
+def in_process(func, *args):
+    """
+    Run func in a process of its own, so that its peak RSS is its own.
+
+    :return: The return value of func and the peak RSS in KB.
+    :rtype: tuple
+    """
+    queue = multiprocessing.Queue()
+
+    def child():
+        try:
+            queue.put((None, func(*args), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        except BaseException, err:
+            queue.put((repr(err), None, None))
+
+    process = multiprocessing.Process(target=child)
+    process.start()
+    error, result, rss = queue.get()
+    process.join()
+    if error:
+        raise RuntimeError(error)
+    return result, rss
+
+
+def legacy_substitute(mapping, raw_string, start_marker, end_marker):
+    """
+    The original TagManager.substitute algorithm, kept for comparison.
+    It rebuilds the whole string for every macro and only terminates
+    when every macro in raw_string is mapped.
+    """
+    start = 0
+    replaced = False
+    while True:
+        try:
+            start = raw_string.index(start_marker, start)
+            end = raw_string.index(end_marker, start)
+        except ValueError:
+            break
+        marked_string = raw_string[(start + len(start_marker)):end]
+        replaced_string = None
+        for tag, replacement in mapping['mapping'].iteritems():
+            if tag in marked_string:
+                replaced_string = "<%= " + marked_string.replace(tag, replacement) + " %>"
+                break
+        if replaced_string is not None:
+            replaced = True
+            raw_string = raw_string[0:start] + replaced_string + raw_string[(end + len(end_marker)):]
+    return replaced, raw_string
+
+
+def synthetic_template(size, macros, seed=0):
+    """
+    Build a template of roughly `size` bytes containing `macros` mapped macros.
+    """
+    rnd = random.Random(seed)
+    tags = sorted(ptags.MAPPING['mapping'].keys())
+    filler = 'option_%d = value # some configuration text\n'
+    chunk = max(1, size // (macros + 1))
+    parts = []
+    for i in range(macros + 1):
+        line = filler % i
+        parts.append(line * max(1, chunk // len(line)))
+        if i < macros:
+            parts.append('%s %s %s\n' % (START, rnd.choice(tags), END))
+    return ''.join(parts)
+
+
+class LegacyFile(object):
+    """
+    The File record as it was before __slots__ and shared attribute
+    strings, kept for comparison.
+    """
+
+    def __init__(self, name, type, path, pmode=None, group=None, owner=None):
+        self.name = name
+        self.type = type
+        self.path = path
+        self.contents = None
+        self.pmode = pmode
+        self.group = group
+        self.owner = owner
+        self.macro_start_delimeter = None
+        self.macro_end_delimeter = None
+        self.target = None
+        self.source = None
+        self.source_module = None
+        self.shared = False
+        self.digest = None
+        self.size = 0
+        self.spool = None
+
+
+def _footprint(factory, count):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = {}
+    for i in xrange(count):
+        path = '/etc/synthetic%d/file%d.conf' % (i // 20, i)
+        # like the strings parsed from XML-RPC responses, each one is a new copy
+        index[path] = factory(path.replace('/', '_'), 'file', path, ''.join(['06', '44']),
+                              ''.join(['ro', 'ot']), ''.join(['ro', 'ot']))
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+
+def bench_footprint(results, count):
+    """
+    Compare the memory held per File record with the legacy record.
+    """
+    for name, factory in [('legacy', LegacyFile), ('slotted', pfile.File)]:
+        grown, rss = in_process(_footprint, factory, count)
+        results.add_footprint('footprint/%s' % name, count, grown)
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        began = time.time()
+        func()
+        elapsed = time.time() - began
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_substitute(results, size, macros, repeat):
+    """
+    Compare the single pass engine against the legacy algorithm.
+    """
+    template = synthetic_template(size, macros)
+    tm = ptags.TagManager()
+    legacy = timed(lambda: legacy_substitute(ptags.MAPPING, template, START, END), repeat)
+    current = timed(lambda: tm.substitute(template, START, END), repeat)
+    results.add('substitute/legacy/%dk' % (size / 1024), legacy, 1, len(template))
+    results.add('substitute/single-pass/%dk' % (size / 1024), current, 1, len(template))
+
+
+def _add_channel(knobs, streaming):
+    path = tempfile.mkdtemp(prefix='puppetize-bench-')
+    try:
+        module = skeleton.ModuleSkeleton('bench-synthetic', 'localhost')
+        module.write(path)
+        fm = pfile.FileManager.Instance()
+        if streaming:
+            fm.open(path, module)
+        count = size = 0
+        elapsed = 0.0
+        for file_path, info in mockserver.synthetic_entries(**knobs):
+            count += 1
+            size += len(info.get('contents') or '')
+            # only the FileManager is timed, not the generator
+            began = time.time()
+            puppetize.add_file_info(fm, info)
+            elapsed += time.time() - began
+        began = time.time()
+        if streaming:
+            fm.close()
+        else:
+            fm.export(path, module)
+        return elapsed + time.time() - began, count, size
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_filemanager(results, knobs):
+    """
+    Compare streaming export, which releases the bodies as they are added,
+    with exporting the collected channel at the end.  Either way the
+    metadata of every File is kept for the manifest and the state, so the
+    peak RSS grows with the number of files, only the size of the files
+    does not count when streaming.
+    """
+    for streaming in (False, True):
+        (elapsed, count, size), rss = in_process(_add_channel, knobs, streaming)
+        results.add('filemanager/%s' % (streaming and 'streaming' or 'collected'), elapsed, count, size, rss)
+
+
+def bench_manifest(results, knobs, repeat):
+    """
+    Compare the size of the class manifest of a synthetic channel, and the
+    time `puppet parser validate` takes on it when puppet is installed,
+    with every attribute on every resource and with resource defaults.
+    """
+    module = skeleton.ModuleSkeleton('bench-synthetic', 'localhost')
+    files = [pfile.File(path.replace('/', '_'), info['type'], path, info.get('permissions_mode'),
+                        info.get('group'), info.get('owner'), target=info.get('target_path'))
+             for path, info in mockserver.synthetic_entries(**knobs)]
+    puppet = find_executable('puppet')
+    if not puppet:
+        print 'puppet is not installed, skipping puppet parser validate'
+    cases = [('full', lambda: ''.join(file.render(module.class_name) for file in files)),
+             ('defaults', lambda: ''.join(pfile.render_resources(files, module.class_name)))]
+    path = tempfile.mkdtemp(prefix='puppetize-bench-')
+    try:
+        for name, render in cases:
+            results.add('manifest/%s/render' % name, timed(render, repeat), len(files))
+            manifest = module.manifest_header() + render() + module.manifest_footer()
+            results.add_size('manifest/%s/size' % name, len(manifest))
+            if puppet:
+                fpath = os.path.join(path, '%s.pp' % name)
+                fh = open(fpath, "w")
+                fh.write(manifest)
+                fh.close()
+                validate = lambda: subprocess.check_call([puppet, 'parser', 'validate', fpath])
+                results.add('manifest/%s/validate' % name, timed(validate, 1), len(files))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_jobs(results, count, size, macros, jobs=(1, 2, 4, 8)):
+    """
+    Time the macro substitution of `count` templates with an increasing
+    number of substitution worker processes.
+    """
+    templates = [synthetic_template(size, macros, seed=i) for i in range(16)]
+    fm = pfile.FileManager.Instance()
+    for workers in jobs:
+        fm.clear()
+        fm.set_jobs(workers)
+
+        def substitute():
+            fm.clear()
+            for i in range(count):
+                fm.add_file(name='file%d' % i, path='/etc/file%d' % i, contents=templates[i % len(templates)],
+                            pmode='644', group='root', owner='root', macro_start_delimiter=START,
+                            macro_end_delimiter=END, is_binary=False)
+            fm.flush()
+
+        results.add('jobs/%d' % workers, timed(substitute, 1), count, count * size)
+    fm.set_jobs(1)
+    fm.clear()
+
+
+def bench_client(results, calls, latency=0.005, connect_latency=0.005):
+    """
+    Compare a new connection per call with the pooled client, one call at
+    a time and with the calls in flight at once, against the mock server.
+    """
+    mock = mockserver.MockSpacewalk(latency=latency, connect_latency=connect_latency).start()
+    try:
+        connector = fetch.Connector(mock.url)
+        client = spacewalk.Client(connector, 'user', 'password')
+        key = client.login()
+
+        def fresh():
+            for _ in range(calls):
+                server = connector.server()
+                server.configchannel.getDetails(key, 'synthetic')
+                connector.release(server)
+
+        def pooled():
+            for _ in range(calls):
+                client.configchannel.getDetails('synthetic')
+
+        def concurrent():
+            pending = [client.call_async('configchannel.getDetails', 'synthetic') for _ in range(calls)]
+            for result in pending:
+                result.get()
+
+        for name, func in [('connection-per-call', fresh), ('pooled', pooled), ('pooled-async', concurrent)]:
+            results.add('client/%s' % name, timed(func, 1), calls, unit='calls')
+        client.close()
+    finally:
+        mock.stop()
+
+
+def bench_systems(results, count, latency=0.005):
+    """
+    Time fetching the profiles of `count` systems subscribed to a channel
+    from the mock server, then again from the cache.
+    """
+    mock = mockserver.MockSpacewalk(latency=latency, systems=mockserver.synthetic_systems(count)).start()
+    path = tempfile.mkdtemp(prefix='puppetize-bench-')
+    try:
+        client = spacewalk.Client(fetch.Connector(mock.url), 'user', 'password')
+        client.login()
+        systems = hiera.Systems(client, path)
+        for case, refresh in [('systems/fetched', True), ('systems/cached', False)]:
+            results.add(case, timed(lambda: systems.fetch('synthetic', refresh), 1), count, unit='systems')
+        client.close()
+    finally:
+        mock.stop()
+        shutil.rmtree(path)
+
+
+def bench_verify(results, count, size, macros, jobs=(1, 4)):
+    """
+    Time the verification of a module of `count` files, half of them
+    templates, with an increasing number of render worker processes.
+    """
+    path = tempfile.mkdtemp(prefix='puppetize-bench-')
+    try:
+        for directory in ('manifests', 'files', 'templates'):
+            os.mkdir(os.path.join(path, directory))
+        tm = ptags.TagManager()
+        variables = set()
+        resources = []
+        for i in range(count):
+            if i % 2:
+                contents = tm.expand(synthetic_template(size, macros, seed=i), START, END).contents
+                variables.update(re.findall(r'@(\w+)', contents))
+                name, content = 'templates/file%d.erb' % i, "template('synthetic/file%d.erb')" % i
+            else:
+                contents = 'option = value\n' * (size // 15)
+                name, content = 'files/file%d' % i, "'puppet:///modules/synthetic/file%d'" % i
+            fh = open(os.path.join(path, name), "w")
+            fh.write(contents)
+            fh.close()
+            resources.append("file { '/etc/file%d':\n  %s => %s,\n}\n" %
+                             (i, i % 2 and 'content' or 'source', content))
+        fh = open(os.path.join(path, 'manifests', 'init.pp'), "w")
+        fh.write('class synthetic {\n\n%s}\n' % ''.join(resources))
+        fh.close()
+        facts = dict((name, 'value of %s' % name) for name in variables)
+        for workers in jobs:
+            verify_module = lambda: verify.verify_module(path, {'synthetic': path}, facts, workers)
+            results.add('verify/%d' % workers, timed(verify_module, 1), count, count * size)
+    finally:
+        shutil.rmtree(path)
+
+
+def _main(config, *args):
+    # the conversion output is not part of the benchmark
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    sys.argv = ['puppetize.py', '-f', config, '-c', 'synthetic'] + list(args)
+    began = time.time()
+    try:
+        puppetize.main()
+    except SystemExit, err:
+        if err.code:
+            raise
+    return time.time() - began
+
+
+def bench_main(results, knobs):
+    """
+    Run the whole conversion of a synthetic channel against the mock
+    server, from scratch and again once it is unchanged.
+    """
+    files = mockserver.synthetic_channel(**knobs)
+    size = sum([len(info.get('contents') or '') for info in files.itervalues()])
+    mock = mockserver.MockSpacewalk(files=files).start()
+    path = tempfile.mkdtemp(prefix='puppetize-bench-')
+    try:
+        mapping = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'mapping.json')
+        config = os.path.join(path, 'puppetize.conf')
+        fh = open(config, "w")
+        fh.write(CONFIG % {'url': mock.url, 'working_dir': path, 'mapping': mapping})
+        fh.close()
+        for case, args in [('main/full', ['--full']), ('main/unchanged', [])]:
+            elapsed, rss = in_process(_main, config, *args)
+            results.add(case, elapsed, len(files), size, rss)
+    finally:
+        mock.stop()
+        shutil.rmtree(path)
+
+
+def main():
+    parser = OptionParser(usage=USAGE, description=DESCRIPTION)
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Number of runs per substitute case; the best time is reported.")
+    parser.add_option("-s", "--suite", dest="suites", action="append", choices=SUITES,
+                      help="Run only this suite, one of %s.  May be repeated." % ', '.join(SUITES))
+    parser.add_option("-n", "--files", dest="files", type="int", default=50000,
+                      help="Number of files in the synthetic channel of the filemanager and manifest suites.")
+    parser.add_option("--channel-files", dest="channel_files", type="int", default=2000,
+                      help="Number of files in the synthetic channel converted by the main suite.")
+    parser.add_option("--systems", dest="systems", type="int", default=2000,
+                      help="Number of systems subscribed to the channel of the systems suite.")
+    parser.add_option("--size", dest="size", type="int", default=4096, help="Mean file size.")
+    parser.add_option("--distribution", dest="distribution", type="choice", default='lognormal',
+                      choices=sorted(mockserver.DISTRIBUTIONS), help="File size distribution around --size.")
+    parser.add_option("--macros", dest="macros", type="int", default=2, help="Macros per text file.")
+    parser.add_option("--binary-ratio", dest="binary_ratio", type="float", default=0.05,
+                      help="Fraction of base64 encoded files.")
+    parser.add_option("--symlink-ratio", dest="symlink_ratio", type="float", default=0.02,
+                      help="Fraction of symlinks.")
+    parser.add_option("--files-per-directory", dest="files_per_directory", type="int", default=20,
+                      help="Number of files per directory.")
+    parser.add_option("--save", dest="save", help="Save the results as a baseline JSON file.")
+    parser.add_option("--compare", dest="compare",
+                      help="Compare the results with a baseline JSON file; exits with 1 on regressions.")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.1,
+                      help="Relative change of a metric tolerated by --compare.  default: 0.1")
+    (opts, args) = parser.parse_args()
+
+    knobs = {'size': opts.size, 'distribution': opts.distribution, 'macros': opts.macros,
+             'binary_ratio': opts.binary_ratio, 'symlink_ratio': opts.symlink_ratio,
+             'files_per_directory': opts.files_per_directory}
+    suites = opts.suites or SUITES
+    results = Results()
+
+    if 'substitute' in suites:
+        for size, macros in [(64 * 1024, 100), (1024 * 1024, 1000), (4 * 1024 * 1024, 5000)]:
+            bench_substitute(results, size, macros, opts.repeat)
+    if 'footprint' in suites:
+        bench_footprint(results, opts.files)
+    if 'filemanager' in suites:
+        bench_filemanager(results, dict(knobs, files=opts.files))
+    if 'manifest' in suites:
+        bench_manifest(results, dict(knobs, files=opts.files), opts.repeat)
+    if 'jobs' in suites:
+        bench_jobs(results, 2000, 32 * 1024, 200)
+    if 'client' in suites:
+        bench_client(results, 200)
+    if 'systems' in suites:
+        bench_systems(results, opts.systems)
+    if 'verify' in suites:
+        bench_verify(results, 20000, opts.size, opts.macros)
+    if 'main' in suites:
+        bench_main(results, dict(knobs, files=opts.channel_files))
+
+    knobs.update(files=opts.files, channel_files=opts.channel_files, systems=opts.systems)
+    if opts.save:
+        results.save(opts.save, knobs)
+    if opts.compare:
+        regressions = results.compare(opts.compare, knobs, opts.tolerance)
+        if regressions:
+            print
+            print '%d metrics regressed by more than %d%%' % (regressions, opts.tolerance * 100)
+            sys.exit(1)
+
+
+## MAIN
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+#
+# Imports
+#
+
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+import xmlrpclib
+import fetch
+import utils
+
+#
+# Constants
+#
+
+# The calls recorded in a dump.  Their first argument, the session key, is not recorded.
+RECORDED = ['configchannel.getDetails', 'configchannel.listFiles', 'configchannel.listGlobals',
+            'configchannel.lookupFileInfo', 'configchannel.listSubscribedSystems', 'org.getDetails',
+            'system.getDetails', 'system.getNetwork', 'system.getCustomValues', 'system.getNetworkDevices']
+
+BLOBS = 'blobs'
+
+# A dump is made of one or more compressed JSON lines files and a blobs/
+# directory holding the decoded base64 file contents, named by their digest.
+#
+#   {"call": "configchannel.listFiles", "args": ["label"], "result": [...]}
+#   {"call": "configchannel.lookupFileInfo", "args": ["label"], "result": {...one file...}}
+
+
+def encode(value):
+    """
+    Returns value with the XML-RPC types JSON cannot hold replaced by tagged dicts.
+    """
+    if isinstance(value, xmlrpclib.DateTime):
+        return {'__datetime__': value.value}
+    if isinstance(value, xmlrpclib.Binary):
+        return {'__binary__': value.data.encode('base64')}
+    if isinstance(value, dict):
+        return dict((k, encode(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    return value
+
+
+def decode(value):
+    """
+    The reverse of encode().
+    """
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return xmlrpclib.DateTime(str(value['__datetime__']))
+        if '__binary__' in value:
+            return xmlrpclib.Binary(value['__binary__'].decode('base64'))
+        return dict((k, decode(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+class Recorder(fetch.Connector):
+    """
+    Connects to Spacewalk and records the results of the calls needed
+    to convert channels into a dump directory.
+    """
+
+    def __init__(self, url, path):
+        fetch.Connector.__init__(self, url)
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = None
+        self._pid = None
+        self._count = 0
+
+    def server(self):
+        return RecordingServer(fetch.Connector.server(self), self)
+
+    def release(self, server):
+        fetch.Connector.release(self, server._server)
+
+    def _store_blob(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        blob = os.path.join(self.path, BLOBS, digest)
+        if not os.path.exists(blob):
+            spool = '%s.%d' % (blob, os.getpid())
+            fh = open(spool, "wb")
+            fh.write(data)
+            fh.close()
+            os.rename(spool, blob)
+        return digest
+
+    def _write(self, call, args, result):
+        line = json.dumps({'call': call, 'args': encode(args), 'result': encode(result)})
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # forked, the file belongs to the parent process
+                self._fh = None
+                self._pid = os.getpid()
+            if self._fh is None:
+                utils.mkdir(os.path.join(self.path, BLOBS))
+                # one file per process and conversion, bulk conversions record concurrently
+                self._count += 1
+                name = 'calls-%d-%d.jsonl.gz' % (os.getpid(), self._count)
+                self._fh = gzip.open(os.path.join(self.path, name), "wb")
+            self._fh.write(line)
+            self._fh.write('\n')
+        finally:
+            self._lock.release()
+
+    def record(self, call, args, result):
+        """
+        Record the result of a call, made with args after the session key.
+        """
+        if call != 'configchannel.lookupFileInfo':
+            self._write(call, args, result)
+            return
+        # one line per file, binary contents go to the blobs
+        for info in result:
+            if info.get('contents_enc64') and info.get('contents'):
+                info = dict(info)
+                info['contents'] = {'__blob__': self._store_blob(info['contents'].decode('base64'))}
+            self._write(call, args[:1], info)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._fh is not None and self._pid == os.getpid():
+                self._fh.close()
+                self._fh = None
+        finally:
+            self._lock.release()
+
+
+class RecordingServer(object):
+    """
+    A proxy to a Spacewalk server that hands the results of the recorded
+    calls to a Recorder.
+    """
+
+    def __init__(self, server, recorder, name=None):
+        self._server = server
+        self._recorder = recorder
+        self._name = name
+
+    def __getattr__(self, name):
+        if self._name:
+            name = '%s.%s' % (self._name, name)
+        return RecordingServer(self._server, self._recorder, name)
+
+    def __call__(self, *args):
+        method = self._server
+        for part in self._name.split('.'):
+            method = getattr(method, part)
+        result = method(*args)
+        if self._name in RECORDED:
+            self._recorder.record(self._name, list(args[1:]), result)
+        return result
+
+
+class Replay(fetch.Connector):
+    """
+    Answers the calls needed to convert channels from a dump directory,
+    without any network access.
+    """
+
+    def __init__(self, path):
+        fetch.Connector.__init__(self, None)
+        self.path = path
+        self.results = {}
+        self.files = {}
+        names = sorted(glob.glob(os.path.join(path, 'calls-*.jsonl.gz')))
+        if not names:
+            raise IOError('No dump found in %s' % path)
+        for name in names:
+            fh = gzip.open(name, "rb")
+            try:
+                for line in fh:
+                    entry = json.loads(line)
+                    args = tuple(entry['args'])
+                    if entry['call'] == 'configchannel.lookupFileInfo':
+                        self.files[(args[0], entry['result']['path'])] = entry['result']
+                    else:
+                        self.results[(entry['call'], args)] = entry['result']
+            finally:
+                fh.close()
+
+    def server(self):
+        return ReplayServer(self)
+
+    def release(self, server):
+        pass
+
+    def call(self, name, args):
+        """
+        Returns the recorded result of a call, made with args after the session key.
+        """
+        if name == 'auth.login':
+            return 'offline'
+        if name == 'auth.logout':
+            return 1
+        if name == 'configchannel.lookupFileInfo':
+            label, paths = args
+            return [self._file(label, path) for path in paths if (label, path) in self.files]
+        try:
+            return decode(self.results[(name, tuple(args))])
+        except KeyError:
+            raise xmlrpclib.Fault(-1, 'Not in dump %s: %s%s' % (self.path, name, tuple(args)))
+
+    def _file(self, label, path):
+        info = decode(self.files[(label, path)])
+        if isinstance(info.get('contents'), dict):
+            fh = open(os.path.join(self.path, BLOBS, info['contents']['__blob__']), "rb")
+            info['contents'] = fh.read().encode('base64')
+            fh.close()
+        return info
+
+
+class ReplayServer(object):
+    """
+    Stands in for a Spacewalk server proxy, answering from a Replay.
+    """
+
+    def __init__(self, replay, name=None):
+        self._replay = replay
+        self._name = name
+
+    def __getattr__(self, name):
+        if self._name:
+            name = '%s.%s' % (self._name, name)
+        return ReplayServer(self._replay, name)
+
+    def __call__(self, *args):
+        if self._name == 'auth.login':
+            return self._replay.call(self._name, args)
+        return self._replay.call(self._name, list(args[1:]))
@@ -0,0 +1,191 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+#
+# Imports
+#
+
+import collections
+import socket
+import time
+import xmlrpclib
+from multiprocessing.pool import ThreadPool
+from stats import Stats
+
+#
+# Constants
+#
+
+BATCH_SIZE = 100
+WORKERS = 4
+RETRIES = 3
+BACKOFF = 1.0
+
+
+def api_url(server):
+    """
+    Returns the XML-RPC endpoint for a Spacewalk server.  A server given
+    as a full URL (i.e. a local stand-in server) is used as-is.
+
+    :param server: The server hostname or URL.
+    :type server: str
+    """
+    if '://' in server:
+        return server
+    return "https://%s/rpc/api" % server
+
+
+def batches(paths, size):
+    """
+    Split the list of paths into lists of at most `size` paths.
+    """
+    size = max(1, size)
+    return [paths[i:i + size] for i in range(0, len(paths), size)]
+
+
+class CountingResponse(object):
+    """
+    Wraps an HTTP response to count the bytes read from it.
+    """
+
+    def __init__(self, response):
+        self._response = response
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        Stats.Instance().add('bytes_received', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class Transport(xmlrpclib.Transport):
+
+    def parse_response(self, response):
+        return xmlrpclib.Transport.parse_response(self, CountingResponse(response))
+
+
+class SafeTransport(xmlrpclib.SafeTransport):
+
+    def parse_response(self, response):
+        return xmlrpclib.SafeTransport.parse_response(self, CountingResponse(response))
+
+
+class Connector(object):
+    """
+    Opens the XML-RPC proxies used to talk to a Spacewalk server.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def server(self):
+        """
+        Returns a new proxy for the server.  Proxies are not thread-safe,
+        each thread needs its own.
+
+        """
+        if self.url.startswith('https:'):
+            transport = SafeTransport()
+        else:
+            transport = Transport()
+        return xmlrpclib.Server(self.url, transport=transport, verbose=0)
+
+    def release(self, server):
+        """
+        Close the connection of a proxy returned by server().
+
+        """
+        server('close')()
+
+    def close(self):
+        """
+        Release whatever the connector holds once a conversion is done.
+
+        """
+
+
+class Fetcher(object):
+    """
+    Looks up the file details of a configuration channel in batches,
+    several batches at a time.  Batches are recorded in the journal, when
+    given, and not looked up again once recorded.
+    """
+
+    def __init__(self, client, channel, batch_size=BATCH_SIZE, workers=WORKERS,
+                 retries=RETRIES, backoff=BACKOFF, journal=None):
+        """
+        :param journal: The batches recorded for the channel.
+        :type journal: journal.Batches
+        """
+        self.client = client
+        self.channel = channel
+        self.batch_size = batch_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+
+    def lookup(self, paths):
+        """
+        Fetch the details for one batch of paths, retrying on faults and
+        socket errors.
+
+        :return: The file details for the batch.
+        :rtype: list
+        """
+        if self.journal is not None:
+            files = self.journal.get(paths)
+            if files is not None:
+                Stats.Instance().add('batches_resumed')
+                return files
+        attempt = 0
+        while True:
+            try:
+                with Stats.Instance().stage('lookupFileInfo'):
+                    files = self.client.configchannel.lookupFileInfo(self.channel, paths)
+                if self.journal is not None:
+                    self.journal.put(paths, files)
+                return files
+            except (xmlrpclib.Fault, xmlrpclib.ProtocolError, socket.error), err:
+                attempt += 1
+                Stats.Instance().add('fetch_retries')
+                if attempt > self.retries:
+                    raise
+                print "Fetching %d files failed (%s), retry %d of %d" % (len(paths), err, attempt, self.retries)
+                time.sleep(self.backoff * attempt)
+
+    def fetch(self, paths):
+        """
+        Yield the file details for all paths as the batches arrive, in the
+        order of paths.  At most 2 batches per worker are looked up ahead
+        of the one being consumed, so only those are held in memory.
+        """
+        chunks = batches(paths, self.batch_size)
+        if not chunks:
+            return
+        workers = max(1, min(self.workers, len(chunks)))
+        pool = ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.apply_async(self.lookup, (chunk,)))
+                if len(pending) < 2 * workers:
+                    continue
+                for file in pending.popleft().get():
+                    yield file
+            while pending:
+                for file in pending.popleft().get():
+                    yield file
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,245 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import json
+import os
+import re
+import time
+import fetch
+import ptags
+import state
+import utils
+from stats import Stats
+
+#
+# Constants
+#
+
+# The per-node data of a module, read by Hiera 5 through hiera.yaml.
+NODES_DIR = 'data/nodes'
+
+HIERA_CONFIG = """---
+version: 5
+defaults:
+  datadir: data
+  data_hash: yaml_data
+hierarchy:
+  - name: "Per-node data"
+    path: "nodes/%{trusted.certname}.yaml"
+"""
+
+# The profiles of the systems, one file each, under the state directory.
+CACHE_DIR = 'systems'
+
+# Seconds a cached system profile is used before it is fetched again.
+TTL = 24 * 60 * 60
+
+# Number of systems whose profiles are fetched at a time.
+BATCH_SIZE = 100
+
+# The calls fetching a system profile, by part, and the fields kept of their results.
+CALLS = [('details', 'system.getDetails', ('id', 'profile_name', 'description')),
+         ('network', 'system.getNetwork', ('ip', 'hostname')),
+         ('custom', 'system.getCustomValues', None),
+         ('devices', 'system.getNetworkDevices', ('interface', 'ip', 'netmask', 'broadcast',
+                                                  'hardware_address', 'module'))]
+
+
+def _devices(key):
+    return lambda system: dict((device['interface'], device.get(key)) for device in system['devices'])
+
+
+# The value of a macro for a system profile, by macro.
+LITERALS = {
+    'rhn.system.sid': lambda system: system['details'].get('id'),
+    'rhn.system.profile_name': lambda system: system['details'].get('profile_name'),
+    'rhn.system.description': lambda system: system['details'].get('description'),
+    'rhn.system.hostname': lambda system: system['network'].get('hostname'),
+    'rhn.system.ip_address': lambda system: system['network'].get('ip'),
+}
+
+# The values of a parameterized macro for a system profile, by argument, by macro name.
+FUNCTIONS = {
+    'rhn.system.custom_info': lambda system: system['custom'],
+    'rhn.system.net_interface.ip_address': _devices('ip'),
+    'rhn.system.net_interface.netmask': _devices('netmask'),
+    'rhn.system.net_interface.broadcast': _devices('broadcast'),
+    'rhn.system.net_interface.hardware_address': _devices('hardware_address'),
+    'rhn.system.net_interface.driver_module': _devices('module'),
+}
+
+
+def _keep(value, fields):
+    # only plain values are kept, i.e. not the xmlrpclib.DateTime of the last checkin
+    if fields is None:
+        return dict((key, unicode(field)) for key, field in value.iteritems())
+    return dict((key, unicode(value[key])) for key in fields if value.get(key) is not None)
+
+
+class Systems(object):
+    """
+    Fetches the profiles of the systems subscribed to a channel: their
+    details, network, custom values and network devices.  The calls of a
+    batch of systems run at once on the pooled connections of the client,
+    and the profiles are cached in the working directory for `ttl` seconds.
+    """
+
+    def __init__(self, client, working_dir, ttl=TTL, batch_size=BATCH_SIZE):
+        self.client = client
+        self.path = os.path.join(working_dir, state.STATE_DIR, CACHE_DIR)
+        self.ttl = ttl
+        self.batch_size = batch_size
+
+    def _cached(self, sid):
+        fpath = os.path.join(self.path, '%s.json' % sid)
+        try:
+            fh = open(fpath, "r")
+            try:
+                cached = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if cached['fetched'] + self.ttl < time.time():
+            return None
+        return cached['system']
+
+    def _fetch(self, sids):
+        pending = [(sid, part, fields, self.client.call_async(method, sid))
+                   for sid in sids for part, method, fields in CALLS]
+        systems = {}
+        for sid, part, fields, result in pending:
+            value = result.get()
+            if part == 'devices':
+                value = [_keep(device, fields) for device in value]
+            else:
+                value = _keep(value, fields)
+            systems.setdefault(sid, {})[part] = value
+        utils.mkdir(self.path)
+        fetched = time.time()
+        for sid, system in systems.iteritems():
+            utils.atomic_write(os.path.join(self.path, '%s.json' % sid),
+                               json.dumps({'fetched': fetched, 'system': system}))
+        return systems
+
+    def fetch(self, channel, refresh=False):
+        """
+        Returns the profiles of the systems subscribed to channel, ordered
+        by system id.
+
+        :param refresh: Fetch every profile again, even when cached.
+        :type refresh: bool
+        """
+        stats = Stats.Instance()
+        sids = sorted(system['id'] for system in self.client.configchannel.listSubscribedSystems(channel))
+        systems = {}
+        missing = []
+        for sid in sids:
+            cached = not refresh and self._cached(sid)
+            if cached:
+                systems[sid] = cached
+            else:
+                missing.append(sid)
+        stats.add('systems', len(sids))
+        stats.add('systems_cached', len(sids) - len(missing))
+        for batch in fetch.batches(missing, self.batch_size):
+            systems.update(self._fetch(batch))
+        return [systems[sid] for sid in sids]
+
+
+def node_name(system):
+    """
+    Returns the name of the Hiera data file of a system, its hostname.
+
+    """
+    name = system['network'].get('hostname') or system['details'].get('profile_name') or system['details']['id']
+    return re.sub('[^0-9a-zA-Z_.-]', '_', name)
+
+
+def node_data(mapping, systems):
+    """
+    Resolve the macros mapped to nothing for every system.
+
+    :param mapping: The compiled macro mapping.
+    :type mapping: ptags.CompiledMapping
+
+    :return: The names of the class parameters standing for the macros,
+             and their values for each system, by node name.
+    :rtype: tuple
+    """
+    literals = [tag for tag, replacement in mapping.literals.iteritems()
+                if not replacement and tag.strip() in LITERALS]
+    functions = [name for name, replacement in mapping.functions.iteritems()
+                 if not replacement and name in FUNCTIONS]
+    names = set()
+    nodes = {}
+    for system in systems:
+        values = {}
+        for tag in literals:
+            value = LITERALS[tag.strip()](system)
+            if value is not None:
+                values[ptags.parameter_name(tag)] = value
+        for name in functions:
+            for argument, value in FUNCTIONS[name](system).iteritems():
+                if value is not None:
+                    values[ptags.parameter_name(name, argument)] = value
+        names.update(values)
+        nodes[node_name(system)] = values
+    return sorted(names), nodes
+
+
+def parameters(declared, names):
+    """
+    Returns the class parameters declared, followed by those of names
+    that are not, defaulting to undef.
+
+    :param declared: The custom_parameters, i.e. ['$sid', '$site = "lab"'].
+    :type declared: list
+    """
+    known = ptags.parameter_names(declared)
+    return list(declared or []) + ['$%s = undef' % name for name in names if name not in known]
+
+
+def digest(nodes):
+    """
+    Returns the sha1 of the data of the nodes, None without Hiera data.
+
+    """
+    if nodes is None:
+        return None
+    return hashlib.sha1(json.dumps(nodes, sort_keys=True)).hexdigest()
+
+
+def render_node(class_name, values):
+    """
+    Returns the Hiera YAML of a node, setting the class parameters.  The
+    values are JSON strings, which YAML reads as double-quoted scalars.
+
+    """
+    return '---\n' + ''.join('%s::%s: %s\n' % (class_name, name, json.dumps(values[name]))
+                             for name in sorted(values))
+
+
+def write(sink, class_name, nodes):
+    """
+    Write hiera.yaml and the data of every node into the module.
+
+    :param sink: The sink writing the module.
+    :type sink: sinks.DirectorySink
+    """
+    sink.mkdir('data')
+    sink.mkdir(NODES_DIR)
+    # the nodes of an earlier conversion
+    sink.purge(NODES_DIR, '.yaml')
+    sink.write('hiera.yaml', HIERA_CONFIG)
+    for node, values in sorted(nodes.iteritems()):
+        sink.write('%s/%s.yaml' % (NODES_DIR, node), render_node(class_name, values))
@@ -0,0 +1,232 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import dump
+import plan
+import state
+import utils
+
+#
+# Constants
+#
+
+# The journal of the runs, next to the state of the channels.
+JOURNAL = 'journal.db'
+
+# Seconds a process waits for another one writing the journal.
+TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started REAL, finished REAL);
+CREATE TABLE IF NOT EXISTS channels (run INTEGER, channel TEXT, module TEXT, target TEXT, status TEXT,
+                                     error TEXT, finished REAL, PRIMARY KEY (run, channel));
+CREATE TABLE IF NOT EXISTS files (run INTEGER, channel TEXT, name TEXT, checksum TEXT,
+                                  PRIMARY KEY (run, channel, name));
+CREATE TABLE IF NOT EXISTS batches (run INTEGER, channel TEXT, key TEXT, checksum TEXT, files BLOB,
+                                    PRIMARY KEY (run, channel, key));
+"""
+
+# The status of a channel in a run.
+DONE, FAILED = 'done', 'failed'
+
+# The directory of the module holding the bodies of the Files, by type.
+BODIES = {'file': 'files', 'template': 'templates'}
+
+
+def checksum(fpath):
+    fh = open(fpath, "rb")
+    try:
+        return plan.digest(fh)
+    finally:
+        fh.close()
+
+
+class Journal(object):
+    """
+    The progress of a run, kept in an SQLite database in WAL mode so that
+    the processes of a bulk conversion record their channels concurrently.
+    The fetched batches of every channel are recorded as they arrive, and
+    the files of every converted channel with their checksum once it is
+    done.  A resumed run skips the channels whose files are unchanged on
+    disk and does not fetch the recorded batches again.
+    """
+
+    def __init__(self, working_dir):
+        self.path = os.path.join(working_dir, state.STATE_DIR, JOURNAL)
+        self.run = None
+        self._local = threading.local()
+
+    def _connection(self):
+        # one connection per fetch thread, and none shared with a forked process
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            utils.mkdir(os.path.dirname(self.path))
+            local.db = sqlite3.connect(self.path, timeout=TIMEOUT, isolation_level=None)
+            local.db.execute('PRAGMA journal_mode=WAL')
+            local.db.execute('PRAGMA synchronous=NORMAL')
+            local.db.executescript(SCHEMA)
+            local.pid = os.getpid()
+        return local.db
+
+    def _transaction(self, statements):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for statement, args in statements:
+                db.execute(statement, args)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def start(self, resume=False):
+        """
+        Start a run, or resume the last one if it did not finish.  A new
+        run drops the progress of the earlier ones.
+
+        :return: The time the resumed run started, None for a new run.
+        :rtype: float
+        """
+        db = self._connection()
+        last = db.execute('SELECT id, started FROM runs WHERE finished IS NULL ORDER BY id DESC LIMIT 1').fetchone()
+        if resume and last:
+            self.run = last[0]
+            return last[1]
+        self._transaction([('DELETE FROM %s' % table, ()) for table in ('batches', 'files', 'channels', 'runs')] +
+                          [('INSERT INTO runs (started) VALUES (?)', (time.time(),))])
+        self.run = db.execute('SELECT MAX(id) FROM runs').fetchone()[0]
+        return None
+
+    def finish(self):
+        self._transaction([('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self.run))])
+
+    def completed(self, channel):
+        """
+        Returns the name of the module channel was converted to by this
+        run, None if it was not.
+
+        """
+        row = self._connection().execute('SELECT module FROM channels WHERE run = ? AND channel = ? AND status = ?',
+                                         (self.run, channel, DONE)).fetchone()
+        return row and row[0]
+
+    def verify(self, channel):
+        """
+        Returns whether every file recorded for the module of channel is
+        unchanged on disk.
+
+        """
+        db = self._connection()
+        target = db.execute('SELECT target FROM channels WHERE run = ? AND channel = ?',
+                            (self.run, channel)).fetchone()[0]
+        files = db.execute('SELECT name, checksum FROM files WHERE run = ? AND channel = ?',
+                           (self.run, channel)).fetchall()
+        if not files:
+            return False
+        for name, digest in files:
+            fpath = name and os.path.join(target, name) or target
+            try:
+                if checksum(fpath) != digest:
+                    return False
+            except IOError:
+                return False
+        return True
+
+    def complete(self, channel, module_name, target, files=None):
+        """
+        Record that channel was converted into target, the module directory
+        or its archive, with the checksum of every file.  The bodies of the
+        Files of the module are recorded with the digest they were written
+        with, only the other files, i.e. the manifests, are read again.
+
+        :param files: The Files of the module directory, see pfile.File.
+        :type files: list
+        """
+        if files is None:
+            files = [('', checksum(target))]
+        else:
+            bodies = {}
+            for file in files:
+                if file.digest is not None and not file.source_module and file.type in BODIES:
+                    bodies['%s/%s' % (BODIES[file.type], file.source_name())] = file.digest
+            files = bodies.items()
+            for root, directories, names in os.walk(target):
+                if root == target:
+                    directories[:] = [d for d in directories if d not in BODIES.values()]
+                for name in names:
+                    fpath = os.path.join(root, name)
+                    files.append((os.path.relpath(fpath, target), checksum(fpath)))
+        self._transaction([('DELETE FROM files WHERE run = ? AND channel = ?', (self.run, channel)),
+                           ('DELETE FROM batches WHERE run = ? AND channel = ?', (self.run, channel)),
+                           ('INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, NULL, ?)',
+                            (self.run, channel, module_name, target, DONE, time.time()))] +
+                          [('INSERT INTO files VALUES (?, ?, ?, ?)', (self.run, channel, name, digest))
+                           for name, digest in files])
+
+    def failed(self, channel, error):
+        self._transaction([('INSERT OR REPLACE INTO channels VALUES (?, ?, NULL, NULL, ?, ?, ?)',
+                            (self.run, channel, FAILED, error, time.time()))])
+
+    def batches(self, channel, listing):
+        """
+        Returns the recorded batches of channel, for its fetch.Fetcher.
+
+        :param listing: The listFiles entries of the channel, keyed by path.
+        :type listing: dict
+        """
+        return Batches(self, channel, listing)
+
+
+class Batches(object):
+    """
+    The batches of file details fetched for a channel during a run.  A
+    batch is keyed by the revisions of its files, so that the batches of
+    files changed since it was recorded are fetched again.
+    """
+
+    def __init__(self, journal, channel, listing):
+        self.journal = journal
+        self.channel = channel
+        self.listing = listing
+
+    def _key(self, paths):
+        stamps = [(path, state.stamp(self.listing.get(path, {}))) for path in paths]
+        return hashlib.sha1(json.dumps(stamps)).hexdigest()
+
+    def get(self, paths):
+        """
+        Returns the recorded details of the files at paths, None unless
+        they were recorded intact.
+
+        """
+        db = self.journal._connection()
+        row = db.execute('SELECT checksum, files FROM batches WHERE run = ? AND channel = ? AND key = ?',
+                         (self.journal.run, self.channel, self._key(paths))).fetchone()
+        if row is None or hashlib.sha1(row[1]).hexdigest() != row[0]:
+            return None
+        return dump.decode(json.loads(zlib.decompress(row[1])))
+
+    def put(self, paths, files):
+        """
+        Record the details of the files at paths.
+
+        """
+        data = zlib.compress(json.dumps(dump.encode(files)))
+        self.journal._transaction([('INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?)',
+                                    (self.journal.run, self.channel, self._key(paths),
+                                     hashlib.sha1(data).hexdigest(), sqlite3.Binary(data)))])
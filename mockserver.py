@@ -0,0 +1,301 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+#
+# Imports
+#
+
+import math
+import random
+import threading
+import time
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+#
+# Constants
+#
+
+USAGE = '%prog <options>'
+
+DESCRIPTION = 'Local stand-in for the Spacewalk XML-RPC API, serving a synthetic configuration channel.'
+
+
+# Macro lines of the synthetic text files, used in turn.
+MACRO_LINES = ['host = {| rhn.system.hostname |}\n',
+               'address = {| rhn.system.ip_address |}\n',
+               'listen = {| rhn.system.net_interface.ip_address(eth0) |}\n',
+               'netmask = {| rhn.system.net_interface.netmask(eth0) |}\n',
+               'serial = {| rhn.system.sid |}\n']
+
+# Size distributions of the synthetic files, given the mean size.
+DISTRIBUTIONS = {
+    'fixed': lambda rnd, size: size,
+    'uniform': lambda rnd, size: rnd.randint(1, 2 * size),
+    # a few large files among many small ones, like /etc
+    'lognormal': lambda rnd, size: int(rnd.lognormvariate(math.log(max(size, 2)) - 0.5, 1.0)),
+}
+
+
+def synthetic_entries(files=100, size=4096, binary_ratio=0.0, seed=0, macros=1, distribution='fixed',
+                      files_per_directory=10, symlink_ratio=0.0):
+    """
+    Yield the (path, lookupFileInfo result) pairs of a synthetic channel,
+    one at a time: a directory per `files_per_directory` files, symlinks to
+    the previous file for `symlink_ratio` of the files, base64 encoded
+    binaries for `binary_ratio` of them and text files with `macros`
+    macros each for the rest.  File sizes follow `distribution` around
+    `size` bytes.
+    """
+    rnd = random.Random(seed)
+    pick_size = DISTRIBUTIONS[distribution]
+    modified = xmlrpclib.DateTime('20141001T00:00:00')
+    line = 'option = value # configuration line\n'
+    directory = None
+    previous = None
+    for i in range(files):
+        if directory != '/etc/synthetic%d' % (i // files_per_directory):
+            directory = '/etc/synthetic%d' % (i // files_per_directory)
+            yield directory, {'type': 'directory', 'path': directory, 'permissions_mode': '755',
+                              'owner': 'root', 'group': 'root', 'revision': 1, 'modified': modified}
+        path = '%s/file%d.conf' % (directory, i)
+        if previous and symlink_ratio and rnd.random() < symlink_ratio:
+            yield path, {'type': 'symlink', 'path': path, 'target_path': previous, 'revision': 1,
+                         'modified': modified}
+            continue
+        info = {'type': 'file', 'path': path, 'permissions_mode': '644', 'owner': 'root', 'group': 'root',
+                'macro-start-delimiter': '{|', 'macro-end-delimiter': '|}', 'revision': 1,
+                'modified': modified}
+        file_size = pick_size(rnd, size)
+        if rnd.random() < binary_ratio:
+            info['contents'] = ''.join(chr(rnd.randint(0, 255)) for _ in range(file_size)).encode('base64')
+            info['contents_enc64'] = True
+        else:
+            lines = [line] * max(1, file_size // len(line))
+            count = len(lines)
+            # spread evenly, inserted from the end so the earlier positions hold
+            for j in range(macros, 0, -1):
+                lines.insert(j * count // macros, MACRO_LINES[(j - 1) % len(MACRO_LINES)])
+            info['contents'] = ''.join(lines)
+            info['contents_enc64'] = False
+        previous = path
+        yield path, info
+
+
+def synthetic_channel(files=100, size=4096, binary_ratio=0.0, seed=0, **knobs):
+    """
+    Build the lookupFileInfo results for a synthetic channel, see
+    synthetic_entries() for the knobs.
+
+    :return: The file details, keyed by path.
+    :rtype: dict
+    """
+    return dict(synthetic_entries(files, size, binary_ratio, seed, **knobs))
+
+
+def synthetic_systems(count=10, seed=0):
+    """
+    Build the profiles of `count` systems, keyed by system id: their
+    getDetails, getNetwork, getCustomValues and getNetworkDevices results.
+    """
+    rnd = random.Random(seed)
+    systems = {}
+    for i in range(count):
+        sid = 1000010000 + i
+        hostname = 'host%d.example.com' % i
+        systems[sid] = {
+            'details': {'id': sid, 'profile_name': hostname, 'description': 'Synthetic system %d' % i,
+                        'last_checkin': xmlrpclib.DateTime('20141001T00:00:00')},
+            'network': {'ip': '10.0.%d.%d' % (i // 250, i % 250 + 1), 'hostname': hostname},
+            'custom': {'rack': 'r%d' % rnd.randint(1, 20), 'owner': 'team%d' % rnd.randint(1, 5)},
+            'devices': [{'interface': 'eth0', 'ip': '10.0.%d.%d' % (i // 250, i % 250 + 1),
+                         'netmask': '255.255.0.0', 'broadcast': '10.0.255.255',
+                         'hardware_address': '52:54:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                         'module': 'virtio_net'}],
+        }
+    return systems
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/rpc/api',)
+    # keep connections open between calls, like Satellite does
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        SimpleXMLRPCRequestHandler.setup(self)
+        # stands in for the TCP and TLS handshakes of a new connection
+        self.server.connections += 1
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+
+class ThreadedServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    connections = 0
+    connect_latency = 0.0
+
+
+class MockSpacewalk(object):
+    """
+    A minimal Spacewalk API over plain HTTP that serves one or more
+    channels, each subscribed by every system, and can simulate per-call
+    latency.
+    """
+
+    def __init__(self, channel='synthetic', files=None, latency=0.0, port=0, connect_latency=0.0, systems=None):
+        self.channels = {}
+        self.add_channel(channel, files if files is not None else synthetic_channel())
+        self.systems = systems if systems is not None else synthetic_systems()
+        self.latency = latency
+        self.calls = {}
+        self.sessions = set()
+        self.server = ThreadedServer(('127.0.0.1', port), requestHandler=RequestHandler,
+                                     logRequests=False, allow_none=True)
+        self.server.connect_latency = connect_latency
+        for name, func in [('auth.login', self.login),
+                           ('auth.logout', self.logout),
+                           ('configchannel.getDetails', self.get_details),
+                           ('configchannel.listGlobals', self.list_globals),
+                           ('configchannel.listFiles', self.list_files),
+                           ('configchannel.lookupFileInfo', self.lookup_file_info),
+                           ('configchannel.listSubscribedSystems', self.list_subscribed_systems),
+                           ('system.getDetails', self.system_part('details')),
+                           ('system.getNetwork', self.system_part('network')),
+                           ('system.getCustomValues', self.system_part('custom')),
+                           ('system.getNetworkDevices', self.system_part('devices')),
+                           ('org.getDetails', self.org_details)]:
+            self.server.register_function(self._wrap(name, func), name)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/rpc/api' % self.server.server_address
+
+    def _wrap(self, name, func):
+        def call(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.latency:
+                time.sleep(self.latency)
+            if name != 'auth.login' and args[0] not in self.sessions:
+                raise xmlrpclib.Fault(2950, 'Could not find session: %s' % args[0])
+            return func(*args)
+        return call
+
+    def expire_sessions(self):
+        """
+        Invalidate every session key handed out so far.
+        """
+        self.sessions.clear()
+
+    def add_channel(self, label, files):
+        """
+        Serve another channel, given its file details keyed by path.
+        """
+        self.channels[label] = files
+
+    def _channel(self, label):
+        if label not in self.channels:
+            raise xmlrpclib.Fault(1023, 'No such configuration channel: %s' % label)
+        return self.channels[label]
+
+    def login(self, user, password):
+        key = 'mock-session-%d' % self.calls['auth.login']
+        self.sessions.add(key)
+        return key
+
+    def logout(self, key):
+        self.sessions.discard(key)
+        return 1
+
+    def get_details(self, key, label):
+        self._channel(label)
+        return {'id': sorted(self.channels).index(label) + 1, 'orgId': 1,
+                'label': label, 'name': label, 'description': label}
+
+    def list_globals(self, key):
+        return [self.get_details(key, label) for label in sorted(self.channels)]
+
+    def org_details(self, key, org_id):
+        return {'id': org_id, 'name': 'Mock Org'}
+
+    def list_files(self, key, label):
+        files = self._channel(label)
+        return [{'path': path, 'type': info['type'], 'last_modified': info['modified']}
+                for path, info in sorted(files.items())]
+
+    def lookup_file_info(self, key, label, paths):
+        files = self._channel(label)
+        return [files[path] for path in paths if path in files]
+
+    def list_subscribed_systems(self, key, label):
+        self._channel(label)
+        return [{'id': sid, 'name': system['details']['profile_name']}
+                for sid, system in sorted(self.systems.items())]
+
+    def system_part(self, part):
+        def call(key, sid):
+            if sid not in self.systems:
+                raise xmlrpclib.Fault(-210, 'No such system: %s' % sid)
+            return self.systems[sid][part]
+        return call
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = OptionParser(usage=USAGE, description=DESCRIPTION)
+    parser.add_option("-p", "--port", dest="port", type="int", default=8000, help="Port to listen on.")
+    parser.add_option("-c", "--channels", dest="channels", type="int", default=1, help="Number of channels to serve.")
+    parser.add_option("-n", "--files", dest="files", type="int", default=100, help="Number of files.")
+    parser.add_option("-s", "--size", dest="size", type="int", default=4096, help="Approximate file size.")
+    parser.add_option("-b", "--binary-ratio", dest="binary_ratio", type="float", default=0.0,
+                      help="Fraction of base64 encoded files.")
+    parser.add_option("-m", "--macros", dest="macros", type="int", default=1, help="Macros per text file.")
+    parser.add_option("--distribution", dest="distribution", type="choice", default='fixed',
+                      choices=sorted(DISTRIBUTIONS), help="File size distribution around --size.")
+    parser.add_option("--files-per-directory", dest="files_per_directory", type="int", default=10,
+                      help="Number of files per directory.")
+    parser.add_option("--symlink-ratio", dest="symlink_ratio", type="float", default=0.0,
+                      help="Fraction of symlinks.")
+    parser.add_option("--systems", dest="systems", type="int", default=10,
+                      help="Number of systems subscribed to the channels.")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.0,
+                      help="Seconds of latency added to every call.")
+    parser.add_option("--connect-latency", dest="connect_latency", type="float", default=0.0,
+                      help="Seconds of latency added to every new connection.")
+    (opts, args) = parser.parse_args()
+
+    knobs = dict(macros=opts.macros, distribution=opts.distribution,
+                 files_per_directory=opts.files_per_directory, symlink_ratio=opts.symlink_ratio)
+    mock = MockSpacewalk('synthetic', synthetic_channel(opts.files, opts.size, opts.binary_ratio, seed=0, **knobs),
+                         opts.latency, opts.port, opts.connect_latency, synthetic_systems(opts.systems))
+    for i in range(1, opts.channels):
+        mock.add_channel('synthetic%d' % i,
+                         synthetic_channel(opts.files, opts.size, opts.binary_ratio, seed=i, **knobs))
+    print 'Serving %d channels of %d files on %s' % (opts.channels, opts.files, mock.url)
+    mock.server.serve_forever()
+
+
+## MAIN
+if __name__ == "__main__":
+    main()
@@ -9,101 +9,540 @@
 # have received a copy of GPLv2 along with this software; if not, see
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 
+import binascii
+import hashlib
+import multiprocessing
 import os
+import re
+import shutil
+import tempfile
 import utils
 import ptags
+import sinks
+from stats import Stats
 from utils import Singleton
 
 
+# The attributes of the file resources in the class manifest, by File type,
+# each with its precompiled value.
+RESOURCES = {
+    'file': [('path', "'%(path)s'"),
+             ('source', "'puppet:///modules/%(module)s/%(source)s'"),
+             ('group', "'%(group)s'"),
+             ('owner', "'%(owner)s'"),
+             ('ensure', "'file'"),
+             ('mode', "'%(pmode)s'")],
+    'template': [('path', "'%(path)s'"),
+                 ('group', "'%(group)s'"),
+                 ('owner', "'%(owner)s'"),
+                 ('ensure', "'file'"),
+                 ('mode', "'%(pmode)s'"),
+                 ('content', "template('%(module)s/%(source)s')")],
+    'directory': [('path', "'%(path)s'"),
+                  ('group', "'%(group)s'"),
+                  ('owner', "'%(owner)s'"),
+                  ('ensure', "'directory'"),
+                  ('mode', "'%(pmode)s'")],
+    'symlink': [('path', "'%(path)s'"),
+                ('target', "'%(target)s'"),
+                ('ensure', "'link'")],
+}
+
+# The attributes set once per class, to their most common value, as
+# resource defaults.
+DEFAULTED = ('owner', 'group', 'mode')
+
+# Stats counter of the Files added, by File type.
+COUNTERS = {'file': 'files', 'template': 'templates', 'directory': 'directories', 'symlink': 'symlinks'}
+
+# How the resources of a module may be split into subclasses: one per
+# directory, SHARD_DEPTH levels deep (i.e. /etc/httpd), or by count.
+SHARD_MODES = ('directory', 'size')
+SHARD_DEPTH = 2
+# prefixes the subclasses of directories, so that none is named after a
+# Puppet reserved word (i.e. /node or /default)
+SHARD_PREFIX = 'shard_'
+SHARD_SIZE = 1000
+
+# Base64 encoded bodies decoding to more than this many bytes are decoded
+# straight to disk, a chunk at a time.
+SPOOL_THRESHOLD = 1024 * 1024
+
+# Number of base64 characters decoded at a time.
+BASE64_CHUNK = 4 * 64 * 1024
+
+# Number of files handed to a substitution worker process at a time.
+SUBSTITUTION_CHUNK = 32
+
+# Pending files are substituted once this many bytes of them are held.
+PENDING_BYTES = 32 * 1024 * 1024
+
+# One shared copy of every owner, group and mode string, see shared().
+ATTRIBUTES = {}
+
+
+def shared(value):
+    """
+    Returns the shared copy of an attribute string, so that the thousands
+    of Files owned by root:root hold a single 'root' between them.
+
+    """
+    if value is None:
+        return None
+    return ATTRIBUTES.setdefault(value, value)
+
+
+def _substitute(task):
+    """
+    Expand the macros of a chunk of file bodies inside a substitution
+    worker process, with the mapping and parameters of the task.  Workers
+    never touch the Stats: the lock a thread of the parent held when the
+    pool was started stays held in them.  The counts are returned instead.
+
+    :return: For each body, the expanded body, or None when it is
+             unchanged, the number of macros replaced, of unmapped macros
+             and of macros resolved.
+    :rtype: list
+    """
+    mapping, parameters, bodies = task
+    tag_manager = ptags.TagManager(mapping=mapping, parameters=parameters)
+    results = []
+    for contents, start_marker, end_marker in bodies:
+        result = tag_manager.expand(contents, start_marker, end_marker)
+        if not result.replaced and not result.resolved:
+            results.append((None, 0, len(result.unmapped), 0))
+        else:
+            results.append((result.contents, result.replaced, len(result.unmapped), result.resolved))
+    return results
+
+
+class Base64Reader(object):
+    """
+    A file object reading the decoded bytes of a base64 string, a chunk
+    at a time.
+    """
+
+    def __init__(self, encoded, chunk=BASE64_CHUNK):
+        self.encoded = encoded
+        self.chunk = chunk
+        self.offset = 0
+        self.rest = ''
+        self.buffer = ''
+
+    def _decode(self):
+        data = self.rest + ''.join(self.encoded[self.offset:self.offset + self.chunk].split())
+        self.offset += self.chunk
+        cut = len(data) - len(data) % 4
+        self.rest = data[cut:]
+        if self.offset >= len(self.encoded) and self.rest:
+            raise binascii.Error('Incorrect padding')
+        return binascii.a2b_base64(data[:cut])
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and self.offset < len(self.encoded):
+            decoded = self._decode()
+            parts.append(decoded)
+            length += len(decoded)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def decode_base64(encoded, fh=None, chunk=BASE64_CHUNK):
+    """
+    Decode a base64 string, a chunk at a time, into the file object fh,
+    or only to checksum it when fh is None.
+
+    :return: The SHA-1 digest and the size of the decoded bytes.
+    :rtype: tuple
+    """
+    digest = hashlib.sha1()
+    size = 0
+    reader = Base64Reader(encoded, chunk)
+    while True:
+        decoded = reader.read(chunk)
+        if not decoded:
+            break
+        if fh is not None:
+            fh.write(decoded)
+        digest.update(decoded)
+        size += len(decoded)
+    return digest.hexdigest(), size
+
+
+def spool_base64(encoded, fpath, chunk=BASE64_CHUNK):
+    """
+    Decode a base64 string into the file at fpath without holding the
+    decoded bytes in memory.
+
+    :return: The SHA-1 digest and the size of the decoded bytes.
+    :rtype: tuple
+    """
+    fh = open(fpath, "wb")
+    try:
+        return decode_base64(encoded, fh, chunk)
+    finally:
+        fh.close()
+
+
 class File(object):
     """
     This class represents a file to be written into a Puppet module.
     """
 
+    # channels hold up to hundreds of thousands of Files, without a __dict__ each
+    __slots__ = ('name', 'type', 'path', 'contents', 'pmode', 'group', 'owner', 'macro_start_delimeter',
+                 'macro_end_delimeter', 'target', 'source', 'source_module', 'shared', 'digest', 'size',
+                 'spool', 'encoded', 'deferred')
+
     def __init__(self, name, type, path, pmode=None, group=None, owner=None, contents=None,
                  macro_start_delimeter=None, macro_end_delimeter=None, target=None,
-                 is_binary=False):
+                 is_binary=False, tag_manager=None, spool=None, deferred=False, stream=False):
         self.name = name
         self.type = type
         self.path = path
         self.contents = contents
-        self.pmode = pmode
-        self.group = group
-        self.owner = owner
-        self.macro_start_delimeter = macro_start_delimeter
-        self.macro_end_delimeter = macro_end_delimeter
+        self.pmode = shared(pmode)
+        self.group = shared(group)
+        self.owner = shared(owner)
+        self.macro_start_delimeter = shared(macro_start_delimeter)
+        self.macro_end_delimeter = shared(macro_end_delimeter)
         self.target = target
+        self.source = None
+        self.source_module = None
+        self.shared = False
+        self.digest = None
+        self.size = 0
+        # the body decoded to disk, when it is not held in contents
+        self.spool = None
+        # contents is the base64 encoded body, decoded as it is written
+        self.encoded = False
+        # the macros are substituted later, by FileManager.flush()
+        self.deferred = False
+
+        if spool:
+            self.spool = spool
+            self.digest, self.size = spool_base64(self.contents, spool)
+            self.contents = None
+            return
+
+        if stream:
+            self.encoded = True
+            self.digest, self.size = decode_base64(self.contents)
+            return
+
+        if self.type == 'file' and self.contents and not is_binary:
+            if deferred:
+                self.deferred = True
+                return
+            tm = tag_manager or ptags.TagManager()
+            with Stats.Instance().stage('substitute'):
+                replaced, content = tm.substitute(self.contents, self.macro_start_delimeter,
+                                                  self.macro_end_delimeter)
+            # macros resolved to nothing are dropped even from static files
+            self.contents = content
+            if replaced:
+                self.type = 'template'
+
+        self._checksum()
+
+    def _checksum(self):
+        if self.type in ('file', 'template'):
+            self.digest = hashlib.sha1(self.contents or '').hexdigest()
+            self.size = len(self.contents or '')
+
+    def substituted(self, contents, template=True):
+        """
+        Complete a deferred File with its substituted body, None when it
+        had no mapped macros.  It is a template unless every macro was
+        resolved to nothing.
 
-        if self.type == 'file' and self.contents:
-            tm = ptags.TagManager()
-            if not is_binary:
-                replaced, content = tm.substitute(self.contents, self.macro_start_delimeter, self.macro_end_delimeter)
-                if replaced:
-                    self.contents = content
-                    self.type = 'template'
+        """
+        if contents is not None:
+            self.contents = contents
+            if template:
+                self.type = 'template'
+        self.deferred = False
+        self._checksum()
 
     def __eq__(self, other):
-        return self.name == other.name
+        return self.path == other.path
 
-    def export(self, path, module_name):
+    def record(self):
+        """
+        Returns the metadata of the File, without its body, as a dict.
 
-        if self.type == 'file':
-            #write the file into the module
-            files_path = os.path.join(path, 'files')
-            fpath = os.path.join(files_path, self.path.replace("/", "_"))
-            fh = open(fpath, "wb")
-            fh.write(self.contents)
-            fh.close()
-
-            #create file dsl entry for app.pp
-            dsl =  "file { '%s':\n" % self.name
-            dsl += "  path => '%s',\n" % self.path
-            dsl += "  source => 'puppet:///modules/%s/%s',\n" % (module_name, self.path.replace("/", "_"))
-            dsl += "  group => '%s',\n" % self.group
-            dsl += "  owner => '%s',\n" % self.owner
-            dsl += "  ensure => 'file',\n"
-            dsl += "  mode => '%s',\n" % self.pmode
-            dsl += "}\n\n"
+        """
+        return {'name': self.name, 'type': self.type, 'path': self.path, 'pmode': self.pmode,
+                'group': self.group, 'owner': self.owner, 'target': self.target,
+                'source': self.source, 'source_module': self.source_module,
+                'digest': self.digest, 'size': self.size}
 
+    @classmethod
+    def from_record(cls, record):
+        """
+        Returns the File described by a record whose body is already written.
+
+        """
+        file = cls(record['name'], record['type'], record['path'], record['pmode'], record['group'],
+                   record['owner'], target=record['target'])
+        file.source = record['source']
+        file.source_module = shared(record['source_module'])
+        file.digest = record['digest']
+        file.size = record['size']
+        file.shared = True
+        return file
+
+    def source_name(self):
+        """
+        Returns the name of the file body inside the module's files/ or templates/.
+
+        """
+        if self.source:
+            return self.source
+        if self.type == 'template':
+            return self.name + ".erb"
+        return self.name
+
+    def write(self, sink):
+        """
+        Write the file body into the module and release it.  Bodies shared
+        with another File are not written again.
+
+        :param sink: The module directory, or the sink writing the module.
+        :type sink: sinks.DirectorySink
+        """
+        if self.shared:
+            self.release()
+            return
+        if self.type == 'file':
+            name = 'files/' + self.source_name()
         elif self.type == 'template':
-            #write the template into the module
-            templates_path = os.path.join(path, 'templates')
-            fpath = os.path.join(templates_path, self.path.replace("/", "_") + ".erb")
-            fh = open(fpath, "wb")
-            fh.write(self.contents)
-            fh.close()
-
-            #create file dsl entry for app.pp
-            dsl =  "file { '%s':\n" % self.name
-            dsl += "  path => '%s',\n" % self.path
-            dsl += "  group => '%s',\n" % self.group
-            dsl += "  owner => '%s',\n" % self.owner
-            dsl += "  ensure => 'file',\n"
-            dsl += "  mode => '%s',\n" % self.pmode
-            dsl += "  content => template('%s/%s.erb'),\n" % (module_name, self.path.replace("/", "_"))
-            dsl += "}\n\n"
-
-        elif self.type == 'directory':
-
-            #create file dsl entry for app.pp
-            dsl =  "file { '%s':\n" % self.name
-            dsl += "  path => '%s',\n" % self.path
-            dsl += "  group => '%s',\n" % self.group
-            dsl += "  owner => '%s',\n" % self.owner
-            dsl += "  ensure => 'directory',\n"
-            dsl += "  mode => '%s',\n" % self.pmode
-            dsl += "}\n\n"
-
-        elif self.type == 'symlink':
-
-            #create file dsl entry for app.pp
-            dsl =  "file { '%s':\n" % self.name
-            dsl += "  path => '%s',\n" % self.path
-            dsl += "  target => '%s',\n" % self.target
-            dsl += "  ensure => 'link',\n"
-            dsl += "}\n\n"
-
-        return dsl
+            name = 'templates/' + self.source_name()
+        else:
+            return
+        sink = sinks.sink(sink)
+        Stats.Instance().add('bytes_written', self.size)
+        if self.spool:
+            sink.move(name, self.spool)
+            self.spool = None
+            return
+        if self.encoded:
+            sink.stream(name, self.size, Base64Reader(self.contents))
+            self.encoded = False
+        else:
+            sink.write(name, self.contents or '')
+        self.contents = None
+
+    def store(self, fpath):
+        """
+        Store the file body at fpath, atomically, and release it.
+
+        """
+        Stats.Instance().add('bytes_written', self.size)
+        if self.spool:
+            shutil.move(self.spool, fpath)
+            self.spool = None
+            return
+        if self.encoded:
+            fd, spool = tempfile.mkstemp(prefix='.spool-', dir=os.path.dirname(fpath))
+            os.close(fd)
+            spool_base64(self.contents, spool)
+            os.rename(spool, fpath)
+            self.encoded = False
+        else:
+            utils.atomic_write(fpath, self.contents or '')
+        self.contents = None
+
+    def release(self):
+        """
+        Drop the file body, it is stored elsewhere.
+
+        """
+        self.contents = None
+        self.encoded = False
+        if self.spool:
+            os.remove(self.spool)
+            self.spool = None
+
+    def attributes(self, module_name, defaults=None):
+        """
+        Returns the (attribute, value) pairs of the file resource, but
+        those set to the same value by defaults.  The defaults the
+        resource has no value for, i.e. the mode of a symlink, are reset
+        to undef.
+
+        """
+        values = {'name': self.name, 'path': self.path, 'group': self.group, 'owner': self.owner,
+                  'pmode': self.pmode, 'target': self.target, 'module': self.source_module or module_name,
+                  'source': self.source_name()}
+        defaults = defaults or {}
+        attributes = [(key, value % values) for key, value in RESOURCES[self.type]
+                      if defaults.get(key) != value % values]
+        own = set(key for key, value in RESOURCES[self.type])
+        attributes.extend((key, 'undef') for key in DEFAULTED if key in defaults and key not in own)
+        return attributes
+
+    def render(self, module_name, defaults=None):
+        """
+        Returns the file resource for the module's class manifest.
+
+        """
+        return "file { '%s':\n%s}\n\n" % (self.name, render_attributes(self.attributes(module_name, defaults)))
+
+
+def render_attributes(attributes):
+    return ''.join("  %s => %s,\n" % attribute for attribute in attributes)
+
+
+def resource_defaults(files, module_name):
+    """
+    Returns the most common value of each DEFAULTED attribute among the
+    resources of files that have it, symlinks have none, when more than
+    one resource has it.
+
+    :rtype: dict
+    """
+    counts = dict((key, {}) for key in DEFAULTED)
+    for file in files:
+        for key, value in file.attributes(module_name):
+            if key in counts:
+                counts[key][value] = counts[key].get(value, 0) + 1
+    defaults = {}
+    for key, values in counts.iteritems():
+        if values:
+            count, value = max((count, value) for value, count in values.iteritems())
+            if count > 1:
+                defaults[key] = value
+    return defaults
+
+
+def render_resources(files, module_name):
+    """
+    Yields the resources of files for a class manifest: the most common
+    owner, group and mode set once as resource defaults, then the
+    directories, titled by their paths and those with the same attributes
+    declared by a single resource, then every other resource with only
+    the attributes that differ from the defaults.
+
+    """
+    defaults = resource_defaults(files, module_name)
+    if defaults:
+        yield "File {\n%s}\n\n" % render_attributes([(key, defaults[key]) for key in DEFAULTED if key in defaults])
+
+    groups = {}
+    order = []
+    for file in files:
+        if file.type == 'directory':
+            attributes = tuple(attribute for attribute in file.attributes(module_name, defaults)
+                               if attribute[0] != 'path')
+            if attributes not in groups:
+                groups[attributes] = []
+                order.append(attributes)
+            groups[attributes].append(file)
+    for attributes in order:
+        directories = groups[attributes]
+        if len(directories) == 1:
+            yield "file { '%s':\n%s}\n\n" % (directories[0].path, render_attributes(attributes))
+        else:
+            yield "file { [\n%s]:\n%s}\n\n" % (''.join("  '%s',\n" % file.path for file in directories),
+                                                  render_attributes(attributes))
+
+    for file in files:
+        if file.type != 'directory':
+            yield file.render(module_name, defaults)
+
+
+class Manifest(object):
+    """
+    The class manifest of a module, manifests/init.pp.  It holds the
+    (body-less) Files added and renders their resources once every file
+    was added, see render_resources().
+    """
+
+    def __init__(self, sink, module, parameters=None):
+        self.sink = sink
+        self.module = module
+        self.parameters = parameters
+        self.files = []
+
+    def write(self, file):
+        """
+        Add the resource of file to the manifest.
+
+        """
+        self.files.append(file)
+
+    def _write(self, name, header, files, body=''):
+        fh = self.sink.open(name)
+        fh.write(header)
+        for resources in render_resources(files, self.module.class_name):
+            fh.write(resources)
+        fh.write(body)
+        fh.write(self.module.manifest_footer())
+        fh.close()
+
+    def close(self):
+        self._write('manifests/init.pp', self.module.manifest_header(self.parameters), self.files)
+        self.files = []
+
+
+class ShardedManifest(Manifest):
+    """
+    A class manifest whose resources are split into subclasses, each in a
+    manifest of its own, that manifests/init.pp contains.  The subclasses
+    take the class parameters, so templates see the same values.
+    """
+
+    def __init__(self, sink, module, parameters=None, by='directory', size=SHARD_SIZE):
+        Manifest.__init__(self, sink, module, parameters)
+        self.by = by
+        self.size = size
+        self.shards = []
+        self.members = {}
+        self.descriptions = {}
+        self.current = None
+
+    def shard(self, file):
+        """
+        Returns the subclass name holding the resource of file.
+
+        """
+        if self.by == 'size':
+            if self.current is None or len(self.members[self.current]) >= self.size:
+                return 'part%d' % (len(self.shards) + 1)
+            return self.current
+        return SHARD_PREFIX + re.sub('[^a-z0-9_]', '_', '_'.join(self._components(file) or ['root']).lower())
+
+    def _components(self, file):
+        directory = file.type == 'directory' and file.path or os.path.dirname(file.path)
+        return [c for c in directory.split('/') if c][:SHARD_DEPTH]
+
+    def write(self, file):
+        shard = self.shard(file)
+        if shard not in self.members:
+            # resources of a directory are not always added together, i.e. /etc/a-b sorts between /etc/a and /etc/a/b
+            self.shards.append(shard)
+            self.members[shard] = []
+            if self.by == 'directory':
+                self.descriptions[shard] = 'under /%s' % '/'.join(self._components(file))
+            else:
+                self.descriptions[shard] = 'part %d' % len(self.shards)
+        self.current = shard
+        self.members[shard].append(file)
+
+    def close(self):
+        for shard in self.shards:
+            self._write('manifests/%s.pp' % shard,
+                        self.module.shard_header(shard, self.parameters, self.descriptions[shard]),
+                        self.members[shard])
+        self._write('manifests/init.pp', self.module.manifest_header(self.parameters), [],
+                    self.module.contain(self.shards))
+        self.members = {}
 
 
 @Singleton
@@ -113,11 +552,289 @@ class FileManager(object):
     """
 
     def __init__(self):
+        # the managed Files by path, and the paths by File name
         self.files = {}
+        self.names = {}
         self.tag_manager = ptags.TagManager()
+        self.manifest = None
+        self.sink = None
+        self.module = None
+        self.count = 0
+        self.blobs = {}
+        self.deduplicated = 0
+        self.saved = 0
+        self.common_path = None
+        self.common_name = None
+        self.spool_threshold = SPOOL_THRESHOLD
+        self.shard_by = None
+        self.shard_size = SHARD_SIZE
+        self.jobs = 1
+        self.pool = None
+        self.pending = []
+        self.pending_bytes = 0
+
+    def set_jobs(self, jobs):
+        """
+        Substitute the macros of the added files in this many worker
+        processes.  Files are then held as pending work and added, in the
+        order they were added in, by flush().  Setting 1 stops the workers
+        and substitutes every file as it is added.
+
+        The workers are started here, before the fetch threads are: a
+        process forked while they run would inherit the locks they hold.
+
+        """
+        jobs = max(1, jobs or 1)
+        if jobs != self.jobs:
+            self.flush()
+            self._stop_pool()
+            if jobs > 1:
+                self.pool = multiprocessing.Pool(jobs)
+        self.jobs = jobs
+
+    def _stop_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def flush(self):
+        """
+        Substitute the macros of the pending files on the worker processes
+        and add them, in order.
+
+        """
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+
+        deferred = [file for file, stored in pending if file.deferred]
+        if deferred:
+            stats = Stats.Instance()
+            bodies = [(file.contents, file.macro_start_delimeter, file.macro_end_delimeter) for file in deferred]
+            # the mapping goes with every chunk, the workers are not restarted when it changes
+            tasks = [(self.tag_manager.compiled, self.tag_manager.parameters, bodies[i:i + SUBSTITUTION_CHUNK])
+                     for i in range(0, len(bodies), SUBSTITUTION_CHUNK)]
+            with stats.stage('substitute'):
+                results = [result for chunk in self.pool.map(_substitute, tasks, 1) for result in chunk]
+            for file, (contents, replaced, unmapped, resolved) in zip(deferred, results):
+                file.substituted(contents, replaced > 0)
+                stats.add('macros_substituted', replaced)
+                stats.add('macros_unmapped', unmapped)
+                stats.add('macros_resolved', resolved)
+                if resolved and not replaced:
+                    stats.add('templates_downgraded')
+
+        for file, stored in pending:
+            if stored:
+                self._add_stored(file)
+            else:
+                self._add(file)
+
+    def _queue(self, file, stored=False):
+        if self.jobs == 1:
+            if stored:
+                self._add_stored(file)
+            else:
+                self._add(file)
+            return
+        self.pending.append((file, stored))
+        if file.deferred:
+            self.pending_bytes += len(file.contents)
+        if self.pending_bytes >= PENDING_BYTES or len(self.pending) >= self.jobs * SUBSTITUTION_CHUNK * 8:
+            self.flush()
+
+    def set_sharding(self, by=None, size=SHARD_SIZE):
+        """
+        Split the resources of the modules written into subclasses, one per
+        directory (by='directory') or one per `size` resources (by='size').
+        Passing by=None writes every resource into init.pp.
+
+        """
+        self.shard_by = by
+        self.shard_size = size
+
+    def set_spool_threshold(self, threshold):
+        """
+        Set the size above which base64 encoded bodies are decoded straight to disk.
+
+        """
+        self.spool_threshold = threshold
+
+    def clear(self):
+        """
+        Forget all managed files so the manager can be reused for another module.
+
+        """
+        self.files = {}
+        self.names = {}
+        self.count = 0
+        self.blobs = {}
+        self.deduplicated = 0
+        self.saved = 0
+        self.pending = []
+        self.pending_bytes = 0
+
+    def set_common_module(self, path, module_name):
+        """
+        Store file bodies in the shared module at path, named by their
+        content hash, so that identical files of several modules are kept once.
+        Passing path=None stores bodies in each module again.
+
+        :param module_name: The class name of the shared module.
+        :type module_name: str
+        """
+        self.common_path = path
+        self.common_name = module_name
+
+    def _deduplicate(self, file):
+        """
+        Point file at an identical body already stored, if there is one.
+
+        """
+        if file.digest is None:
+            return
+
+        if file.type == 'file' and self.common_path:
+            blob = os.path.join(self.common_path, 'files', file.digest)
+            file.source = file.digest
+            file.source_module = self.common_name
+            file.shared = True
+            if os.path.exists(blob):
+                self.deduplicated += 1
+                self.saved += file.size
+            elif self.sink is not None:
+                # other conversions may store the same blob concurrently
+                self.sink.store(file, blob)
+            else:
+                file.store(blob)
+            return
+
+        key = (file.type, file.digest)
+        if key in self.blobs:
+            file.source = self.blobs[key]
+            file.shared = True
+            self.deduplicated += 1
+            self.saved += file.size
+        else:
+            self.blobs[key] = file.source_name()
+
+    def open(self, path, module, parameters=None):
+        """
+        Start streaming a module.  Until close() is called the body of every
+        added file is written into the module at path as soon as it is
+        added, and released.  Its File, without the body, is kept for the
+        class manifest, manifests/init.pp, or the manifest of its subclass,
+        see set_sharding(), and for the state of the channel, so memory
+        grows with the number of files but not with their size.  The
+        manifests are written by close(), once their resource defaults are
+        known.
+
+        :param path: The module directory, or the sink writing the module,
+                     i.e. a sinks.TarSink.
+        :type path: str
+
+        :param module: The skeleton of the module being written.
+        :type module: skeleton.ModuleSkeleton
+        """
+        sink = sinks.sink(path)
+        for directory in ('files', 'templates', 'manifests'):
+            sink.mkdir(directory)
+        # the manifests of an earlier conversion, they may be links to those of the module in place
+        sink.purge('manifests', '.pp')
+        self.sink = sink
+        self.module = module
+        if self.shard_by:
+            self.manifest = ShardedManifest(sink, module, parameters, self.shard_by, self.shard_size)
+        else:
+            self.manifest = Manifest(sink, module, parameters)
+
+    def close(self):
+        """
+        Write the manifests of the streamed module.
+
+        """
+        self.flush()
+        with Stats.Instance().stage('write'):
+            self.manifest.close()
+        self.manifest = None
+        self.sink = None
+        self.module = None
+
+    def _index(self, file):
+        """
+        Index file by its path.  Distinct paths may mangle to the same name,
+        i.e. /etc/a_b and /etc/a/b, the later one is then renamed.
+
+        """
+        previous = self.files.get(file.path)
+        if previous is not None:
+            file.name = previous.name
+        elif file.name in self.names:
+            base = file.name
+            suffix = 2
+            while '%s_%d' % (base, suffix) in self.names:
+                suffix += 1
+            file.name = '%s_%d' % (base, suffix)
+        self.names[file.name] = file.path
+        self.files[file.path] = file
+
+    def _add(self, file):
+        stats = Stats.Instance()
+        stats.add(COUNTERS[file.type])
+        self.count += 1
+        self._index(file)
+        self._deduplicate(file)
+        # once streamed, only the (body-less) File is kept, for the manifest and the state
+        if self.manifest is not None:
+            with stats.stage('write'):
+                file.write(self.sink)
+            self.manifest.write(file)
+
+    def add_record(self, record):
+        """
+        Add a File whose body is already stored in the module, from the
+        record of a previous conversion.
+
+        :param record: The File record, see File.record().
+        :type record: dict
+        """
+        file = File.from_record(record)
+        if file.digest is not None and not file.source_module:
+            self.blobs.setdefault((file.type, file.digest), file.source_name())
+        self._queue(file, stored=True)
+
+    def _add_stored(self, file):
+        self.count += 1
+        self._index(file)
+        if self.manifest is not None:
+            self.manifest.write(file)
+
+    def prune(self, path):
+        """
+        Remove the bodies in the module at path that no managed File uses anymore.
+
+        """
+        self.flush()
+        used = set()
+        for file in self.files.itervalues():
+            if file.type == 'file' and not file.source_module:
+                used.add(('files', file.source_name()))
+            elif file.type == 'template':
+                used.add(('templates', file.source_name()))
+        for directory in ('files', 'templates'):
+            dpath = os.path.join(path, directory)
+            if not os.path.isdir(dpath):
+                continue
+            for name in os.listdir(dpath):
+                if (directory, name) not in used:
+                    os.remove(os.path.join(dpath, name))
 
     def set_tag_manager(self, manager):
         if manager:
+            self.flush()
             self.tag_manager = manager
 
     def add_file(self, **kwargs):
@@ -131,9 +848,36 @@ class FileManager(object):
         macro_start_delimiter = kwargs['macro_start_delimiter']
         macro_end_delimiter = kwargs['macro_end_delimiter']
         is_binary = kwargs['is_binary']
-
-        self.files[name] = File(name, type, path, pmode, group, owner, contents, macro_start_delimiter,
-                                macro_end_delimiter, is_binary=is_binary)
+        spool = None
+        stream = False
+
+        # bodies are handled as bytes, non-ASCII text is returned as unicode
+        contents = utils.utf8(contents)
+        macro_start_delimiter = utils.utf8(macro_start_delimiter)
+        macro_end_delimiter = utils.utf8(macro_end_delimiter)
+
+        # base64 encoded contents are decoded here, large ones a chunk at a time to disk,
+        # or as they are written when streaming to a sink that can take them
+        if kwargs.get('encoded') and contents:
+            if len(contents) / 4 * 3 <= self.spool_threshold:
+                contents = contents.decode('base64')
+            elif self.sink is not None and self.sink.streams:
+                stream = True
+            else:
+                spool = self._spool_path()
+
+        self._queue(File(name, type, path, pmode, group, owner, contents, macro_start_delimiter,
+                         macro_end_delimiter, is_binary=is_binary, tag_manager=self.tag_manager,
+                         spool=spool, deferred=self.jobs > 1, stream=stream))
+
+    def _spool_path(self):
+        if self.sink is not None and self.sink.spool_dir:
+            # next to its final location when streaming, so it only has to be renamed
+            fd, spool = tempfile.mkstemp(prefix='.spool-', dir=self.sink.spool_dir)
+        else:
+            fd, spool = tempfile.mkstemp(prefix='puppetize-spool-')
+        os.close(fd)
+        return spool
 
     def add_directory(self, **kwargs):
         name= kwargs['name']
@@ -144,7 +888,7 @@ class FileManager(object):
         group = kwargs['group']
         owner = kwargs['owner']
 
-        self.files[name] = File(name, type, path, pmode, group, owner)
+        self._queue(File(name, type, path, pmode, group, owner))
 
     def add_symlink(self, **kwargs):
         name= kwargs['name']
@@ -152,55 +896,37 @@ class FileManager(object):
         target = kwargs['target_path']
         type='symlink'
 
-        self.files[name] = File(name, type, path, target=target)
+        self._queue(File(name, type, path, target=target))
 
-    def remove_file(self, name):
+    def remove_file(self, path):
         """
         Removes a File Object from management by the File Manager.
 
         """
-        if name in self.files.keys():
-            del self.files[name]
+        self.flush()
+        file = self.files.pop(path, None)
+        if file is not None:
+            del self.names[file.name]
 
-    def write_parameters(self, parameters):
+    def ordered(self):
         """
-        Returns a properly formatted parameters clause for a Puppet Class.
+        Returns the managed Files ordered by path depth, then path, so that
+        directories precede their contents.
 
         """
-        pstring = ""
-        pstring += "(\n"
-        for parameter in parameters:
-            pstring += "%s,\n" % parameter
-        pstring += ")\n"
-        return pstring
-
-    def export(self, path, module_name, manifest_name, parameters=None):
-
-        files_path = os.path.join(path, 'files')
-        utils.mkdir(files_path)
-
-        templates_path = os.path.join(path, 'templates')
-        utils.mkdir(templates_path)
+        return sorted(self.files.itervalues(), key=lambda file: (file.path.count('/'), file.path))
 
-        manifests_path = os.path.join(path, 'manifests')
-
-        app_manifest = os.path.join(manifests_path, manifest_name+'.pp')
-        fh = open(app_manifest, "r+")
-
-        offset=0
-        for line in fh:
-            offset += len(line)
-            if line.startswith("class"):
-                break
-
-        fh.seek(offset-2)
-
-        if parameters:
-            fh.write(self.write_parameters(parameters))
-
-        fh.write("{\n\n")
+    def export(self, path, module, parameters=None):
+        """
+        Write the files held by the manager into the module at path, a
+        directory or a sink such as sinks.TarSink.
 
-        for name, file in self.files.iteritems():
-            fh.write(file.export(path, module_name))
-        fh.write("}")
-        fh.close()
+        :param module: The skeleton of the module being written.
+        :type module: skeleton.ModuleSkeleton
+        """
+        self.flush()
+        self.open(path, module, parameters)
+        for file in self.ordered():
+            file.write(self.sink)
+            self.manifest.write(file)
+        self.close()
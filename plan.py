@@ -0,0 +1,261 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import sinks
+
+#
+# Constants
+#
+
+# A file resource of a manifest, titled by one name or an array of paths,
+# and the resource defaults of its class, see pfile.render_resources().
+RESOURCE = re.compile(r"^file \{ ('(?:[^'\\]|\\.)*'|\[[^\]]*\]):\n((?:  \w+ => .*,\n)*)\}", re.M)
+DEFAULTS = re.compile(r"^File \{\n((?:  \w+ => .*,\n)*)\}", re.M)
+ATTRIBUTE = re.compile(r"^  (\w+) => (.*),$", re.M)
+TITLE = re.compile(r"'((?:[^'\\]|\\.)*)'")
+
+# The directories of a module whose files are all written by a conversion,
+# any other file found there was removed from the channel.
+GENERATED = ('files', 'templates', 'manifests', 'data')
+
+# Number of bytes hashed at a time.
+HASH_CHUNK = 1024 * 1024
+
+# The changes of a plan.
+ADDED, CHANGED, REMOVED = 'added', 'changed', 'removed'
+SYMBOLS = {ADDED: '+', CHANGED: '~', REMOVED: '-'}
+
+
+def parse_resources(text):
+    """
+    Returns the file resources of a manifest by path, each a dict of its
+    attributes, the resource defaults included, and their (unparsed)
+    values.  Resources titled by an array of paths are one per path.
+
+    """
+    defaults = {}
+    for match in DEFAULTS.finditer(text):
+        defaults.update(ATTRIBUTE.findall(match.group(1)))
+    resources = {}
+    for match in RESOURCE.finditer(text):
+        attributes = dict(defaults)
+        attributes.update(ATTRIBUTE.findall(match.group(2)))
+        if 'path' in attributes:
+            resources[TITLE.match(attributes.pop('path')).group(1)] = attributes
+        else:
+            for title in TITLE.findall(match.group(1)):
+                resources[title] = dict(attributes)
+    return resources
+
+
+def digest(fileobj):
+    """
+    Returns the sha1 of the contents read from fileobj.
+
+    """
+    sha = hashlib.sha1()
+    while True:
+        chunk = fileobj.read(HASH_CHUNK)
+        if not chunk:
+            break
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ModuleIndex(object):
+    """
+    The content hashes of the files of a module directory, and the file
+    resources of its manifests: manifests/init.pp and its subclasses.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.resources = {}
+        if not os.path.isdir(path):
+            return
+        for root, directories, files in os.walk(path):
+            for name in files:
+                if name.startswith('.'):
+                    # the spools of an interrupted conversion
+                    continue
+                fpath = os.path.join(root, name)
+                fh = open(fpath, "rb")
+                try:
+                    self.files[os.path.relpath(fpath, path)] = digest(fh)
+                    if name.endswith('.pp') and os.path.basename(root) == 'manifests':
+                        fh.seek(0)
+                        self.resources.update(parse_resources(fh.read()))
+                finally:
+                    fh.close()
+
+
+class PlanSink(object):
+    """
+    Computes the changes a conversion makes to the module at path instead
+    of writing it: every file written is hashed and compared with the one
+    on disk, and the resources of the manifests with those of the module.
+    When applying, only the files that differ are written, and those the
+    conversion no longer writes are removed.
+    """
+
+    # bodies are spooled outside of the module, see FileManager._spool_path()
+    streams = False
+    spool_dir = None
+
+    def __init__(self, path, apply=False):
+        self.path = path
+        self.apply = apply
+        self.index = ModuleIndex(path)
+        self.directory = sinks.DirectorySink(path)
+        self.files = {ADDED: [], CHANGED: [], REMOVED: []}
+        self.resources = {ADDED: [], CHANGED: [], REMOVED: []}
+        self.blobs = []
+        self.written = set()
+        self.manifests = {}
+        self.order = []
+
+    def _compare(self, name, sha):
+        """
+        Record how the file name compares with the one on disk.
+
+        :return: Whether it differs.
+        :rtype: bool
+        """
+        self.written.add(name)
+        previous = self.index.files.get(name)
+        if previous == sha:
+            return False
+        self.files[previous is None and ADDED or CHANGED].append(name)
+        return True
+
+    def mkdir(self, name):
+        if self.apply:
+            self.directory.mkdir(name)
+
+    def purge(self, name, suffix):
+        # stale files are found once every file was written, see close()
+        pass
+
+    def open(self, name, append=False):
+        if name not in self.order:
+            self.order.append(name)
+        if name not in self.manifests or not append:
+            self.manifests[name] = sinks.Buffered()
+        return self.manifests[name]
+
+    def write(self, name, contents):
+        if self._compare(name, hashlib.sha1(contents).hexdigest()) and self.apply:
+            self.directory.write(name, contents)
+
+    def move(self, name, spool):
+        fh = open(spool, "rb")
+        try:
+            changed = self._compare(name, digest(fh))
+        finally:
+            fh.close()
+        if changed and self.apply:
+            self.directory.move(name, spool)
+        else:
+            os.remove(spool)
+
+    def stream(self, name, size, fileobj):
+        fd, spool = tempfile.mkstemp(prefix='puppetize-spool-')
+        fh = os.fdopen(fd, "wb")
+        try:
+            shutil.copyfileobj(fileobj, fh)
+        finally:
+            fh.close()
+        self.move(name, spool)
+
+    def store(self, file, fpath):
+        """
+        Store the body of file in the common module, when applying.
+
+        """
+        self.blobs.append(fpath)
+        if self.apply:
+            file.store(fpath)
+        else:
+            file.release()
+
+    def close(self):
+        """
+        Compare the manifests and find the files no longer written.
+
+        """
+        resources = {}
+        for name in self.order:
+            buffer = self.manifests[name].buffer
+            buffer.seek(0)
+            contents = buffer.read()
+            buffer.close()
+            resources.update(parse_resources(contents))
+            self.write(name, contents)
+        self.manifests = {}
+
+        for path, attributes in sorted(resources.iteritems()):
+            previous = self.index.resources.get(path)
+            if previous is None:
+                self.resources[ADDED].append((path, {}))
+            elif previous != attributes:
+                changes = dict((key, (previous.get(key), attributes.get(key)))
+                               for key in set(previous) | set(attributes)
+                               if previous.get(key) != attributes.get(key))
+                self.resources[CHANGED].append((path, changes))
+        for path in sorted(set(self.index.resources) - set(resources)):
+            self.resources[REMOVED].append((path, {}))
+
+        for name in sorted(self.index.files):
+            if name.split(os.sep)[0] in GENERATED and name not in self.written:
+                self.files[REMOVED].append(name)
+                if self.apply:
+                    os.remove(os.path.join(self.path, name))
+        for kind in (ADDED, CHANGED):
+            self.files[kind].sort()
+
+    def abort(self):
+        for buffer in self.manifests.values():
+            buffer.buffer.close()
+        self.manifests = {}
+
+    def changed(self):
+        """
+        Returns whether the conversion changes the module.
+
+        """
+        return bool([names for names in self.files.values() if names])
+
+    def report(self):
+        """
+        Returns the changes as text, resources first.
+
+        """
+        lines = ['Plan for %s:' % self.path]
+        for kind in (ADDED, CHANGED, REMOVED):
+            for path, changes in self.resources[kind]:
+                lines.append('  %s file %s' % (SYMBOLS[kind], path))
+                for key, (old, new) in sorted(changes.iteritems()):
+                    lines.append('      %s: %s -> %s' % (key, old, new))
+        for kind in (ADDED, CHANGED, REMOVED):
+            for name in self.files[kind]:
+                lines.append('  %s %s' % (SYMBOLS[kind], name))
+        for fpath in self.blobs:
+            lines.append('  %s %s' % (SYMBOLS[ADDED], fpath))
+        lines.append('Resources: %d to add, %d to change, %d to remove.  Files: %d to add, %d to change, '
+                     '%d to remove.' % tuple([len(self.resources[kind]) for kind in (ADDED, CHANGED, REMOVED)] +
+                                             [len(self.files[kind]) for kind in (ADDED, CHANGED, REMOVED)]))
+        return '\n'.join(lines)
@@ -9,8 +9,12 @@
 # have received a copy of GPLv2 along with this software; if not, see
 # http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
 
+import hashlib
+import json
 import os
+import re
 import utils
+from stats import Stats
 
 # Default Mapping
 MAPPING = {
@@ -29,49 +33,321 @@ MAPPING = {
     }
 }
 
+class MappingError(ValueError):
+    """
+    Raised when a mapping file is not a valid mapping.
+    """
+
+
+# A parameterized macro, i.e. rhn.system.net_interface.ip_address(eth_device).
+PARAMETERIZED = re.compile(r'^([\w.]+)\(\s*\w+\s*\)$')
+
+# The version of the compiled mapping cached by load_mapping(), to bump
+# whenever CompiledMapping changes.
+CACHE_VERSION = 2
+
+# The placeholder for the macro argument in a replacement, i.e. {NETWORK INTERFACE}.
+PLACEHOLDER = re.compile(r'\{[^}]*\}')
+
+
+def validate(mapping):
+    """
+    Check that mapping is a {"mapping": {macro: replacement}} dict of strings.
+
+    :raises MappingError: When it is not.
+    """
+    if not isinstance(mapping, dict) or not isinstance(mapping.get('mapping'), dict):
+        raise MappingError('A mapping must be a JSON object with a "mapping" object')
+    for tag, replacement in mapping['mapping'].iteritems():
+        if not isinstance(tag, basestring) or not tag.strip():
+            raise MappingError('Invalid macro %r in mapping' % (tag,))
+        if not isinstance(replacement, basestring):
+            raise MappingError('The replacement of %s must be a string' % tag)
+
+
+def fact_suffix(argument):
+    """
+    Returns the Facter name suffix for a macro argument, i.e. eth0:1 -> eth0_1.
+    """
+    return re.sub('[^0-9a-zA-Z_]', '_', argument)
+
+
+def parameter_name(macro, argument=None):
+    """
+    Returns the name of the class parameter standing for a macro, the last
+    component of its name followed by its argument, if any.
+
+    """
+    name = fact_suffix(macro.strip().rsplit('.', 1)[-1])
+    if argument is None:
+        return name
+    return '%s_%s' % (name, fact_suffix(argument))
+
+
+class CompiledMapping(object):
+    """
+    A validated mapping compiled into a single regex, which has to match
+    the whole text between the delimiters of a macro, but its blanks.
+    Literal macros are matched as-is, parameterized macros such as
+    rhn.system.net_interface.ip_address(eth_device) match any argument,
+    which replaces the {...} placeholder of their replacement:
+    rhn.system.net_interface.ip_address(eth0) -> @ipaddress_eth0.
+    """
+
+    def __init__(self, mapping):
+        validate(mapping)
+        # the file bodies are UTF-8 bytes, so is the mapping loaded from JSON
+        mapping = utils.utf8(mapping)
+        self.mapping = mapping
+        self.literals = {}
+        self.functions = {}
+        for tag, replacement in mapping['mapping'].iteritems():
+            match = PARAMETERIZED.match(tag.strip())
+            if match:
+                self.functions[match.group(1)] = replacement
+            else:
+                self.literals[tag.strip()] = replacement
+        self.pattern = self._pattern()
+        self.matcher = self.pattern and re.compile(self.pattern)
+
+    def _pattern(self):
+        # longer names first, so that a name which is a prefix of another never wins
+        alternatives = []
+        if self.functions:
+            names = sorted(self.functions, key=len, reverse=True)
+            alternatives.append(r'(?P<function>%s)\(\s*(?P<argument>[^)]*?)\s*\)' %
+                                '|'.join(re.escape(name) for name in names))
+        if self.literals:
+            tags = sorted(self.literals, key=len, reverse=True)
+            alternatives.append('(?P<literal>%s)' % '|'.join(re.escape(tag) for tag in tags))
+        if not alternatives:
+            return ''
+        # anchored, so that i.e. rhn.system.sidekick is not taken for rhn.system.sid
+        return '(?:%s)$' % '|'.join(alternatives)
+
+    def __getstate__(self):
+        return {'mapping': self.mapping, 'literals': self.literals,
+                'functions': self.functions, 'pattern': self.pattern}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matcher = self.pattern and re.compile(self.pattern)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Returns the compiled mapping of a state, see __getstate__(), without
+        validating and compiling the mapping again.
+
+        """
+        compiled = cls.__new__(cls)
+        compiled.__setstate__(utils.utf8(state))
+        return compiled
+
+    def _replace(self, match):
+        if match.group('literal') is not None:
+            return self.literals[match.group('literal')]
+        replacement = self.functions[match.group('function')]
+        return PLACEHOLDER.sub(fact_suffix(match.group('argument')), replacement)
+
+    def parameter(self, match):
+        """
+        Returns the name of the class parameter a macro may be mapped to,
+        the last component of its name: rhn.system.sid -> sid, and
+        rhn.system.net_interface.broadcast(eth0) -> broadcast_eth0.
+
+        """
+        if match.group('literal') is not None:
+            return parameter_name(match.group('literal'))
+        return parameter_name(match.group('function'), match.group('argument'))
+
+    def sub(self, marked_string, parameters=None):
+        """
+        Replace the macro in marked_string, the text between its
+        delimiters, when it is mapped.  Anything else but blanks around the
+        macro, i.e. {| rhn.system.hostname = "x" |}, leaves it unmapped.
+        Macros mapped to nothing are mapped to the class parameter of the
+        same name instead, when it is one of parameters.
+
+        :return: The new string and the number of macros replaced.
+        :rtype: tuple
+        """
+        if not self.matcher:
+            return marked_string, 0
+        start = len(marked_string) - len(marked_string.lstrip())
+        end = len(marked_string.rstrip())
+        match = self.matcher.match(marked_string, start, end)
+        if match is None:
+            return marked_string, 0
+        replacement = self._replace(match)
+        if not replacement and parameters and self.parameter(match) in parameters:
+            replacement = '@' + self.parameter(match)
+        return marked_string[:start] + replacement + marked_string[end:], 1
+
+
+def parameter_names(parameters):
+    """
+    Returns the names of class parameters declared as in custom_parameters,
+    i.e. ['$sid', '$site = "lab"'] -> set(['sid', 'site']).
+
+    """
+    return set(p.split('=', 1)[0].strip().lstrip('$') for p in parameters or [])
+
+
+def load_mapping(path, cache_dir=None):
+    """
+    Returns the compiled mapping of the JSON file at path.  The compiled
+    mapping is cached as JSON in cache_dir, when given, and used until the
+    file changes or CACHE_VERSION does.
+
+    :param cache_dir: The directory of the cache, i.e. <working_dir>/.puppetize.
+    :type cache_dir: str
+
+    :raises MappingError: When the file is not a valid mapping.
+    """
+    stat = os.stat(path)
+    signature = [CACHE_VERSION, os.path.abspath(path), stat.st_mtime, stat.st_size]
+    cache = None
+    if cache_dir:
+        cache = os.path.join(cache_dir, 'mapping-%s.json' % hashlib.sha1(os.path.abspath(path)).hexdigest()[:12])
+        try:
+            fh = open(cache, "r")
+            try:
+                cached = json.load(fh)
+            finally:
+                fh.close()
+            if cached['signature'] == signature:
+                return CompiledMapping.from_state(cached['compiled'])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    fh = open(path, "r")
+    try:
+        try:
+            compiled = CompiledMapping(json.load(fh))
+        except ValueError, err:
+            raise MappingError('%s is not a valid mapping: %s' % (path, err))
+    finally:
+        fh.close()
+
+    if cache:
+        try:
+            utils.mkdir(cache_dir)
+            utils.atomic_write(cache, json.dumps({'signature': signature, 'compiled': compiled.__getstate__()}))
+        except (IOError, OSError):
+            # compile again next time
+            pass
+    return compiled
+
+
+class Substitution(object):
+    """
+    The result of expanding the macros in a single file.
+    """
+
+    def __init__(self, contents, replaced, unmapped, resolved=0):
+        self.contents = contents
+        self.replaced = replaced
+        self.unmapped = unmapped
+        # the macros mapped to nothing, dropped from the contents
+        self.resolved = resolved
+
+    def downgraded(self):
+        """
+        Returns whether every mapped macro was resolved, so that the
+        contents are a static file rather than a template.
+
+        """
+        return self.resolved > 0 and not self.replaced
+
+    def record(self):
+        """
+        Add the macros of the file to the Stats counters.
+
+        """
+        stats = Stats.Instance()
+        stats.add('macros_substituted', self.replaced)
+        stats.add('macros_resolved', self.resolved)
+        stats.add('macros_unmapped', len(self.unmapped))
+        if self.downgraded():
+            stats.add('templates_downgraded')
+
+
 class TagManager(object):
     """
-    This provides a utility for tag/macro mappings.
+    This provides a utility for tag/macro mappings.  Macros mapped to
+    nothing are resolved when converting: they are dropped, or mapped to
+    the class parameter of the same name when it is declared in parameters.
     """
 
-    def __init__(self, mapping=None):
-        if mapping:
-            self.mapping = mapping
+    def __init__(self, mapping=None, parameters=None):
+        if isinstance(mapping, CompiledMapping):
+            self.compiled = mapping
         else:
-            self.mapping = MAPPING
+            self.compiled = CompiledMapping(mapping or MAPPING)
+        self.mapping = self.compiled.mapping
+        self.parameters = parameter_names(parameters)
+        self._scanners = {}
 
-    def substitute(self, raw_string, start_marker, end_marker):
+    def _scanner(self, start_marker, end_marker):
+        """
+        Returns the (cached) compiled regex matching one delimited macro.
 
-        start = 0
-        end = 0
-        replaced = False
+        """
+        key = (start_marker, end_marker)
+        scanner = self._scanners.get(key)
+        if scanner is None:
+            scanner = re.compile('%s(.*?)%s' % (re.escape(start_marker), re.escape(end_marker)), re.DOTALL)
+            self._scanners[key] = scanner
+        return scanner
 
-        while True:
+    def expand(self, raw_string, start_marker, end_marker):
+        """
+        Expand every macro in raw_string in a single pass.  Unlike
+        substitute(), it does not count the macros in the Stats, see
+        Substitution.record().
 
-            try:
-                start = raw_string.index(start_marker, start)
-                end = raw_string.index(end_marker, start)
-            except ValueError:
-                break
+        :return: The expanded contents, the number of macros replaced, the
+                 list of macros that had no mapping and the number of
+                 macros resolved to nothing.
+        :rtype: Substitution
+        """
+        if not raw_string or not start_marker or not end_marker:
+            return Substitution(raw_string, 0, [])
 
-            marked_string = raw_string[(start + len(start_marker)):end]
+        compiled = self.compiled
+        parts = []
+        unmapped = []
+        replaced = 0
+        resolved = 0
+        position = 0
+        for macro in self._scanner(start_marker, end_marker).finditer(raw_string):
+            marked_string, count = compiled.sub(macro.group(1), self.parameters)
+            if count:
+                parts.append(raw_string[position:macro.start()])
+                if marked_string.strip():
+                    parts.append("<%= " + marked_string + " %>")
+                    replaced += 1
+                else:
+                    resolved += 1
+                position = macro.end()
+            else:
+                unmapped.append(marked_string.strip())
 
-            replaced, replaced_string = self.replace_tag(marked_string)
+        if not replaced and not resolved:
+            return Substitution(raw_string, 0, unmapped)
+        parts.append(raw_string[position:])
+        return Substitution(''.join(parts), replaced, unmapped, resolved)
 
-            if replaced:
-                replaced = True
-                part_one = raw_string[0:start]
-                part_two = raw_string[(end + len(end_marker)): len(raw_string)]
-                raw_string = part_one + replaced_string + part_two
+    def substitute(self, raw_string, start_marker, end_marker):
 
-        return replaced, raw_string
+        result = self.expand(raw_string, start_marker, end_marker)
+        result.record()
+        return result.replaced > 0, result.contents
 
     def replace_tag(self, marked_string):
 
-        for tag, replacement in self.mapping['mapping'].iteritems():
-            if tag in marked_string:
-                marked_string = marked_string.replace(tag, replacement)
-                return True, "<%= " + marked_string + " %>"
+        marked_string, count = self.compiled.sub(marked_string, self.parameters)
+        if count and marked_string.strip():
+            return True, "<%= " + marked_string + " %>"
         return False, marked_string
-
-
@@ -15,21 +15,41 @@
 
 import xmlrpclib
 import ConfigParser
+import copy
 import optparse
 import sys
 import os
 import re
-import subprocess
+import cProfile
+import logging
+import heapq
+import multiprocessing
+import multiprocessing.util
+import time
 from gettext import gettext as _
 from optparse import OptionParser
+import dump
+import fetch
+import hiera
+import journal
 import pfile
+import plan
 import utils
 import ptags
+import sinks
+import skeleton
+import spacewalk
+import state
+import verify
+import watch
+from stats import Stats
 
 #
 # Constants
 #
 
+log = logging.getLogger('puppetize')
+
 USAGE = _('%prog <options> [working-dir]')
 
 DESCRIPTION = _('Convert Satellite5 Configuration Channel into Puppet Module.')
@@ -38,20 +58,59 @@ CONFIG_FILE = _('Set config file for tool options.  default: /etc/puppetize/pupp
 
 CHANNEL = _('Set the channel label of the configuration channel to convert.')
 
+ALL_CHANNELS = _('Convert every global configuration channel visible to the user.')
+
+CHANNELS_FROM = _('Convert the channels listed (one label per line) in the file.')
+
+ORG = _('Only convert channels of the organization with this id or name.  Implies --all-channels.')
+
+DUMP = _('Record the Spacewalk data of the converted channels into the directory, for --from-dump.')
+
+FROM_DUMP = _('Convert from the channel data recorded by --dump in the directory, without contacting Spacewalk.')
+
+STATS = _('Print the time spent in each stage and the conversion counters, as a "table" or "json".')
+
+PROFILE = _('Write a cProfile dump of the run to the file.')
+
+VERBOSE = _('Print the details of every file as it is fetched.')
+
+FULL = _('Convert the whole channel again, even when it is unchanged since the last conversion.')
+
+WORKERS = _('Number of channels converted in parallel in bulk mode.  default: bulk_workers from puppetize.conf')
+
+PACKAGE = _('Write each module as a <module>-<version>.tar.gz archive into output_dir, ready for the Forge or \
+             Katello, instead of a module directory.')
+
+HIERA = _('Resolve the macros mapped to nothing for every system subscribed to the channel into per-node Hiera \
+           data of the module, setting its class parameters.')
+
+PLAN = _('Print the resources and files the conversion would add, change or remove in the module on disk, \
+          without writing anything.')
+
+APPLY = _('Like --plan, then only write the files that differ from the module on disk and remove the stale ones.')
+
+RESUME = _('Resume the last run where it stopped: channels it converted are skipped if their files are unchanged on \
+            disk, and the file details it fetched are not fetched again.')
+
+VERIFY = _('Once converted, check that the sources and templates of every file resource exist, and render the \
+            templates against the facts, and class parameters, of the JSON file, i.e. the output of facter --json.')
+
+WATCH = _('Keep running and poll the channels every SECONDS seconds, converting those that changed.')
+
+CYCLES = _('Stop watching after this many polls.')
+
+STATUS_PORT = _('Serve the watch status, including the last sync latency, as JSON over HTTP on this port.')
+
+JOBS = _('Number of processes substituting the macros of a channel\'s templates.  default: jobs from puppetize.conf')
+
 MAPPING = _('Set the mapping file for Spacewalk macros to Puppet Facts.  If not supplied, the default mapping in the \
              puppetize.conf will be used.')
 
 
-def clean(options, module_name):
+class ConversionError(Exception):
     """
-    Clean up before and after building when specified by the
-    user (-c|clean) command line option.
-
-    :param options: The command line options.
-    :type options: optparse.Options
+    Raised when a configuration channel cannot be converted.
     """
-    path = os.path.join(options['working_dir'], module_name)
-    utils.shell('rm -rf %s' % path)
 
 
 def get_options():
@@ -66,13 +125,59 @@ def get_options():
     parser.add_option("-f", "--config-file", dest="cfg_file", help=CONFIG_FILE)
     parser.add_option("-c", "--channel", dest="channel", help=CHANNEL)
     parser.add_option("-m", "--mapping", dest="mapping", help=MAPPING)
+    parser.add_option("-a", "--all-channels", dest="all_channels", action="store_true", default=False,
+                      help=ALL_CHANNELS)
+    parser.add_option("--channels-from", dest="channels_from", help=CHANNELS_FROM)
+    parser.add_option("--org", dest="org", help=ORG)
+    parser.add_option("-w", "--workers", dest="workers", type="int", help=WORKERS)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help=JOBS)
+    parser.add_option("--full", dest="full", action="store_true", default=False, help=FULL)
+    parser.add_option("--package", dest="package", action="store_true", default=False, help=PACKAGE)
+    parser.add_option("--hiera", dest="hiera", action="store_true", default=False, help=HIERA)
+    parser.add_option("--plan", dest="plan", action="store_true", default=False, help=PLAN)
+    parser.add_option("--apply", dest="apply", action="store_true", default=False, help=APPLY)
+    parser.add_option("--verify", dest="verify", metavar="FACTS", help=VERIFY)
+    parser.add_option("--resume", dest="resume", action="store_true", default=False, help=RESUME)
+    parser.add_option("--watch", dest="watch", type="float", metavar="SECONDS", help=WATCH)
+    parser.add_option("--cycles", dest="cycles", type="int", help=CYCLES)
+    parser.add_option("--status-port", dest="status_port", type="int", help=STATUS_PORT)
+    parser.add_option("--stats", dest="stats", type="choice", choices=['table', 'json'], help=STATS)
+    parser.add_option("--profile", dest="profile", help=PROFILE)
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help=VERBOSE)
+    parser.add_option("--dump", dest="dump", help=DUMP)
+    parser.add_option("--from-dump", dest="from_dump", help=FROM_DUMP)
 
     (opts, args) = parser.parse_args()
 
     # validate
-    if opts.channel is None:
+    if opts.org:
+        opts.all_channels = True
+    if opts.channel is None and not (opts.all_channels or opts.channels_from):
         print "Please specify a valid channel (see -h for help)"
         sys.exit(1)
+    if opts.channel and (opts.all_channels or opts.channels_from):
+        print "Please specify either a channel or a bulk conversion (see -h for help)"
+        sys.exit(1)
+
+    if opts.watch and opts.package:
+        print "Please specify either --watch or --package (see -h for help)"
+        sys.exit(1)
+
+    if (opts.plan or opts.apply) and (opts.watch or opts.package):
+        print "Please specify --plan or --apply without --watch or --package (see -h for help)"
+        sys.exit(1)
+
+    if opts.verify and (opts.watch or opts.package or (opts.plan and not opts.apply)):
+        print "Please specify --verify without --watch, --package or --plan (see -h for help)"
+        sys.exit(1)
+
+    if opts.resume and (opts.watch or opts.plan or opts.apply):
+        print "Please specify --resume without --watch, --plan or --apply (see -h for help)"
+        sys.exit(1)
+
+    if opts.dump and opts.from_dump:
+        print "Please specify either --dump or --from-dump (see -h for help)"
+        sys.exit(1)
 
     if not opts.cfg_file:
         opts.cfg_file = '/etc/puppetize/puppetize.conf'
@@ -92,6 +197,41 @@ def get_options():
         config_opts['working_dir'] = config.get('Puppet', 'working_dir')
         config_opts['output_dir'] = config.get('Puppet', 'output_dir')
         config_opts['mapping'] = config.get('Puppet', 'MAPPING')
+        config_opts['batch_size'] = fetch.BATCH_SIZE
+        if config.has_option('Spacewalk', 'batch_size'):
+            config_opts['batch_size'] = config.getint('Spacewalk', 'batch_size')
+        config_opts['fetch_workers'] = fetch.WORKERS
+        if config.has_option('Spacewalk', 'fetch_workers'):
+            config_opts['fetch_workers'] = config.getint('Spacewalk', 'fetch_workers')
+        config_opts['connections'] = spacewalk.POOL_SIZE
+        if config.has_option('Spacewalk', 'connections'):
+            config_opts['connections'] = config.getint('Spacewalk', 'connections')
+        config_opts['retries'] = fetch.RETRIES
+        if config.has_option('Spacewalk', 'retries'):
+            config_opts['retries'] = config.getint('Spacewalk', 'retries')
+        config_opts['bulk_workers'] = multiprocessing.cpu_count()
+        if config.has_option('Puppet', 'bulk_workers'):
+            config_opts['bulk_workers'] = config.getint('Puppet', 'bulk_workers')
+        config_opts['jobs'] = 1
+        if config.has_option('Puppet', 'jobs'):
+            config_opts['jobs'] = config.getint('Puppet', 'jobs')
+        config_opts['spool_threshold'] = pfile.SPOOL_THRESHOLD
+        if config.has_option('Puppet', 'spool_threshold'):
+            config_opts['spool_threshold'] = config.getint('Puppet', 'spool_threshold')
+        config_opts['shard_by'] = None
+        if config.has_option('Puppet', 'shard_by'):
+            config_opts['shard_by'] = config.get('Puppet', 'shard_by') or None
+        if config_opts['shard_by'] not in (None,) + pfile.SHARD_MODES:
+            raise ValueError('shard_by must be one of %s' % ', '.join(pfile.SHARD_MODES))
+        config_opts['shard_size'] = pfile.SHARD_SIZE
+        if config.has_option('Puppet', 'shard_size'):
+            config_opts['shard_size'] = config.getint('Puppet', 'shard_size')
+        config_opts['hiera_ttl'] = hiera.TTL
+        if config.has_option('Puppet', 'hiera_ttl'):
+            config_opts['hiera_ttl'] = config.getint('Puppet', 'hiera_ttl')
+        config_opts['common_module'] = None
+        if config.has_option('Puppet', 'common_module'):
+            config_opts['common_module'] = config.get('Puppet', 'common_module')
         if config.has_option('Puppet', 'custom_parameters'):
             config_opts['custom_parameters'] = config.get('Puppet', 'custom_parameters').split(',')
         else:
@@ -119,144 +259,690 @@ def get_options():
 
     return opts, config_opts
 
-def generate_puppet_module_template(options, name, sat5_url):
+def generate_puppet_module_template(path, name, sat5_url, common=None):
     """
     Build puppet module template to contain the
     config channel files.
 
-    :param options: The command line options.
-    :type options: optparse.Options
+    :param path: The module root directory.
+    :type path: str
 
     :param name: module name (org-cfgchannel)
     :type name: string
 
     :param sat5_url: The sat5/sw instance we're drawing data from
     :type sat5_url: string
-    """
-    try:
-        answers = ['0.1.0', 'Red Hat', 'GPLv2',
-                   'Module created from org-cfgchannel ' + name,
-                   sat5_url, sat5_url, sat5_url, 'Y']
-        gen_cmd = 'puppet module generate %s' % name
-        process = subprocess.Popen(gen_cmd,
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
-                                    shell=True, )
-        for a in answers:
-            process.stdout.readline()
-            process.stdin.write(a)
-            process.stdin.write('\n')
-
-    except Exception as e:
-        print e
-        sys.exit(1)
 
+    :param common: The shared module holding the file bodies, if any.
+    :type common: skeleton.ModuleSkeleton
 
-def main():
-    """
-    The command entry point.
+    :return: The skeleton of the generated module.
+    :rtype: skeleton.ModuleSkeleton
     """
+    # the files of the module are sourced from the common module
+    dependencies = common and [(common.name, common.version)]
+    module = skeleton.ModuleSkeleton(name, sat5_url, dependencies=dependencies)
+    module.write(path)
+    return module
 
-    _dir = os.getcwd()
-    options, config_options = get_options()
-    utils.chdir(config_options['working_dir'])
 
-    # Log in
-    spacewalk = xmlrpclib.Server("https://%s/rpc/api" % config_options['server'], verbose=0)
-    spacekey = spacewalk.auth.login(config_options['user'], config_options['password'])
+def add_file_info(fm, file):
+    """
+    Add a single lookupFileInfo result to the FileManager.
 
-    # Check if channel exists
-    try:
-        channel_details=spacewalk.configchannel.getDetails(spacekey, options.channel)
-    except xmlrpclib.Fault, err:
-        print "Error getting channel details (Code %s, %s)" % (err.faultCode, err.faultString)
-        spacewalk.auth.logout(spacekey)
-        sys.exit(1)
+    :param fm: The file manager collecting the module contents.
+    :type fm: pfile.FileManager
 
-    # Get Org Name
-    org = spacewalk.org.getDetails(spacekey, channel_details['orgId'])
+    :param file: The file details returned by Spacewalk.
+    :type file: dict
+    """
+    log.debug('JSON for path %s:\n%s', file['path'], file)
+
+    if file['type'] == 'file':
+
+        enc64 = False
+        contents = None
+        macro_start = None
+        macro_end = None
+        if file.has_key('contents_enc64') and file['contents_enc64']:
+            contents = file['contents']
+            macro_start = ''
+            macro_end = ''
+            enc64 = True
+        elif file.has_key('contents') and file['contents']:
+            contents = file['contents']
+            macro_start = file['macro-start-delimiter']
+            macro_end = file['macro-end-delimiter']
+
+        fm.add_file(name=file['path'].replace("/", "_"),
+                    path=file['path'],
+                    contents=contents,
+                    pmode=file['permissions_mode'],
+                    group=file['group'],
+                    owner=file['owner'],
+                    macro_start_delimiter=macro_start,
+                    macro_end_delimiter=macro_end,
+                    is_binary=enc64,
+                    encoded=enc64
+                    )
+        # the fetched batch holds on to the file details until its last file is added
+        file['contents'] = None
+
+    elif file['type'] == 'directory':
+        fm.add_directory(name=file['path'].replace("/", "_"),
+                         path=file['path'],
+                         pmode=file['permissions_mode'],
+                         group=file['group'],
+                         owner=file['owner'])
+
+    elif file['type'] == 'symlink':
+        fm.add_symlink(name=file['path'].replace("/", "_"),
+                       path=file['path'],
+                       target_path=file['target_path'])
+
+
+def module_names(org, channel_details):
+    """
+    Returns the puppet module and class names for a configuration channel.
 
+    :return: (module_name, class_name)
+    :rtype: tuple
+    """
     # puppetlabs usernames can be alphanumeric *only*
     # puppetlabs classnames can be only alphanumeric and underscore
     username = re.sub('[^0-9a-zA-Z]*', '', org['name']).lower()
     class_name = re.sub('[^0-9a-zA-Z_]', '_', channel_details['name']).lower()
-    module_name = username+'-'+class_name
+    return username+'-'+class_name, class_name
+
+
+def module_path(config_options, module_name):
+    """
+    Returns the directory of a module, in output_dir.  The state of the
+    conversions stays in working_dir.
+
+    """
+    return os.path.join(config_options['output_dir'], module_name)
+
+
+def module_target(options, config_options, module_name):
+    """
+    Returns the path the module is written to: its directory, or its
+    archive with --package, in output_dir.
+
+    """
+    if options.package:
+        release = skeleton.ModuleSkeleton(module_name, config_options['server']).release_name()
+        return os.path.join(config_options['output_dir'], release + '.tar.gz')
+    return module_path(config_options, module_name)
+
+
+def convert_channel(options, config_options, client, channel, mapping, common=None, journal=None):
+    """
+    Convert a single configuration channel into a Puppet module using an
+    existing Spacewalk session.
+
+    :param client: A logged in Spacewalk client.
+    :type client: spacewalk.Client
+
+    :param channel: The configuration channel label.
+    :type channel: str
+
+    :param mapping: The compiled macro mapping.
+    :type mapping: ptags.CompiledMapping
+
+    :param common: The shared module holding the file bodies, if any.
+    :type common: skeleton.ModuleSkeleton
+
+    :param journal: The journal recording the progress of the run, if any.
+    :type journal: journal.Journal
+
+    :return: The name of the generated module and the bytes saved by deduplication.
+    :rtype: tuple
+    """
+    stats = Stats.Instance()
+    module_name = journal and journal.completed(channel)
+    if module_name:
+        if journal.verify(channel):
+            print "Channel %s was already converted to %s, verified by checksum" % (channel, module_name)
+            stats.add('channels')
+            stats.add('channels_resumed')
+            return module_name, 0
+        print "Module %s changed since channel %s was converted, converting it again" % (module_name, channel)
+        options = copy.copy(options)
+        options.full = True
+    try:
+        module_name, saved = _convert_channel(options, config_options, client, channel, mapping, common, journal)
+    except (Exception, SystemExit), err:
+        if journal is not None:
+            journal.failed(channel, str(err) or err.__class__.__name__)
+        raise
+    return module_name, saved
+
 
-    # Clean module if exists
-    clean(config_options, module_name)
+def _convert_channel(options, config_options, client, channel, mapping, common, journal):
 
-    # Generate Module Template
-    generate_puppet_module_template(options, name=module_name, sat5_url=config_options['server'])
+    stats = Stats.Instance()
+    stats.add('channels')
+
+    # Check if channel exists
+    with stats.stage('getDetails'):
+        try:
+            channel_details=client.configchannel.getDetails(channel)
+        except xmlrpclib.Fault, err:
+            raise ConversionError("Error getting channel details (Code %s, %s)" % (err.faultCode, err.faultString))
+
+        # Get Org Name
+        org = client.org.getDetails(channel_details['orgId'])
+
+    module_name, class_name = module_names(org, channel_details)
 
     # Get files contained in channel
-    files = spacewalk.configchannel.listFiles(spacekey, options.channel)
+    with stats.stage('listFiles'):
+        files = client.configchannel.listFiles(channel)
 
-    paths = []
+    listing = {}
     for file in files:
-        paths.append(file['path'])
-
-    # Get file details
-    files = spacewalk.configchannel.lookupFileInfo(spacekey, options.channel, paths)
+        listing[file['path']] = file
+    # the file details fetched by an interrupted run
+    batches = journal and journal.batches(channel, listing)
+
+    nodes = None
+    if options.hiera:
+        with stats.stage('systems'):
+            systems = hiera.Systems(client, config_options['working_dir'], config_options['hiera_ttl'],
+                                    config_options['batch_size']).fetch(channel, refresh=options.full)
+        names, nodes = hiera.node_data(mapping, systems)
+        print "Channel %s: Hiera data of %d systems for %d parameters" % (channel, len(nodes), len(names))
+        # the macros mapped to nothing then stand for the class parameters set by the nodes
+        config_options = dict(config_options,
+                              custom_parameters=hiera.parameters(config_options['custom_parameters'], names))
+
+    if options.package:
+        return _package_channel(options, config_options, client, channel, mapping, common, module_name,
+                                sorted(listing), nodes, journal, batches)
 
     # Add files directory to module
-    path = os.path.join(config_options['working_dir'], module_name)
+    path = module_path(config_options, module_name)
+    utils.mkdir(config_options['output_dir'])
+
+    # Compare with the last conversion of the channel
+    settings = {'mapping': mapping.mapping,
+                'parameters': config_options['custom_parameters'],
+                'shards': [config_options['shard_by'], config_options['shard_size']],
+                'common': common and common.name}
+    cache = state.ChannelState.load(config_options['working_dir'], channel)
+
+    if options.plan or options.apply:
+        return _plan_channel(options, config_options, client, channel, mapping, common, module_name,
+                             listing, settings, cache, nodes)
+
+    full = options.full or not cache.matches(module_name, settings) or not os.path.isdir(path)
+
+    if full:
+        paths = sorted(listing)
+        cache.files = {}
+        cache.save()
+    else:
+        changed, removed = cache.changes(listing)
+        if not changed and not removed and cache.nodes == hiera.digest(nodes):
+            print "Channel %s is unchanged, skipping %s" % (channel, module_name)
+            stats.add('channels_unchanged')
+            return module_name, 0
+        print "Channel %s: %d files changed, %d removed" % (channel, len(changed), len(removed))
+        paths = sorted(changed)
+
+    # the module is built next to its final location and only replaces it once complete
+    with utils.staging(path, existing=not full) as build:
+        fm = _build_module(config_options, client, channel, mapping, common, module_name, build,
+                           paths, None if full else (cache, listing, changed), nodes, batches)
+
+    with stats.stage('state'):
+        cache.update(module_name, settings, listing, fm.files.values(), hiera.digest(nodes))
+        cache.save()
+    if journal is not None:
+        # unchanged channels are skipped above, they are as quick to skip again when resuming
+        with stats.stage('journal'):
+            journal.complete(channel, module_name, path, fm.files.values())
+
+    if fm.deduplicated:
+        print "Deduplicated %d of %d files, %d bytes saved" % (fm.deduplicated, fm.count, fm.saved)
+    return module_name, fm.saved
+
+
+def _package_channel(options, config_options, client, channel, mapping, common, module_name, paths, nodes,
+                     journal, batches):
+    """
+    Write the module of a channel straight into its archive in output_dir.
+    Archives are always written from scratch: neither the module directory
+    nor the state of the channel are used.
 
-    # Read in Mapping Json
-    fh = open(options.mapping, "r")
-    mapping = fh.read()
-    fh.close()
+    :return: (module_name, saved)
+    :rtype: tuple
+    """
+    release = skeleton.ModuleSkeleton(module_name, config_options['server']).release_name()
+    utils.mkdir(config_options['output_dir'])
+    path = module_target(options, config_options, module_name)
+    archive = sinks.TarSink(path, release)
+    try:
+        fm = _build_module(config_options, client, channel, mapping, common, module_name, archive, paths, None,
+                           nodes, batches)
+    except:
+        archive.abort()
+        raise
+    with Stats.Instance().stage('write'):
+        archive.close()
+    if journal is not None:
+        with Stats.Instance().stage('journal'):
+            journal.complete(channel, module_name, path)
+    print "Channel %s packaged to %s" % (channel, path)
+    if fm.deduplicated:
+        print "Deduplicated %d of %d files, %d bytes saved" % (fm.deduplicated, fm.count, fm.saved)
+    return module_name, fm.saved
+
+
+def _plan_channel(options, config_options, client, channel, mapping, common, module_name, listing, settings, cache,
+                  nodes):
+    """
+    Convert the whole channel in memory and compare the result with the
+    module on disk, by content hash and by resource.  The changes are
+    printed, and with --apply only those are written.
+
+    :return: (module_name, saved)
+    :rtype: tuple
+    """
+    stats = Stats.Instance()
+    path = module_path(config_options, module_name)
+    sink = plan.PlanSink(path, apply=options.apply)
+    if options.apply:
+        # the module is changed in place, it has to be converted again if this fails
+        cache.files = {}
+        cache.save()
+    try:
+        fm = _build_module(config_options, client, channel, mapping, common, module_name, sink,
+                           sorted(listing), None, nodes)
+    except:
+        sink.abort()
+        raise
+    with stats.stage('write'):
+        sink.close()
+    if sink.changed():
+        print sink.report()
+    else:
+        print "Module %s is up to date with channel %s" % (module_name, channel)
+
+    if options.apply:
+        with stats.stage('state'):
+            cache.update(module_name, settings, listing, fm.files.values(), hiera.digest(nodes))
+            cache.save()
+    return module_name, fm.saved
+
+
+def _build_module(config_options, client, channel, mapping, common, module_name, path, paths, incremental,
+                  nodes=None, batches=None):
+    """
+    Write the module of a channel at path, a directory or a sink.
+
+    :param paths: The paths of the files to fetch.
+    :type paths: list
+
+    :param incremental: None to write the module from scratch, or the
+                        (state, listing, changed paths) of the channel to
+                        update the existing module at path.
+    :type incremental: tuple
+
+    :param nodes: The Hiera data of the nodes to write, see hiera.node_data().
+    :type nodes: dict
+
+    :param batches: The file details recorded in the journal, see fetch.Fetcher.
+    :type batches: journal.Batches
+
+    :return: The FileManager holding the files of the module.
+    :rtype: pfile.FileManager
+    """
+    stats = Stats.Instance()
+    full = incremental is None
+    if full:
+        with stats.stage('skeleton'):
+            # Generate Module Template
+            module = generate_puppet_module_template(path, name=module_name,
+                                                     sat5_url=config_options['server'], common=common)
+    else:
+        cache, listing, changed = incremental
+        module = skeleton.ModuleSkeleton(module_name, config_options['server'])
 
     fm = pfile.FileManager.Instance()
-    fm.set_tag_manager(ptags.TagManager(mapping=mapping))
+    fm.clear()
+    fm.set_tag_manager(ptags.TagManager(mapping=mapping, parameters=config_options['custom_parameters']))
+    fm.set_spool_threshold(config_options['spool_threshold'])
+    fm.set_sharding(config_options['shard_by'], config_options['shard_size'])
+    if common:
+        fm.set_common_module(module_path(config_options, common.name), common.class_name)
+    fm.open(path, module, config_options['custom_parameters'])
+    if nodes is not None:
+        hiera.write(fm.sink, module.class_name, nodes)
+    downgraded = stats.counters.get('templates_downgraded', 0)
+
+    # Get file details, a batch at a time
+    fetcher = fetch.Fetcher(client, channel,
+                            batch_size=config_options['batch_size'],
+                            workers=config_options['fetch_workers'],
+                            retries=config_options['retries'],
+                            journal=batches)
+    try:
+        if full:
+            for file in fetcher.fetch(paths):
+                with stats.stage('add'):
+                    add_file_info(fm, file)
+        else:
+            # merge the unchanged files with the fetched ones, both ordered by path
+            records = [(file_path, True, cached['record']) for file_path, cached in sorted(cache.files.iteritems())
+                       if file_path in listing and file_path not in changed]
+            fetched = ((file['path'], False, file) for file in fetcher.fetch(paths))
+            for file_path, is_record, entry in heapq.merge(records, fetched):
+                with stats.stage('add'):
+                    if is_record:
+                        fm.add_record(entry)
+                    else:
+                        add_file_info(fm, entry)
+    finally:
+        fm.close()
+
+    downgraded = stats.counters.get('templates_downgraded', 0) - downgraded
+    if downgraded:
+        print "Downgraded %d templates to static files, all their macros map to nothing" % downgraded
+    if not full:
+        with stats.stage('state'):
+            fm.prune(path)
+    return fm
+
+
+def select_channels(options, client):
+    """
+    Returns the labels of the channels selected for a bulk conversion.
+
+    :param options: The command line options.
+    :type options: optparse.Values
+    """
+    if options.channels_from:
+        fh = open(options.channels_from, "r")
+        labels = [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+        fh.close()
+        return labels
+
+    channels = client.configchannel.listGlobals()
+    if options.org:
+        orgs = {}
+        selected = []
+        for channel in channels:
+            org_id = channel['orgId']
+            if org_id not in orgs:
+                orgs[org_id] = client.org.getDetails(org_id)['name']
+            if options.org in (str(org_id), orgs[org_id]):
+                selected.append(channel)
+        channels = selected
+    return [channel['label'] for channel in channels]
+
+
+# State shared with the bulk conversion worker processes.
+_bulk = {}
+
+
+def _init_bulk_worker(options, config_options, client, mapping, common, journal):
+    _bulk.update(options=options, config_options=config_options, client=client,
+                 mapping=mapping, common=common, journal=journal)
+    # the pooled connections are kept across the channels of the worker
+    multiprocessing.util.Finalize(None, client.close, exitpriority=10)
+
+
+def _convert_bulk_channel(channel):
+    """
+    Convert one channel inside a bulk worker process.
+
+    :return: (channel, module_name, seconds, error, saved, stats)
+    :rtype: tuple
+    """
+    began = time.time()
+    stats = Stats.Instance()
+    stats.reset()
+    try:
+        module_name, saved = convert_channel(_bulk['options'], _bulk['config_options'], _bulk['client'],
+                                             channel, _bulk['mapping'], _bulk['common'], _bulk['journal'])
+        return channel, module_name, time.time() - began, None, saved, stats.as_dict()
+    except (Exception, SystemExit), err:
+        return channel, None, time.time() - began, str(err) or err.__class__.__name__, 0, stats.as_dict()
 
-    for file in files:
-        print 'JSON for path %s:' % file['path']
-        print file
-
-        if file['type'] == 'file':
-
-            enc64 = False
-            if file.has_key('contents_enc64') and file['contents_enc64']:
-                contents = file['contents'].decode('base64')
-                macro_start = ''
-                macro_end = ''
-                enc64 = True
-            elif file.has_key('contents') and file['contents']:
-                contents = file['contents']
-                macro_start = file['macro-start-delimiter']
-                macro_end = file['macro-end-delimiter']
-
-            fm.add_file(name=file['path'].replace("/", "_"),
-                        path=file['path'],
-                        contents=contents,
-                        pmode=file['permissions_mode'],
-                        group=file['group'],
-                        owner=file['owner'],
-                        macro_start_delimiter=macro_start,
-                        macro_end_delimiter=macro_end,
-                        is_binary=enc64
-                        )
-
-        elif file['type'] == 'directory':
-            fm.add_directory(name=file['path'].replace("/", "_"),
-                             path=file['path'],
-                             pmode=file['permissions_mode'],
-                             group=file['group'],
-                             owner=file['owner'])
-
-        elif file['type'] == 'symlink':
-            fm.add_symlink(name=file['path'].replace("/", "_"),
-                           path=file['path'],
-                           target_path=file['target_path'])
-
-    fm.export(path, class_name, 'init', config_options['custom_parameters'])
-
-
-    # logout
-    spacewalk.auth.logout(spacekey)
+
+def prepare_common(options, config_options):
+    """
+    Create the shared module holding the file bodies of the converted
+    channels, when one is configured.
+
+    :return: Its skeleton, or None.
+    :rtype: skeleton.ModuleSkeleton
+    """
+    if not config_options['common_module']:
+        return None
+    common = skeleton.ModuleSkeleton(config_options['common_module'], config_options['server'],
+                                     summary='File contents shared by the configuration channel modules')
+    if options.plan and not options.apply:
+        # planned conversions only report the missing blobs
+        return common
+    # modules converted incrementally still use the blobs of earlier runs
+    path = module_path(config_options, common.name)
+    if options.full or not os.path.isdir(path):
+        utils.mkdir(config_options['output_dir'])
+        with utils.staging(path) as build:
+            common.write(build)
+    return common
+
+
+def watch_channels(options, config_options, client, mapping):
+    """
+    Keep converting the selected channels as they change, until stopped.
+    """
+    common = prepare_common(options, config_options)
+    stats = Stats.Instance()
+    converted = set()
+
+    def convert(channel):
+        unchanged = stats.counters.get('channels_unchanged', 0)
+        # --full only applies to the first conversion of each channel
+        channel_options = copy.copy(options)
+        channel_options.full = options.full and channel not in converted
+        convert_channel(channel_options, config_options, client, channel, mapping, common)
+        converted.add(channel)
+        return stats.counters.get('channels_unchanged', 0) == unchanged
+
+    def select():
+        if options.channel:
+            return [options.channel]
+        return select_channels(options, client)
+
+    watcher = watch.Watcher(convert, select, config_options['working_dir'], options.watch,
+                            cycles=options.cycles, status_port=options.status_port)
+    watcher.run()
+
+
+def convert_channels(options, config_options, client, channels, mapping, journal=None):
+    """
+    Convert several channels in parallel worker processes, all sharing the
+    same Spacewalk session.
+
+    :return: One (channel, module_name, seconds, error, saved, stats) tuple per channel.
+    :rtype: list
+    """
+    common = prepare_common(options, config_options)
+    workers = max(1, min(options.workers or config_options['bulk_workers'], len(channels)))
+    client.close()
+    pool = multiprocessing.Pool(workers, _init_bulk_worker,
+                                (options, config_options, client, mapping, common, journal))
+    try:
+        results = []
+        for result in pool.imap_unordered(_convert_bulk_channel, channels):
+            channel, module_name, seconds, error, saved, worker_stats = result
+            Stats.Instance().merge(worker_stats)
+            if error:
+                print "Channel %s failed after %.1fs: %s" % (channel, seconds, error)
+            else:
+                print "Channel %s converted to %s in %.1fs" % (channel, module_name, seconds)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    if options.package and common:
+        # shared bodies are written concurrently by the workers, so the common module is packed once they are done
+        archive = os.path.join(config_options['output_dir'], common.release_name() + '.tar.gz')
+        utils.mkdir(config_options['output_dir'])
+        sinks.pack(module_path(config_options, common.name), archive, common.release_name())
+        print "Common module packaged to %s" % archive
+    return sorted(results)
+
+
+def verify_modules(options, config_options, module_names, facts):
+    """
+    Verify the converted modules against the facts and print their errors.
+
+    :return: The number of errors found.
+    :rtype: int
+    """
+    modules = {}
+    if config_options['common_module']:
+        common = skeleton.ModuleSkeleton(config_options['common_module'], config_options['server'])
+        modules[common.class_name] = module_path(config_options, common.name)
+    errors = 0
+    for module_name in sorted(set(module_names)):
+        path = module_path(config_options, module_name)
+        modules[skeleton.ModuleSkeleton(module_name, config_options['server']).class_name] = path
+        report = verify.verify_module(path, modules, facts, options.jobs or config_options['jobs'])
+        print report.text()
+        errors += report.count()
+    return errors
+
+
+def print_summary(results):
+    """
+    Print the per-channel timing and failure summary of a bulk conversion.
+    """
+    width = max([len('CHANNEL')] + [len(r[0]) for r in results])
+    print
+    print "%-*s  %9s  %s" % (width, 'CHANNEL', 'SECONDS', 'RESULT')
+    for channel, module_name, seconds, error, saved, worker_stats in results:
+        print "%-*s  %9.1f  %s" % (width, channel, seconds, error and 'FAILED: %s' % error or module_name)
+    failed = len([r for r in results if r[3]])
+    print
+    print "%d channels converted, %d failed, %.1fs total, %d bytes saved by deduplication" % \
+          (len(results) - failed, failed, sum([r[2] for r in results]), sum([r[4] for r in results]))
+
+
+def run(options, config_options):
+    """
+    Convert the channels selected by the options.
+    """
+    stats = Stats.Instance()
+
+    # Read in Mapping Json
+    try:
+        mapping = ptags.load_mapping(options.mapping, os.path.join(config_options['working_dir'], state.STATE_DIR))
+    except (ptags.MappingError, IOError, OSError), err:
+        print "Could not load mapping %s: %s" % (options.mapping, err)
+        sys.exit(1)
+
+    facts = None
+    if options.verify:
+        try:
+            facts = verify.load_facts(options.verify)
+        except (ValueError, IOError), err:
+            print "Could not load facts %s: %s" % (options.verify, err)
+            sys.exit(1)
+
+    # Log in
+    if options.from_dump:
+        connector = dump.Replay(options.from_dump)
+    elif options.dump:
+        connector = dump.Recorder(fetch.api_url(config_options['server']), options.dump)
+    else:
+        connector = fetch.Connector(fetch.api_url(config_options['server']))
+    client = spacewalk.Client(connector, config_options['user'], config_options['password'],
+                              size=config_options['connections'])
+    with stats.stage('login'):
+        client.login()
+
+    # the progress of the run, to resume it if it is interrupted
+    progress = None
+    if not (options.watch or options.plan or options.apply):
+        progress = journal.Journal(config_options['working_dir'])
+        started = progress.start(resume=options.resume)
+        if started:
+            print "Resuming the run started %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))
+        elif options.resume:
+            print "No interrupted run to resume, starting a new one"
+
+    try:
+        converted = []
+        failed = False
+        if options.watch:
+            # one process keeps the session, the mapping and the channel states between polls
+            pfile.FileManager.Instance().set_jobs(options.jobs or config_options['jobs'])
+            watch_channels(options, config_options, client, mapping)
+        elif options.channel:
+            # bulk workers convert channels in parallel already
+            pfile.FileManager.Instance().set_jobs(options.jobs or config_options['jobs'])
+            try:
+                module_name, saved = convert_channel(options, config_options, client, options.channel, mapping,
+                                                     journal=progress)
+            except ConversionError, err:
+                print err
+                sys.exit(1)
+            converted.append(module_name)
+        else:
+            channels = select_channels(options, client)
+            results = convert_channels(options, config_options, client, channels, mapping, progress)
+            print_summary(results)
+            converted = [r[1] for r in results if r[1]]
+            failed = bool([r for r in results if r[3]])
+        if progress is not None and not failed:
+            progress.finish()
+        if facts is not None and verify_modules(options, config_options, converted, facts):
+            failed = True
+        if failed:
+            sys.exit(1)
+    finally:
+        # stop the substitution workers
+        pfile.FileManager.Instance().set_jobs(1)
+        # logout
+        client.logout()
+        client.close()
+
+
+def main():
+    """
+    The command entry point.
+    """
+
+    _dir = os.getcwd()
+    options, config_options = get_options()
+    logging.basicConfig(format='%(message)s', level=options.verbose and logging.DEBUG or logging.INFO)
+    utils.chdir(config_options['working_dir'])
+
+    stats = Stats.Instance()
+    try:
+        with stats.stage('total'):
+            if options.profile:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(run, options, config_options)
+                finally:
+                    profiler.dump_stats(os.path.join(_dir, options.profile))
+            else:
+                run(options, config_options)
+    finally:
+        if options.stats == 'json':
+            print stats.json()
+        elif options.stats == 'table':
+            print
+            print stats.table()
 
 ## MAIN
 if __name__ == "__main__":
     main()
-
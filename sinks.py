@@ -0,0 +1,252 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import cStringIO
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import utils
+from stats import Stats
+
+#
+# Constants
+#
+
+# Size of the buffer used for the manifests.
+MANIFEST_BUFFER = 1024 * 1024
+
+# Compression level of the module archives, gzip's default.
+COMPRESSION = 6
+
+
+def sink(target):
+    """
+    Returns the sink writing a module into target, a directory path or a sink.
+
+    """
+    if isinstance(target, basestring):
+        return DirectorySink(target)
+    return target
+
+
+class DirectorySink(object):
+    """
+    Writes the files of a module into its directory.  Names are relative
+    to the module root, i.e. 'manifests/init.pp'.
+    """
+
+    # bodies larger than the spool threshold are decoded to disk first
+    streams = False
+
+    def __init__(self, path):
+        self.path = path
+        self.spool_dir = os.path.join(path, 'files')
+
+    def mkdir(self, name):
+        utils.mkdir(os.path.join(self.path, name))
+
+    def purge(self, name, suffix):
+        """
+        Remove the files of the directory name ending with suffix.
+
+        """
+        directory = os.path.join(self.path, name)
+        for entry in os.listdir(directory):
+            if entry.endswith(suffix):
+                os.remove(os.path.join(directory, entry))
+
+    def open(self, name, append=False):
+        """
+        Returns a file object writing the file name, or appending to it.
+
+        """
+        return open(os.path.join(self.path, name), append and "ab" or "wb", MANIFEST_BUFFER)
+
+    def write(self, name, contents):
+        fpath = os.path.join(self.path, name)
+        if os.path.lexists(fpath):
+            # replaced, it may be a link to the file of the module in place
+            os.remove(fpath)
+        fh = open(fpath, "wb")
+        fh.write(contents)
+        fh.close()
+
+    def move(self, name, spool):
+        """
+        Move the file at spool to name.
+
+        """
+        shutil.move(spool, os.path.join(self.path, name))
+
+    def store(self, file, fpath):
+        """
+        Store the body of file outside of the module, at fpath.
+
+        """
+        file.store(fpath)
+
+    def stream(self, name, size, fileobj):
+        """
+        Write the `size` bytes read from fileobj to name.
+
+        """
+        fh = self.open(name)
+        try:
+            shutil.copyfileobj(fileobj, fh)
+        finally:
+            fh.close()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class Buffered(object):
+    """
+    A file buffered until its sink is closed, i.e. by a TarSink since the
+    size of an entry must precede its contents.
+    """
+
+    def __init__(self):
+        self.buffer = tempfile.SpooledTemporaryFile(MANIFEST_BUFFER)
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def close(self):
+        # reopened with append=True, see TarSink.close()
+        pass
+
+
+class TarSink(object):
+    """
+    Writes a module straight into a gzipped tar archive, in the layout of
+    `puppet module build`: every file under a <name>-<version> directory.
+    The archive is written next to path and only replaces it once closed.
+    """
+
+    # large bodies are decoded straight into the archive
+    streams = True
+    spool_dir = None
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.mtime = int(time.time())
+        self.members = {}
+        self.order = []
+        # the skeleton and the FileManager both create files/, manifests/ and templates/
+        self.directories = set()
+        fd, self.spool = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                          dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        self.tar = tarfile.open(self.spool, "w:gz", compresslevel=COMPRESSION)
+        self._add(tarfile.TarInfo(prefix), None, tarfile.DIRTYPE)
+
+    def _add(self, info, fileobj, type=tarfile.REGTYPE):
+        info.type = type
+        info.mtime = self.mtime
+        info.mode = type == tarfile.DIRTYPE and 0755 or 0644
+        info.uname = info.gname = 'root'
+        self.tar.addfile(info, fileobj)
+        if type == tarfile.REGTYPE:
+            Stats.Instance().add('bytes_archived', info.size)
+
+    def _info(self, name, size=0):
+        info = tarfile.TarInfo('%s/%s' % (self.prefix, name))
+        info.size = size
+        return info
+
+    def mkdir(self, name):
+        if name in self.directories:
+            return
+        self.directories.add(name)
+        self._add(self._info(name), None, tarfile.DIRTYPE)
+
+    def purge(self, name, suffix):
+        # an archive starts empty
+        pass
+
+    def open(self, name, append=False):
+        if name not in self.order:
+            self.order.append(name)
+        if name not in self.members or not append:
+            self.members[name] = Buffered()
+        return self.members[name]
+
+    def write(self, name, contents):
+        self.stream(name, len(contents), cStringIO.StringIO(contents))
+
+    def move(self, name, spool):
+        fh = open(spool, "rb")
+        try:
+            self.stream(name, os.fstat(fh.fileno()).st_size, fh)
+        finally:
+            fh.close()
+        os.remove(spool)
+
+    def stream(self, name, size, fileobj):
+        self._add(self._info(name, size), fileobj)
+
+    def store(self, file, fpath):
+        file.store(fpath)
+
+    def close(self):
+        """
+        Add the buffered files and put the archive in place.
+
+        """
+        for name in self.order:
+            buffer = self.members[name].buffer
+            size = buffer.tell()
+            buffer.seek(0)
+            self.stream(name, size, buffer)
+            buffer.close()
+        self.members = {}
+        self.tar.close()
+        os.chmod(self.spool, 0644)
+        os.rename(self.spool, self.path)
+
+    def abort(self):
+        """
+        Drop the archive.
+
+        """
+        self.tar.close()
+        os.remove(self.spool)
+
+
+def pack(path, target, prefix):
+    """
+    Write the module in the directory at path as an archive at target.
+
+    """
+    archive = TarSink(target, prefix)
+    try:
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(directories):
+                archive.mkdir(os.path.relpath(os.path.join(root, name), path))
+            for name in sorted(files):
+                fpath = os.path.join(root, name)
+                fh = open(fpath, "rb")
+                try:
+                    archive.stream(os.path.relpath(fpath, path), os.fstat(fh.fileno()).st_size, fh)
+                finally:
+                    fh.close()
+    except:
+        archive.abort()
+        raise
+    archive.close()
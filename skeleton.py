@@ -0,0 +1,170 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import sinks
+
+#
+# Constants
+#
+
+VERSION = '0.1.0'
+AUTHOR = 'Red Hat'
+LICENSE = 'GPLv2'
+
+DIRECTORIES = ['files', 'manifests', 'templates', 'tests']
+
+README = """# %(name)s
+
+#### Table of Contents
+
+1. [Overview](#overview)
+2. [Usage](#usage)
+
+## Overview
+
+%(summary)s
+
+## Usage
+
+    include %(class_name)s
+"""
+
+MANIFEST_HEADER = """# == Class: %(class_name)s
+#
+# %(summary)s
+#
+# Generated by puppetize from %(source)s.
+#
+"""
+
+SHARD_HEADER = """# == Class: %(class_name)s::%(shard)s
+#
+# The resources of %(class_name)s %(description)s.
+#
+"""
+
+TEST = """include %(class_name)s
+"""
+
+
+class ModuleSkeleton(object):
+    """
+    Writes the skeleton of a Puppet module, the layout `puppet module generate`
+    would produce, without running puppet.
+    """
+
+    def __init__(self, name, source, version=VERSION, author=AUTHOR, license=LICENSE, summary=None,
+                 dependencies=None):
+        """
+        :param dependencies: The modules the module uses, each a
+                             (name, version) pair, i.e. the common module.
+        :type dependencies: list
+        """
+        self.name = name
+        self.class_name = name.split('-', 1)[-1]
+        self.source = source
+        self.version = version
+        self.author = author
+        self.license = license
+        self.summary = summary or 'Module created from org-cfgchannel %s' % name
+        self.dependencies = dependencies or []
+
+    def _values(self):
+        return {'name': self.name, 'class_name': self.class_name,
+                'summary': self.summary, 'source': self.source}
+
+    def release_name(self):
+        """
+        Returns the name of the module release, <name>-<version>, which
+        names its archive and the directory holding the module inside it.
+
+        """
+        return '%s-%s' % (self.name, self.version)
+
+    def metadata(self):
+        """
+        Returns the contents of metadata.json.
+
+        """
+        fields = [('name', self.name),
+                  ('version', self.version),
+                  ('author', self.author),
+                  ('summary', self.summary),
+                  ('license', self.license),
+                  ('source', self.source),
+                  ('project_page', self.source),
+                  ('issues_url', self.source),
+                  ('dependencies', [{'name': name, 'version_requirement': '>= %s' % version}
+                                    for name, version in self.dependencies])]
+        lines = ['  %s: %s' % (json.dumps(key), json.dumps(value, sort_keys=True)) for key, value in fields]
+        return '{\n' + ',\n'.join(lines) + '\n}\n'
+
+    def manifest_header(self, parameters=None):
+        """
+        Returns the class manifest up to its first resource.
+
+        :param parameters: The class parameters.
+        :type parameters: list
+        """
+        header = MANIFEST_HEADER % self._values()
+        if parameters:
+            return header + "class %s (\n%s)\n{\n\n" % (self.class_name,
+                                                        ''.join("%s,\n" % p for p in parameters))
+        return header + "class %s {\n\n" % self.class_name
+
+    def shard_header(self, shard, parameters=None, description=None):
+        """
+        Returns the manifest of the subclass shard of the module class up
+        to its first resource.  The subclass takes the class parameters,
+        defaulting to the values of the module class.
+
+        :param description: What the subclass holds, i.e. 'under /etc/httpd'.
+        :type description: str
+        """
+        values = dict(self._values(), shard=shard, description=description or 'in %s' % shard)
+        header = SHARD_HEADER % values
+        name = '%s::%s' % (self.class_name, shard)
+        if parameters:
+            names = [p.split('=', 1)[0].strip() for p in parameters]
+            forwarded = ''.join("%s = $%s::%s,\n" % (n, self.class_name, n.lstrip('$')) for n in names)
+            return header + "class %s (\n%s)\n{\n\n" % (name, forwarded)
+        return header + "class %s {\n\n" % name
+
+    def contain(self, shards):
+        """
+        Returns the statements of the module class containing its subclasses.
+
+        """
+        return ''.join("contain %s::%s\n" % (self.class_name, shard) for shard in shards)
+
+    def manifest_footer(self):
+        """
+        Returns the end of the class manifest.
+
+        """
+        return "}\n"
+
+    def write(self, path):
+        """
+        Create the module directory layout and its static files.
+
+        :param path: The module root directory, or the sink writing the module.
+        :type path: str
+        """
+        sink = sinks.sink(path)
+        for directory in DIRECTORIES:
+            sink.mkdir(directory)
+        values = self._values()
+        for name, contents in [('metadata.json', self.metadata()),
+                               ('README.md', README % values),
+                               ('tests/init.pp', TEST % values)]:
+            sink.write(name, contents)
@@ -0,0 +1,193 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+#
+# Imports
+#
+
+import os
+import threading
+import xmlrpclib
+import Queue
+from multiprocessing.pool import ThreadPool
+
+#
+# Constants
+#
+
+# Number of persistent connections kept open, and of calls run at once by call_async().
+POOL_SIZE = 4
+
+# The API namespaces reachable as client attributes, i.e. client.configchannel.listFiles(label).
+NAMESPACES = ['configchannel', 'org', 'system']
+
+
+def session_expired(fault):
+    """
+    Returns whether a fault means the session key is no longer valid.
+
+    :param fault: A fault raised by a Spacewalk call.
+    :type fault: xmlrpclib.Fault
+    """
+    return 'session' in str(fault.faultString).lower()
+
+
+class Client(object):
+    """
+    A Spacewalk API client that keeps a pool of persistent connections,
+    passes the session key to every call and logs in again when the
+    session expires.  It is thread-safe, and call_async()/imap() run
+    several calls at once.
+    """
+
+    def __init__(self, connector, user, password, size=POOL_SIZE):
+        self.connector = connector
+        self.user = user
+        self.password = password
+        self.size = size
+        self.key = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.Queue()
+        self._threads = None
+
+    def _check_fork(self):
+        # connections and threads are not shared with a forked process
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _acquire(self):
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return self.connector.server()
+
+    def _release(self, server):
+        if self._idle.qsize() < self.size:
+            self._idle.put(server)
+        else:
+            self.connector.release(server)
+
+    def _invoke(self, method, args):
+        server = self._acquire()
+        try:
+            function = server
+            for part in method.split('.'):
+                function = getattr(function, part)
+            result = function(*args)
+        except xmlrpclib.Fault:
+            # the connection is still good
+            self._release(server)
+            raise
+        except:
+            self.connector.release(server)
+            raise
+        self._release(server)
+        return result
+
+    def login(self):
+        """
+        Log in and keep the session key for the following calls.
+
+        """
+        self.key = self._invoke('auth.login', (self.user, self.password))
+        return self.key
+
+    def logout(self):
+        if self.key is not None:
+            self._invoke('auth.logout', (self.key,))
+            self.key = None
+
+    def _relogin(self, expired_key):
+        self._lock.acquire()
+        try:
+            # another thread may have logged in again already
+            if self.key == expired_key:
+                self.login()
+        finally:
+            self._lock.release()
+
+    def call(self, method, *args):
+        """
+        Call an API method, i.e. 'configchannel.listFiles', with the session
+        key followed by args.
+        """
+        key = self.key
+        try:
+            return self._invoke(method, (key,) + args)
+        except xmlrpclib.Fault, fault:
+            if not session_expired(fault):
+                raise
+        self._relogin(key)
+        return self._invoke(method, (self.key,) + args)
+
+    def _pool(self):
+        self._check_fork()
+        if self._threads is None:
+            self._threads = ThreadPool(self.size)
+        return self._threads
+
+    def call_async(self, method, *args):
+        """
+        Start a call in the background.
+
+        :return: The pending result, see AsyncResult.get().
+        :rtype: multiprocessing.pool.AsyncResult
+        """
+        return self._pool().apply_async(self.call, (method,) + args)
+
+    def imap(self, method, arglists):
+        """
+        Call method once for each tuple of args in arglists, up to size
+        calls at a time, and yield the results in order.
+        """
+        call = lambda args: self.call(method, *args)
+        return self._pool().imap(call, arglists)
+
+    def close(self):
+        """
+        Close the pooled connections and release the connector.
+
+        """
+        self._check_fork()
+        while True:
+            try:
+                self.connector.release(self._idle.get_nowait())
+            except Queue.Empty:
+                break
+        if self._threads is not None:
+            self._threads.close()
+            self._threads.join()
+            self._threads = None
+        self.connector.close()
+
+    def __getattr__(self, name):
+        if name in NAMESPACES:
+            return Namespace(self, name)
+        raise AttributeError(name)
+
+
+class Namespace(object):
+    """
+    The methods of an API namespace, called through a Client.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, name):
+        method = '%s.%s' % (self._name, name)
+        return lambda *args: self._client.call(method, *args)
@@ -0,0 +1,150 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import os
+import pfile
+import utils
+
+#
+# Constants
+#
+
+STATE_DIR = '.puppetize'
+
+# The states loaded by this process, by path, with the size and mtime of
+# their file, so that a long running process does not parse them again.
+LOADED = {}
+
+
+def stamp(entry):
+    """
+    Returns the value identifying a revision of a listFiles entry, when
+    it was last modified.
+
+    :param entry: The file entry returned by configchannel.listFiles.
+    :type entry: dict
+    """
+    return str(entry.get('last_modified', ''))
+
+
+def signature(path):
+    """
+    Returns the size and mtime of the file at path, None if there is none.
+
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_size, info.st_mtime
+
+
+class ChannelState(object):
+    """
+    The state of the last conversion of a configuration channel, kept in the
+    working directory so that unchanged files need not be fetched again.
+    """
+
+    def __init__(self, path, channel):
+        self.path = path
+        self.channel = channel
+        self.module_name = None
+        self.settings = None
+        self.files = {}
+        # the digest of the Hiera data of the nodes, if any
+        self.nodes = None
+
+    @classmethod
+    def load(cls, working_dir, channel):
+        """
+        Returns the state of channel, empty if it was never converted.
+
+        """
+        path = os.path.join(working_dir, STATE_DIR, '%s.json' % channel)
+        if path in LOADED and LOADED[path][0] == signature(path):
+            return LOADED[path][1]
+        state = cls(path, channel)
+        if os.path.exists(path):
+            fh = open(path, "r")
+            try:
+                data = json.load(fh)
+            finally:
+                fh.close()
+            state.module_name = data['module_name']
+            state.settings = data['settings']
+            state.files = data['files']
+            state.nodes = data.get('nodes')
+            LOADED[path] = (signature(path), state)
+        return state
+
+    def save(self):
+        utils.mkdir(os.path.dirname(self.path))
+        utils.atomic_write(self.path, json.dumps({'channel': self.channel, 'module_name': self.module_name,
+                                                  'settings': self.settings, 'files': self.files,
+                                                  'nodes': self.nodes}))
+        LOADED[self.path] = (signature(self.path), self)
+
+    def matches(self, module_name, settings):
+        """
+        Returns whether the last conversion produced module_name with the same settings.
+
+        """
+        return self.module_name == module_name and self.settings == settings
+
+    def changes(self, listing):
+        """
+        Compare the channel listing with the last conversion.
+
+        :param listing: The listFiles entries, keyed by path.
+        :type listing: dict
+
+        :return: The paths to fetch again and the paths removed from the channel.
+        :rtype: tuple
+        """
+        changed = set()
+        for path, entry in listing.iteritems():
+            cached = self.files.get(path)
+            if cached is None or cached['stamp'] != stamp(entry):
+                changed.add(path)
+        removed = set(self.files) - set(listing)
+
+        # a body written under the name of a changed or removed file may be
+        # shared by unchanged files, those have to be written again too.
+        stale = set()
+        for path in changed | removed:
+            cached = self.files.get(path)
+            if cached and not cached['record']['source_module']:
+                file = pfile.File.from_record(cached['record'])
+                stale.add((file.type, file.source_name()))
+        for path, cached in self.files.iteritems():
+            record = cached['record']
+            if path in listing and record['source'] and not record['source_module'] \
+                    and (record['type'], record['source']) in stale:
+                changed.add(path)
+        return changed, removed
+
+    def update(self, module_name, settings, listing, files, nodes=None):
+        """
+        Record the result of a conversion.
+
+        :param files: The Files of the module.
+        :type files: list
+
+        :param nodes: The digest of the Hiera data of the nodes, see hiera.digest().
+        :type nodes: str
+        """
+        self.module_name = module_name
+        self.settings = settings
+        self.nodes = nodes
+        self.files = {}
+        for file in files:
+            self.files[file.path] = {'stamp': stamp(listing.get(file.path, {})), 'record': file.record()}
@@ -0,0 +1,102 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from utils import Singleton
+
+
+def cpu_time():
+    """
+    Returns the user and system CPU time used by the process so far.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+@Singleton
+class Stats(object):
+    """
+    Collects the time spent in each stage of a conversion and counters
+    such as the number of files written or macros substituted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as (part of) the named stage.  The CPU time is
+        that of the whole process, including other threads, while in the stage.
+        """
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - wall, cpu_time() - cpu)
+
+    def add_time(self, name, wall, cpu, calls=1):
+        self._lock.acquire()
+        try:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['calls'] += calls
+        finally:
+            self._lock.release()
+
+    def add(self, name, value=1):
+        """
+        Add value to the named counter.
+        """
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def as_dict(self):
+        return {'stages': self.stages, 'counters': self.counters}
+
+    def merge(self, other):
+        """
+        Add the stages and counters of another as_dict(), i.e. from a worker process.
+        """
+        for name, stage in other['stages'].iteritems():
+            self.add_time(name, stage['wall'], stage['cpu'], stage['calls'])
+        for name, value in other['counters'].iteritems():
+            self.add(name, value)
+
+    def json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def table(self):
+        """
+        Returns the stages and counters as a summary table.
+        """
+        lines = ['%-24s %10s %10s %8s' % ('STAGE', 'WALL (s)', 'CPU (s)', 'CALLS')]
+        for name, stage in sorted(self.stages.iteritems(), key=lambda item: -item[1]['wall']):
+            lines.append('%-24s %10.3f %10.3f %8d' % (name, stage['wall'], stage['cpu'], stage['calls']))
+        if self.counters:
+            lines.append('')
+            lines.append('%-24s %10s' % ('COUNTER', 'VALUE'))
+            for name, value in sorted(self.counters.iteritems()):
+                lines.append('%-24s %10d' % (name, value))
+        return '\n'.join(lines)
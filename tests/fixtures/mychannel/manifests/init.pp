@@ -0,0 +1,37 @@
+# == Class: mychannel
+#
+# Module created from org-cfgchannel myorg-mychannel
+#
+# Generated by puppetize from https://spacewalk.example.com.
+#
+class mychannel {
+
+File {
+  owner => 'root',
+  group => 'root',
+  mode => '755',
+}
+
+file { [
+  '/etc/myapp',
+  '/etc/myapp/conf.d',
+]:
+  ensure => 'directory',
+}
+
+file { '/etc/myapp/private':
+  owner => 'myapp',
+  ensure => 'directory',
+  mode => '700',
+}
+
+file { '_etc_myapp_current':
+  path => '/etc/myapp/current',
+  target => '/etc/myapp/conf.d',
+  ensure => 'link',
+  owner => undef,
+  group => undef,
+  mode => undef,
+}
+
+}
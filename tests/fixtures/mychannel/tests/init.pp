@@ -0,0 +1 @@
+include mychannel
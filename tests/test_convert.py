@@ -0,0 +1,282 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import os
+import sqlite3
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import xmlrpclib
+from StringIO import StringIO
+import fetch
+import journal
+import mockserver
+import pfile
+import puppetize
+import state
+from stats import Stats
+
+#
+# Constants
+#
+
+CONFIG = """[Spacewalk]
+server = %(url)s
+user = admin
+password = secret
+[Puppet]
+working_dir = %(working_dir)s
+output_dir = %(output_dir)s
+mapping = %(mapping)s
+"""
+
+MAPPING = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'mapping.json')
+
+
+class ConversionTest(unittest.TestCase):
+    """
+    Converts the synthetic channels served by mockserver.py the ways that
+    must all produce the same modules.
+    """
+
+    def setUp(self):
+        self.files = mockserver.synthetic_channel(30, 300, 0.1, symlink_ratio=0.1)
+        self.server = mockserver.MockSpacewalk(files=self.files).start()
+        self.root = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.working_dir = os.path.join(self.root, 'work')
+        self.output_dir = os.path.join(self.root, 'modules')
+        os.mkdir(self.working_dir)
+        self.config = os.path.join(self.root, 'puppetize.conf')
+        fh = open(self.config, "w")
+        try:
+            fh.write(CONFIG % {'url': self.server.url, 'working_dir': self.working_dir,
+                               'output_dir': self.output_dir, 'mapping': MAPPING})
+        finally:
+            fh.close()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        self.server.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, True)
+
+    def convert(self, *args):
+        """
+        Run puppetize with args, its output discarded.
+
+        :return: The exit status.
+        :rtype: int
+        """
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv = ['puppetize.py', '-f', self.config] + list(args)
+        sys.stdout = StringIO()
+        try:
+            puppetize.main()
+            return 0
+        except SystemExit, err:
+            return err.code
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+            os.chdir(self.cwd)
+
+    def clear(self):
+        """
+        Remove the modules and the state of the earlier conversions.
+
+        """
+        shutil.rmtree(self.working_dir, True)
+        shutil.rmtree(self.output_dir, True)
+        os.mkdir(self.working_dir)
+
+    def modules(self):
+        """
+        Returns the sha1 of every file of the converted modules, by path.
+
+        """
+        tree = {}
+        for root, dirs, files in os.walk(self.output_dir):
+            if state.STATE_DIR in dirs:
+                dirs.remove(state.STATE_DIR)
+            for name in files:
+                fpath = os.path.join(root, name)
+                fh = open(fpath, "rb")
+                try:
+                    tree[os.path.relpath(fpath, self.output_dir)] = hashlib.sha1(fh.read()).hexdigest()
+                finally:
+                    fh.close()
+        return tree
+
+    def change_channel(self):
+        """
+        Change a file of the channel, remove one and add another.
+
+        """
+        self.files['/etc/synthetic0/file0.conf'] = dict(self.files['/etc/synthetic0/file0.conf'],
+                                                        contents='changed\n', permissions_mode='600',
+                                                        modified=xmlrpclib.DateTime('20141002T00:00:00'))
+        del self.files['/etc/synthetic0/file5.conf']
+        self.files['/etc/synthetic0/new.conf'] = dict(self.files['/etc/synthetic0/file1.conf'],
+                                                      path='/etc/synthetic0/new.conf')
+
+    def test_incremental(self):
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        self.change_channel()
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        incremental = self.modules()
+        self.assertTrue('mockorg-synthetic/manifests/init.pp' in incremental)
+        self.assertEqual(self.convert('-c', 'synthetic', '--full'), 0)
+        self.assertEqual(incremental, self.modules())
+
+    def test_modified(self):
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        lookups = self.server.calls['configchannel.lookupFileInfo']
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        self.assertEqual(self.server.calls['configchannel.lookupFileInfo'], lookups)
+        self.files['/etc/synthetic1/file12.conf'] = dict(self.files['/etc/synthetic1/file12.conf'],
+                                                         contents='changed\n',
+                                                         modified=xmlrpclib.DateTime('20141002T00:00:00'))
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        self.assertEqual(self.server.calls['configchannel.lookupFileInfo'], lookups + 1)
+        fh = open(os.path.join(self.output_dir, 'mockorg-synthetic', 'files', '_etc_synthetic1_file12.conf'), "rb")
+        try:
+            self.assertEqual(fh.read(), 'changed\n')
+        finally:
+            fh.close()
+
+    def test_unchanged(self):
+        db = os.path.join(self.working_dir, state.STATE_DIR, journal.JOURNAL)
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        self.assertEqual(sqlite3.connect(db).execute('SELECT module FROM channels').fetchall(),
+                         [('mockorg-synthetic',)])
+        # an unchanged channel is skipped without being journaled
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        self.assertEqual(sqlite3.connect(db).execute('SELECT module FROM channels').fetchall(), [])
+        self.assertEqual(sqlite3.connect(db).execute('SELECT COUNT(*) FROM batches').fetchall(), [(0,)])
+
+    def test_jobs(self):
+        self.files.clear()
+        self.files.update(mockserver.synthetic_channel(200, 1000, 0.1))
+        self.assertEqual(self.convert('-c', 'synthetic', '-j', '1'), 0)
+        single = self.modules()
+        self.assertTrue('mockorg-synthetic/manifests/init.pp' in single)
+        self.clear()
+        pending_bytes = pfile.PENDING_BYTES
+        # substitute while the details are still being fetched
+        pfile.PENDING_BYTES = 4096
+        try:
+            self.assertEqual(self.convert('-c', 'synthetic', '-j', '4'), 0)
+        finally:
+            pfile.PENDING_BYTES = pending_bytes
+        self.assertEqual(single, self.modules())
+
+    def test_from_dump(self):
+        self.server.add_channel('other', mockserver.synthetic_channel(20, 300, 0.2, seed=3))
+        dump = os.path.join(self.root, 'dump')
+        self.assertEqual(self.convert('--all-channels', '--dump', dump), 0)
+        live = self.modules()
+        self.server.stop()
+        self.clear()
+        self.assertEqual(self.convert('--all-channels', '--from-dump', dump), 0)
+        self.assertEqual(live, self.modules())
+        self.assertEqual(len([name for name in live if name.endswith('init.pp')]), 4)
+
+    def test_package(self):
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        converted = dict((name.split('/', 1)[1], sha) for name, sha in self.modules().iteritems())
+        self.clear()
+        self.assertEqual(self.convert('-c', 'synthetic', '--package'), 0)
+        archives = os.listdir(self.output_dir)
+        self.assertEqual(len(archives), 1)
+        tar = tarfile.open(os.path.join(self.output_dir, archives[0]), "r:gz")
+        try:
+            members = tar.getmembers()
+            names = [info.name for info in members]
+            # every directory is added once, though the skeleton and the files both create them
+            self.assertEqual(len(names), len(set(names)))
+            packaged = dict((info.name.split('/', 1)[1], hashlib.sha1(tar.extractfile(info).read()).hexdigest())
+                            for info in members if info.isfile())
+        finally:
+            tar.close()
+        self.assertTrue(names[0] + '/files' in names)
+        self.assertEqual(converted, packaged)
+
+    def test_hiera(self):
+        self.files['/etc/synthetic0/file1.conf'] = dict(self.files['/etc/synthetic0/file1.conf'],
+                                                        contents='serial = {| rhn.system.sid |}\n')
+        self.assertEqual(self.convert('-c', 'synthetic', '--hiera'), 0)
+        module = os.path.join(self.output_dir, 'mockorg-synthetic')
+        nodes = os.path.join(module, 'data', 'nodes')
+        self.assertEqual(len(os.listdir(nodes)), 10)
+        fh = open(os.path.join(nodes, 'host0.example.com.yaml'), "r")
+        try:
+            self.assertTrue('synthetic::sid: "1000010000"\n' in fh.read())
+        finally:
+            fh.close()
+        fh = open(os.path.join(module, 'manifests', 'init.pp'), "r")
+        try:
+            init = fh.read()
+            self.assertTrue('class synthetic (\n' in init)
+            self.assertTrue('$sid = undef,\n' in init)
+        finally:
+            fh.close()
+        # the macro resolved to nothing stands for the class parameter set by the node data
+        fh = open(os.path.join(module, 'templates', '_etc_synthetic0_file1.conf.erb'), "r")
+        try:
+            self.assertEqual(fh.read(), 'serial = <%=  @sid  %>\n')
+        finally:
+            fh.close()
+
+    def test_resume(self):
+        self.server.add_channel('other', mockserver.synthetic_channel(20, 300, 0.2, seed=3))
+        good = self.files['/etc/synthetic2/file29.conf']['contents']
+        # xmlrpclib cannot marshal it, the lookup fails with a Fault
+        self.files['/etc/synthetic2/file29.conf']['contents'] = set()
+        retries = fetch.RETRIES
+        fetch.RETRIES = 0
+        try:
+            self.assertNotEqual(self.convert('--all-channels', '-w', '1'), 0)
+        finally:
+            fetch.RETRIES = retries
+        self.files['/etc/synthetic2/file29.conf']['contents'] = good
+        stats = Stats.Instance()
+        resumed = stats.counters.get('channels_resumed', 0)
+        self.assertEqual(self.convert('--all-channels', '-w', '1', '--resume'), 0)
+        # only the failed channel is converted again
+        self.assertEqual(stats.counters.get('channels_resumed', 0), resumed + 1)
+        converted = self.modules()
+        self.assertTrue('mockorg-other/manifests/init.pp' in converted)
+        self.assertTrue('mockorg-synthetic/manifests/init.pp' in converted)
+        # the run is over, there is nothing left to resume
+        self.assertEqual(self.convert('--all-channels', '-w', '1', '--resume'), 0)
+        self.assertEqual(stats.counters.get('channels_resumed', 0), resumed + 1)
+        self.clear()
+        self.assertEqual(self.convert('--all-channels', '-w', '1'), 0)
+        self.assertEqual(converted, self.modules())
+
+    def test_apply(self):
+        self.assertEqual(self.convert('-c', 'synthetic'), 0)
+        converted = self.modules()
+        self.assertTrue('mockorg-synthetic/manifests/init.pp' in converted)
+        self.change_channel()
+        self.assertEqual(self.convert('-c', 'synthetic', '--plan'), 0)
+        self.assertEqual(converted, self.modules())
+        self.assertEqual(self.convert('-c', 'synthetic', '--apply'), 0)
+        applied = self.modules()
+        self.assertNotEqual(converted, applied)
+        self.assertEqual(self.convert('-c', 'synthetic', '--full'), 0)
+        self.assertEqual(applied, self.modules())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import socket
+import sys
+import threading
+import unittest
+import xmlrpclib
+from StringIO import StringIO
+import fetch
+
+
+class FakeChannels(object):
+    """
+    Stands in for client.configchannel: looks up one detail per path,
+    after the errors queued in `errors`.
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def lookupFileInfo(self, channel, paths):
+        self._lock.acquire()
+        try:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.batches.append(paths)
+        finally:
+            self._lock.release()
+        return [{'path': path} for path in paths]
+
+
+class FakeClient(object):
+
+    def __init__(self, errors=()):
+        self.configchannel = FakeChannels(errors)
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_batches(self):
+        self.assertEqual(fetch.batches(['a', 'b', 'c', 'd', 'e'], 2), [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(fetch.batches(['a'], 0), [['a']])
+        self.assertEqual(fetch.batches([], 10), [])
+
+    def test_order(self):
+        client = FakeClient()
+        paths = ['/etc/file%d' % i for i in range(95)]
+        fetcher = fetch.Fetcher(client, 'channel', batch_size=10, workers=4)
+        self.assertEqual([file['path'] for file in fetcher.fetch(paths)], paths)
+        self.assertEqual(len(client.configchannel.batches), 10)
+
+    def test_batches_ahead(self):
+        client = FakeClient()
+        fetcher = fetch.Fetcher(client, 'channel', batch_size=1, workers=2)
+        paths = ['/etc/file%d' % i for i in range(40)]
+        consumed = 0
+        for file in fetcher.fetch(paths):
+            consumed += 1
+            # the workers would otherwise look up the whole channel meanwhile
+            threading.Event().wait(0.01)
+            self.assertTrue(len(client.configchannel.batches) <= consumed + 4,
+                            '%d batches looked up, %d consumed' % (len(client.configchannel.batches), consumed))
+        self.assertEqual(consumed, 40)
+
+    def test_retry(self):
+        errors = [socket.error(104, 'Connection reset by peer'),
+                  xmlrpclib.ProtocolError('localhost', 502, 'Bad Gateway', {}),
+                  xmlrpclib.Fault(-1, 'Internal error')]
+        client = FakeClient(errors)
+        fetcher = fetch.Fetcher(client, 'channel', retries=3, backoff=0)
+        self.assertEqual(fetcher.lookup(['/etc/motd']), [{'path': '/etc/motd'}])
+        self.assertEqual(client.configchannel.batches, [['/etc/motd']])
+
+    def test_retries_exhausted(self):
+        client = FakeClient([socket.error(104, 'Connection reset by peer')] * 3)
+        fetcher = fetch.Fetcher(client, 'channel', retries=2, backoff=0)
+        self.assertRaises(socket.error, fetcher.lookup, ['/etc/motd'])
+        self.assertEqual(client.configchannel.batches, [])
+
+    def test_unexpected_error(self):
+        client = FakeClient([ValueError('not retried')])
+        fetcher = fetch.Fetcher(client, 'channel', retries=3, backoff=0)
+        self.assertRaises(ValueError, fetcher.lookup, ['/etc/motd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+import fetch
+import hiera
+import mockserver
+import ptags
+import sinks
+import spacewalk
+
+#
+# Constants
+#
+
+# Two system profiles as Systems.fetch() returns them.
+WEB = {'details': {'id': u'1000010000', 'profile_name': u'web1', 'description': u'Web server'},
+       'network': {'ip': u'10.0.0.1', 'hostname': u'web1.example.com'},
+       'custom': {'rack': u'r1'},
+       'devices': [{'interface': u'eth0', 'ip': u'10.0.0.1', 'netmask': u'255.255.0.0',
+                    'broadcast': u'10.0.255.255', 'module': u'virtio_net'}]}
+DB = {'details': {'id': u'1000010001', 'profile_name': u'db 1'},
+      'network': {'ip': u'10.0.0.2'},
+      'custom': {},
+      'devices': [{'interface': u'eth1', 'ip': u'10.0.0.2', 'module': u'e1000'}]}
+
+
+def read(path):
+    fh = open(path, "r")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+class NodeDataTest(unittest.TestCase):
+
+    def test_node_name(self):
+        self.assertEqual(hiera.node_name(WEB), 'web1.example.com')
+        # without a hostname, the profile name
+        self.assertEqual(hiera.node_name(DB), 'db_1')
+
+    def test_node_data(self):
+        names, nodes = hiera.node_data(ptags.CompiledMapping(ptags.MAPPING), [WEB, DB])
+        # only the macros mapped to nothing, that Facter has no fact for
+        self.assertEqual(names, ['broadcast_eth0', 'custom_info_rack', 'description', 'driver_module_eth0',
+                                 'driver_module_eth1', 'profile_name', 'sid'])
+        self.assertEqual(nodes, {
+            'web1.example.com': {'sid': '1000010000', 'profile_name': 'web1', 'description': 'Web server',
+                                 'custom_info_rack': 'r1', 'broadcast_eth0': '10.0.255.255',
+                                 'driver_module_eth0': 'virtio_net'},
+            'db_1': {'sid': '1000010001', 'profile_name': 'db 1', 'driver_module_eth1': 'e1000'}})
+
+    def test_mapped(self):
+        mapping = ptags.CompiledMapping({'mapping': {'rhn.system.sid': '@serial',
+                                                     'rhn.system.description': ''}})
+        self.assertEqual(hiera.node_data(mapping, [WEB]),
+                         (['description'], {'web1.example.com': {'description': 'Web server'}}))
+
+    def test_parameters(self):
+        self.assertEqual(hiera.parameters(['$sid', '$site = "lab"'], ['description', 'sid']),
+                         ['$sid', '$site = "lab"', '$description = undef'])
+        self.assertEqual(hiera.parameters(None, ['sid']), ['$sid = undef'])
+
+    def test_render_node(self):
+        self.assertEqual(hiera.render_node('mychannel', {'sid': u'1000010000', 'description': u'The "web" server'}),
+                         '---\n'
+                         'mychannel::description: "The \\"web\\" server"\n'
+                         'mychannel::sid: "1000010000"\n')
+
+    def test_digest(self):
+        self.assertEqual(hiera.digest(None), None)
+        self.assertEqual(hiera.digest({'a': {'sid': '1'}, 'b': {}}), hiera.digest({'b': {}, 'a': {'sid': '1'}}))
+        self.assertNotEqual(hiera.digest({'a': {'sid': '1'}}), hiera.digest({'a': {'sid': '2'}}))
+        self.assertNotEqual(hiera.digest({}), None)
+
+    def test_write(self):
+        path = tempfile.mkdtemp(prefix='puppetize-test-')
+        try:
+            stale = os.path.join(path, hiera.NODES_DIR, 'gone.example.com.yaml')
+            os.makedirs(os.path.dirname(stale))
+            open(stale, "w").close()
+            hiera.write(sinks.DirectorySink(path), 'mychannel', {'web1.example.com': {'sid': '1000010000'}})
+            self.assertEqual(read(os.path.join(path, 'hiera.yaml')), hiera.HIERA_CONFIG)
+            self.assertEqual(os.listdir(os.path.join(path, hiera.NODES_DIR)), ['web1.example.com.yaml'])
+            self.assertEqual(read(os.path.join(path, hiera.NODES_DIR, 'web1.example.com.yaml')),
+                             '---\nmychannel::sid: "1000010000"\n')
+        finally:
+            shutil.rmtree(path, True)
+
+
+class SystemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.server = mockserver.MockSpacewalk(systems=mockserver.synthetic_systems(3)).start()
+        self.client = spacewalk.Client(fetch.Connector(self.server.url), 'admin', 'secret')
+        self.client.login()
+        self.working_dir = tempfile.mkdtemp(prefix='puppetize-test-')
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.working_dir, True)
+
+    def test_fetch(self):
+        systems = hiera.Systems(self.client, self.working_dir, batch_size=2).fetch('synthetic')
+        self.assertEqual([system['details']['id'] for system in systems], ['1000010000', '1000010001', '1000010002'])
+        self.assertEqual(systems[0]['details'], {'id': '1000010000', 'profile_name': 'host0.example.com',
+                                                 'description': 'Synthetic system 0'})
+        self.assertEqual(systems[1]['network'], {'ip': '10.0.0.2', 'hostname': 'host1.example.com'})
+        self.assertEqual(systems[2]['devices'], [{'interface': 'eth0', 'ip': '10.0.0.3', 'netmask': '255.255.0.0',
+                                                  'broadcast': '10.0.255.255',
+                                                  'hardware_address': '52:54:00:00:00:02',
+                                                  'module': 'virtio_net'}])
+        self.assertEqual(self.server.calls['system.getDetails'], 3)
+
+    def test_cached(self):
+        fetched = hiera.Systems(self.client, self.working_dir).fetch('synthetic')
+        self.assertEqual(hiera.Systems(self.client, self.working_dir).fetch('synthetic'), fetched)
+        self.assertEqual(self.server.calls['system.getDetails'], 3)
+        hiera.Systems(self.client, self.working_dir).fetch('synthetic', refresh=True)
+        self.assertEqual(self.server.calls['system.getDetails'], 6)
+        # expired
+        hiera.Systems(self.client, self.working_dir, ttl=-1).fetch('synthetic')
+        self.assertEqual(self.server.calls['system.getDetails'], 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xmlrpclib
+from StringIO import StringIO
+import journal
+import pfile
+
+
+def write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fh = open(path, "wb")
+    try:
+        fh.write(contents)
+    finally:
+        fh.close()
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.working_dir = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.module = os.path.join(self.working_dir, 'myorg-mychannel')
+        write(os.path.join(self.module, 'files', '_etc_motd'), 'Welcome\n')
+        write(os.path.join(self.module, 'manifests', 'init.pp'), 'class mychannel {\n}\n')
+        self.motd = pfile.File('_etc_motd', 'file', '/etc/motd', '644', 'root', 'root', 'Welcome\n')
+        # shares the body of /etc/motd
+        self.issue = pfile.File('_etc_issue', 'file', '/etc/issue', '644', 'root', 'root', 'Welcome\n')
+        self.issue.source = '_etc_motd'
+        self.journal = journal.Journal(self.working_dir)
+        self.journal.start()
+        self.checksum = journal.checksum
+        self.checksums = []
+
+        def checksum(fpath):
+            self.checksums.append(os.path.relpath(fpath, self.module))
+            return self.checksum(fpath)
+        journal.checksum = checksum
+
+    def tearDown(self):
+        journal.checksum = self.checksum
+        sys.stdout = self.stdout
+        shutil.rmtree(self.working_dir, True)
+
+    def test_complete(self):
+        self.journal.complete('mychannel', 'myorg-mychannel', self.module, [self.motd, self.issue])
+        # the bodies are recorded with their digest, not read again
+        self.assertEqual(self.checksums, ['manifests/init.pp'])
+        self.assertEqual(self.journal.completed('mychannel'), 'myorg-mychannel')
+        self.assertEqual(self.journal.completed('other'), None)
+        self.assertTrue(self.journal.verify('mychannel'))
+
+    def test_changed_body(self):
+        self.journal.complete('mychannel', 'myorg-mychannel', self.module, [self.motd, self.issue])
+        write(os.path.join(self.module, 'files', '_etc_motd'), 'Changed\n')
+        self.assertFalse(self.journal.verify('mychannel'))
+
+    def test_changed_manifest(self):
+        self.journal.complete('mychannel', 'myorg-mychannel', self.module, [self.motd, self.issue])
+        write(os.path.join(self.module, 'manifests', 'init.pp'), 'class mychannel {\nfile { }\n}\n')
+        self.assertFalse(self.journal.verify('mychannel'))
+
+    def test_archive(self):
+        archive = os.path.join(self.working_dir, 'myorg-mychannel-0.1.0.tar.gz')
+        write(archive, 'archive')
+        self.journal.complete('mychannel', 'myorg-mychannel', archive)
+        self.assertTrue(self.journal.verify('mychannel'))
+        os.remove(archive)
+        self.assertFalse(self.journal.verify('mychannel'))
+
+    def test_resume(self):
+        self.journal.complete('mychannel', 'myorg-mychannel', self.module, [self.motd])
+        resumed = journal.Journal(self.working_dir)
+        self.assertNotEqual(resumed.start(resume=True), None)
+        self.assertEqual(resumed.completed('mychannel'), 'myorg-mychannel')
+        self.journal.finish()
+        restarted = journal.Journal(self.working_dir)
+        self.assertEqual(restarted.start(resume=True), None)
+        self.assertEqual(restarted.completed('mychannel'), None)
+
+    def test_batches(self):
+        modified = xmlrpclib.DateTime('20141001T00:00:00')
+        listing = {'/etc/motd': {'path': '/etc/motd', 'type': 'file', 'last_modified': modified}}
+        details = [{'path': '/etc/motd', 'contents': 'Welcome\n', 'modified': modified}]
+        batches = self.journal.batches('mychannel', listing)
+        self.assertEqual(batches.get(['/etc/motd']), None)
+        batches.put(['/etc/motd'], details)
+        self.assertEqual(batches.get(['/etc/motd']), details)
+
+        listing['/etc/motd'] = dict(listing['/etc/motd'], last_modified=xmlrpclib.DateTime('20141002T00:00:00'))
+        self.assertEqual(self.journal.batches('mychannel', listing).get(['/etc/motd']), None)
+        # the batches of a converted channel are dropped
+        self.journal.complete('mychannel', 'myorg-mychannel', self.module, [self.motd])
+        self.assertEqual(batches.get(['/etc/motd']), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
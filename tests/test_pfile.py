@@ -0,0 +1,266 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+import pfile
+import plan
+import ptags
+import skeleton
+from stats import Stats
+
+
+def read(path):
+    fh = open(path, "rb")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+class Base64Test(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 256) for i in range(1000))
+        # Spacewalk wraps the encoded bodies every 76 characters
+        self.encoded = base64.encodestring(self.data)
+
+    def test_reader(self):
+        for chunk in [4, 7, 76, 77, 4096]:
+            reader = pfile.Base64Reader(self.encoded, chunk)
+            self.assertEqual(reader.read(1), self.data[:1])
+            self.assertEqual(reader.read(10), self.data[1:11])
+            self.assertEqual(reader.read(), self.data[11:])
+            self.assertEqual(reader.read(), '')
+
+    def test_padding(self):
+        self.assertEqual(pfile.Base64Reader('YWI=\n', 3).read(), 'ab')
+        self.assertEqual(pfile.Base64Reader('', 3).read(), '')
+        self.assertRaises(binascii.Error, pfile.Base64Reader('YWI', 2).read)
+
+    def test_decode(self):
+        self.assertEqual(pfile.decode_base64(self.encoded, chunk=10),
+                         (hashlib.sha1(self.data).hexdigest(), 1000))
+        fh = StringIO()
+        pfile.decode_base64(self.encoded, fh, chunk=10)
+        self.assertEqual(fh.getvalue(), self.data)
+
+    def test_spool(self):
+        path = tempfile.mkdtemp(prefix='puppetize-test-')
+        try:
+            fpath = os.path.join(path, 'spool')
+            self.assertEqual(pfile.spool_base64(self.encoded, fpath, chunk=10),
+                             (hashlib.sha1(self.data).hexdigest(), 1000))
+            self.assertEqual(read(fpath), self.data)
+        finally:
+            shutil.rmtree(path, True)
+
+
+class FileManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.path = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.fm = pfile.FileManager.Instance()
+        self.fm.clear()
+        self.fm.set_jobs(1)
+        self.fm.set_spool_threshold(pfile.SPOOL_THRESHOLD)
+        self.fm.set_sharding(None)
+        self.fm.set_common_module(None, None)
+        # the mapping as load_mapping() reads it, unicode strings
+        self.fm.set_tag_manager(ptags.TagManager(json.loads(json.dumps(ptags.MAPPING))))
+        self.module = skeleton.ModuleSkeleton('myorg-mychannel', 'https://spacewalk.example.com')
+
+    def tearDown(self):
+        self.fm.clear()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.path, True)
+
+    def add_file(self, path, contents, **kwargs):
+        details = dict(name=path.replace('/', '_'), path=path, contents=contents, pmode='644',
+                       group='root', owner='root', macro_start_delimiter=u'{|', macro_end_delimiter=u'|}',
+                       is_binary=False)
+        details.update(kwargs)
+        self.fm.add_file(**details)
+        return self.fm.files[path]
+
+    def test_unicode_contents(self):
+        # xmlrpclib returns the non-ASCII bodies as unicode
+        self.fm.open(self.path, self.module)
+        template = self.add_file('/etc/motd', u'Bienvenue \xe0 {| rhn.system.hostname |}\n')
+        static = self.add_file('/etc/issue', u'Caf\xe9\n')
+        self.fm.close()
+
+        expected = 'Bienvenue \xc3\xa0 <%=  @fqdn  %>\n'
+        self.assertEqual(template.type, 'template')
+        self.assertEqual(template.digest, hashlib.sha1(expected).hexdigest())
+        self.assertEqual(template.size, len(expected))
+        self.assertEqual(read(os.path.join(self.path, 'templates', '_etc_motd.erb')), expected)
+        self.assertEqual(static.type, 'file')
+        self.assertEqual(static.digest, hashlib.sha1('Caf\xc3\xa9\n').hexdigest())
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_issue')), 'Caf\xc3\xa9\n')
+
+    def test_utf8_contents(self):
+        self.fm.open(self.path, self.module)
+        template = self.add_file('/etc/motd', 'Bienvenue \xc3\xa0 {| rhn.system.hostname |}\n')
+        self.fm.close()
+        self.assertEqual(template.type, 'template')
+        self.assertEqual(read(os.path.join(self.path, 'templates', '_etc_motd.erb')),
+                         'Bienvenue \xc3\xa0 <%=  @fqdn  %>\n')
+
+    def test_spooled(self):
+        data = ''.join(chr(i % 256) for i in range(1000))
+        self.fm.set_spool_threshold(100)
+        self.fm.open(self.path, self.module)
+        small = self.add_file('/etc/small', base64.encodestring(data[:10]), is_binary=True, encoded=True)
+        large = self.add_file('/etc/large', base64.encodestring(data), is_binary=True, encoded=True)
+        self.fm.close()
+        self.assertEqual((large.digest, large.size), (hashlib.sha1(data).hexdigest(), 1000))
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_large')), data)
+        self.assertEqual(small.size, 10)
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_small')), data[:10])
+        # the bodies are decoded into the module directory, the spool files are gone
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'files'))), ['_etc_large', '_etc_small'])
+        self.assertEqual([name for root, dirs, names in os.walk(self.path) for name in names
+                          if name.startswith('.spool-')], [])
+
+    def test_name_collisions(self):
+        self.fm.open(self.path, self.module)
+        files = [self.add_file(path, 'body of %s\n' % path) for path in ['/etc/a_b', '/etc/a/b', '/etc_a/b']]
+        # its natural name is taken by the renamed /etc/a/b
+        taken = self.add_file('/etc/a_b_2', 'body of /etc/a_b_2\n')
+        # added again, a path keeps its name
+        again = self.add_file('/etc/a/b', 'changed body of /etc/a/b\n')
+        self.fm.close()
+        self.assertEqual([file.name for file in files], ['_etc_a_b', '_etc_a_b_2', '_etc_a_b_3'])
+        self.assertEqual(taken.name, '_etc_a_b_2_2')
+        self.assertEqual(again.name, '_etc_a_b_2')
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_a_b')), 'body of /etc/a_b\n')
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_a_b_2')), 'changed body of /etc/a/b\n')
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_a_b_3')), 'body of /etc_a/b\n')
+        self.assertEqual(read(os.path.join(self.path, 'files', '_etc_a_b_2_2')), 'body of /etc/a_b_2\n')
+
+    def test_removed_name(self):
+        self.add_file('/etc/a_b', 'a\n')
+        self.add_file('/etc/a/b', 'b\n')
+        self.fm.remove_file('/etc/a_b')
+        # the name is free again
+        self.assertEqual(self.add_file('/etc_a/b', 'c\n').name, '_etc_a_b')
+        self.assertEqual(sorted(self.fm.files), ['/etc/a/b', '/etc_a/b'])
+
+    def add_files(self, paths):
+        self.fm.open(self.path, self.module)
+        for path in paths:
+            self.add_file(path, 'Welcome\n')
+        self.fm.close()
+        return read(os.path.join(self.path, 'manifests', 'init.pp'))
+
+    def test_shard_by_directory(self):
+        self.fm.set_sharding('directory')
+        init = self.add_files(['/node/site.pp', '/etc/httpd/conf/httpd.conf', '/etc/motd', '/Default/x-y', '/motd'])
+        # the directories named after reserved words, i.e. /node, are prefixed like the others
+        self.assertEqual(init.split('{\n\n', 1)[1],
+                         'contain mychannel::shard_node\n'
+                         'contain mychannel::shard_etc_httpd\n'
+                         'contain mychannel::shard_etc\n'
+                         'contain mychannel::shard_default\n'
+                         'contain mychannel::shard_root\n'
+                         '}\n')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'manifests'))),
+                         ['init.pp', 'shard_default.pp', 'shard_etc.pp', 'shard_etc_httpd.pp',
+                          'shard_node.pp', 'shard_root.pp'])
+        node = read(os.path.join(self.path, 'manifests', 'shard_node.pp'))
+        self.assertTrue(node.startswith('# == Class: mychannel::shard_node\n#\n'
+                                        '# The resources of mychannel under /node.\n'))
+        self.assertTrue('class mychannel::shard_node {\n' in node)
+        self.assertTrue("  path => '/node/site.pp',\n" in node)
+        self.assertFalse("/etc/motd" in node)
+
+    def test_shard_by_size(self):
+        self.fm.set_sharding('size', 2)
+        init = self.add_files(['/node/site.pp', '/etc/httpd/conf/httpd.conf', '/etc/motd', '/Default/x-y', '/motd'])
+        self.assertEqual(init.split('{\n\n', 1)[1],
+                         'contain mychannel::part1\ncontain mychannel::part2\ncontain mychannel::part3\n}\n')
+        part3 = read(os.path.join(self.path, 'manifests', 'part3.pp'))
+        self.assertTrue('class mychannel::part3 {\n' in part3)
+        self.assertEqual(part3.count("  path => '"), 1)
+
+    def test_directory_titles(self):
+        directories = [pfile.File('_etc_a', 'directory', '/etc/a', '755', 'root', 'root'),
+                       pfile.File('_etc_b', 'directory', '/etc/b', '755', 'root', 'root'),
+                       pfile.File('_etc_private', 'directory', '/etc/private', '700', 'root', 'root')]
+        resources = ''.join(pfile.render_resources(directories, 'mychannel'))
+        # single and grouped directories are both titled by their paths
+        self.assertEqual(resources,
+                         "File {\n  owner => 'root',\n  group => 'root',\n  mode => '755',\n}\n\n"
+                         "file { [\n  '/etc/a',\n  '/etc/b',\n]:\n  ensure => 'directory',\n}\n\n"
+                         "file { '/etc/private':\n  ensure => 'directory',\n  mode => '700',\n}\n\n")
+        self.assertEqual(sorted(plan.parse_resources(resources)), ['/etc/a', '/etc/b', '/etc/private'])
+
+    def test_flush_while_fetching(self):
+        # a fetch thread counting the bytes it receives holds the Stats lock
+        self.fm.set_jobs(2)
+        self.fm.open(self.path, self.module)
+        stats = Stats.Instance()
+        held = threading.Event()
+
+        def fetching():
+            stats._lock.acquire()
+            held.set()
+            threading.Event().wait(0.5)
+            stats._lock.release()
+
+        def convert():
+            for i in range(4):
+                self.add_file('/etc/file%d' % i, 'host%d = {| rhn.system.hostname |}\n' % i)
+            self.fm.close()
+
+        substituted = stats.counters.get('macros_substituted', 0)
+        pending_bytes = pfile.PENDING_BYTES
+        # every file added flushes the pending ones to the workers
+        pfile.PENDING_BYTES = 1
+        fetcher = threading.Thread(target=fetching)
+        converter = threading.Thread(target=convert)
+        converter.daemon = True
+        try:
+            fetcher.start()
+            held.wait()
+            converter.start()
+            converter.join(30)
+            fetcher.join()
+        finally:
+            pfile.PENDING_BYTES = pending_bytes
+            if converter.isAlive():
+                # the workers are stuck, the converter with them
+                self.fm.pool.terminate()
+                self.fm.pool = None
+                self.fm.clear()
+            self.fm.set_jobs(1)
+        self.assertFalse(converter.isAlive(), 'the substitution workers hung')
+        self.assertEqual(stats.counters['macros_substituted'], substituted + 4)
+        for i in range(4):
+            self.assertEqual(self.fm.files['/etc/file%d' % i].type, 'template')
+            self.assertEqual(read(os.path.join(self.path, 'templates', '_etc_file%d.erb' % i)),
+                             'host%d = <%%=  @fqdn  %%>\n' % i)
+
+
+if __name__ == '__main__':
+    unittest.main()
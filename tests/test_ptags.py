@@ -0,0 +1,215 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+import ptags
+from stats import Stats
+
+
+def write(path, contents):
+    fh = open(path, "w")
+    try:
+        fh.write(contents)
+    finally:
+        fh.close()
+
+
+class CompiledMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mapping = ptags.CompiledMapping(ptags.MAPPING)
+
+    def test_literal(self):
+        self.assertEqual(self.mapping.sub(' rhn.system.hostname '), (' @fqdn ', 1))
+        self.assertEqual(self.mapping.sub('rhn.system.ip_address'), ('@ipaddress', 1))
+
+    def test_function(self):
+        self.assertEqual(self.mapping.sub(' rhn.system.net_interface.ip_address(eth0) '), (' @ipaddress_eth0 ', 1))
+        self.assertEqual(self.mapping.sub('rhn.system.net_interface.netmask( eth0:1 )'), ('@netmask_eth0_1', 1))
+
+    def test_mapped_to_nothing(self):
+        self.assertEqual(self.mapping.sub(' rhn.system.sid '), ('  ', 1))
+        self.assertEqual(self.mapping.sub(' rhn.system.sid ', set(['sid'])), (' @sid ', 1))
+        self.assertEqual(self.mapping.sub(' rhn.system.net_interface.broadcast(eth0) ', set(['broadcast_eth0'])),
+                         (' @broadcast_eth0 ', 1))
+
+    def test_longer_name(self):
+        self.assertEqual(self.mapping.sub(' rhn.system.sidekick '), (' rhn.system.sidekick ', 0))
+        self.assertEqual(self.mapping.sub('rhn.system.hostnames'), ('rhn.system.hostnames', 0))
+
+    def test_expression(self):
+        self.assertEqual(self.mapping.sub(' rhn.system.hostname = "def" '), (' rhn.system.hostname = "def" ', 0))
+        self.assertEqual(self.mapping.sub(' x rhn.system.hostname '), (' x rhn.system.hostname ', 0))
+        self.assertEqual(self.mapping.sub(' rhn.system.net_interface.ip_address(eth0).x '),
+                         (' rhn.system.net_interface.ip_address(eth0).x ', 0))
+
+    def test_blank(self):
+        self.assertEqual(self.mapping.sub('   '), ('   ', 0))
+
+    def test_empty_mapping(self):
+        mapping = ptags.CompiledMapping({'mapping': {}})
+        self.assertEqual(mapping.sub(' rhn.system.hostname '), (' rhn.system.hostname ', 0))
+
+    def test_invalid(self):
+        for mapping in [[], {}, {'mapping': []}, {'mapping': {'': '@fqdn'}},
+                        {'mapping': {'rhn.system.hostname': 1}}]:
+            self.assertRaises(ptags.MappingError, ptags.CompiledMapping, mapping)
+
+    def test_state(self):
+        state = json.loads(json.dumps(self.mapping.__getstate__()))
+        mapping = ptags.CompiledMapping.from_state(state)
+        self.assertEqual(mapping.sub(' rhn.system.hostname '), (' @fqdn ', 1))
+        self.assertEqual(mapping.sub(' rhn.system.sidekick '), (' rhn.system.sidekick ', 0))
+        self.assertTrue(isinstance(mapping.sub(' rhn.system.hostname ')[0], str))
+
+
+class TagManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tm = ptags.TagManager()
+
+    def counters(self):
+        counters = Stats.Instance().counters
+        return dict((name, counters.get(name, 0)) for name in
+                    ['macros_substituted', 'macros_resolved', 'macros_unmapped', 'templates_downgraded'])
+
+    def test_expand(self):
+        result = self.tm.expand('{| rhn.system.hostname |} has {|rhn.system.ip_address|}, '
+                                '{| rhn.system.net_interface.hardware_address(eth0) |}\n', '{|', '|}')
+        self.assertEqual(result.contents, '<%=  @fqdn  %> has <%= @ipaddress %>, <%=  @macaddress_eth0  %>\n')
+        self.assertEqual((result.replaced, result.unmapped, result.resolved), (3, [], 0))
+        self.assertFalse(result.downgraded())
+
+    def test_unmapped(self):
+        result = self.tm.expand('{| rhn.system.uptime |} on {| rhn.system.hostname |}', '{|', '|}')
+        self.assertEqual(result.contents, '{| rhn.system.uptime |} on <%=  @fqdn  %>')
+        self.assertEqual((result.replaced, result.unmapped), (1, ['rhn.system.uptime']))
+
+    def test_no_macros(self):
+        for contents in ['', 'Welcome\n', 'Welcome {| rhn.system.hostname']:
+            result = self.tm.expand(contents, '{|', '|}')
+            self.assertEqual((result.contents, result.replaced, result.unmapped), (contents, 0, []))
+        result = self.tm.expand('{| rhn.system.hostname |}', '', '')
+        self.assertEqual((result.contents, result.replaced), ('{| rhn.system.hostname |}', 0))
+
+    def test_delimiters(self):
+        result = self.tm.expand('@@ rhn.system.hostname @@ and [[rhn.system.ip_address]]', '[[', ']]')
+        self.assertEqual(result.contents, '@@ rhn.system.hostname @@ and <%= @ipaddress %>')
+
+    def test_resolved(self):
+        result = self.tm.expand('sid={| rhn.system.sid |}\n', '{|', '|}')
+        self.assertEqual(result.contents, 'sid=\n')
+        self.assertEqual((result.replaced, result.resolved), (0, 1))
+        self.assertTrue(result.downgraded())
+
+    def test_parameters(self):
+        tm = ptags.TagManager(parameters=['$sid', '$site = "lab"'])
+        result = tm.expand('sid={| rhn.system.sid |}\n', '{|', '|}')
+        self.assertEqual(result.contents, 'sid=<%=  @sid  %>\n')
+        self.assertEqual((result.replaced, result.resolved), (1, 0))
+
+    def test_substitute(self):
+        before = self.counters()
+        self.assertEqual(self.tm.substitute('{| rhn.system.hostname |} {| rhn.system.sid |} {| x |}', '{|', '|}'),
+                         (True, '<%=  @fqdn  %>  {| x |}'))
+        self.assertEqual(self.tm.substitute('{| rhn.system.sid |}', '{|', '|}'), (False, ''))
+        after = self.counters()
+        self.assertEqual(dict((name, after[name] - before[name]) for name in after),
+                         {'macros_substituted': 1, 'macros_resolved': 2, 'macros_unmapped': 1,
+                          'templates_downgraded': 1})
+
+    def test_replace_tag(self):
+        self.assertEqual(self.tm.replace_tag(' rhn.system.hostname '), (True, '<%=  @fqdn  %>'))
+        self.assertEqual(self.tm.replace_tag(' rhn.system.sid '), (False, '  '))
+        self.assertEqual(self.tm.replace_tag(' x '), (False, ' x '))
+
+    def test_boundaries(self):
+        tm = ptags.TagManager()
+        self.assertEqual(tm.substitute('a {|rhn.system.sidekick|} b', '{|', '|}'),
+                         (False, 'a {|rhn.system.sidekick|} b'))
+        self.assertEqual(tm.substitute('a {| rhn.system.hostname = "def" |} b', '{|', '|}'),
+                         (False, 'a {| rhn.system.hostname = "def" |} b'))
+
+
+class LoadMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.path = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.mapping = os.path.join(self.path, 'mapping.json')
+        write(self.mapping, json.dumps({'mapping': {'rhn.system.hostname': '@fqdn'}}))
+        self.cache_dir = os.path.join(self.path, '.puppetize')
+        self.version = ptags.CACHE_VERSION
+
+    def tearDown(self):
+        ptags.CACHE_VERSION = self.version
+        sys.stdout = self.stdout
+        shutil.rmtree(self.path, True)
+
+    def cache(self):
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len(names), 1)
+        return os.path.join(self.cache_dir, names[0])
+
+    def tamper(self):
+        """
+        Change the replacement in the cache, to tell when it is used.
+
+        """
+        fh = open(self.cache(), "r")
+        try:
+            cached = json.load(fh)
+        finally:
+            fh.close()
+        cached['compiled']['literals']['rhn.system.hostname'] = '@cached'
+        write(self.cache(), json.dumps(cached))
+
+    def test_cached(self):
+        self.assertEqual(ptags.load_mapping(self.mapping, self.cache_dir).sub('rhn.system.hostname'), ('@fqdn', 1))
+        self.tamper()
+        self.assertEqual(ptags.load_mapping(self.mapping, self.cache_dir).sub('rhn.system.hostname'), ('@cached', 1))
+
+    def test_version(self):
+        ptags.load_mapping(self.mapping, self.cache_dir)
+        self.tamper()
+        ptags.CACHE_VERSION += 1
+        self.assertEqual(ptags.load_mapping(self.mapping, self.cache_dir).sub('rhn.system.hostname'), ('@fqdn', 1))
+
+    def test_changed(self):
+        ptags.load_mapping(self.mapping, self.cache_dir)
+        write(self.mapping, json.dumps({'mapping': {'rhn.system.hostname': '@hostname'}}))
+        self.assertEqual(ptags.load_mapping(self.mapping, self.cache_dir).sub('rhn.system.hostname'),
+                         ('@hostname', 1))
+
+    def test_garbage(self):
+        ptags.load_mapping(self.mapping, self.cache_dir)
+        write(self.cache(), 'garbage')
+        self.assertEqual(ptags.load_mapping(self.mapping, self.cache_dir).sub('rhn.system.hostname'), ('@fqdn', 1))
+
+    def test_invalid(self):
+        write(self.mapping, '{"mapping": ')
+        self.assertRaises(ptags.MappingError, ptags.load_mapping, self.mapping, self.cache_dir)
+        write(self.mapping, '{"mapping": {"rhn.system.hostname": null}}')
+        self.assertRaises(ptags.MappingError, ptags.load_mapping, self.mapping, self.cache_dir)
+
+    def test_no_cache(self):
+        self.assertEqual(ptags.load_mapping(self.mapping).sub('rhn.system.hostname'), ('@fqdn', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
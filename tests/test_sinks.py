@@ -0,0 +1,95 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import sinks
+
+
+def write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fh = open(path, "wb")
+    try:
+        fh.write(contents)
+    finally:
+        fh.close()
+
+
+class TarSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.archive = os.path.join(self.path, 'myorg-mychannel-0.1.0.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def members(self):
+        tar = tarfile.open(self.archive, "r:gz")
+        try:
+            return [(info.name, info.isdir() and 'directory' or tar.extractfile(info).read())
+                    for info in tar.getmembers()]
+        finally:
+            tar.close()
+
+    def test_directories(self):
+        sink = sinks.TarSink(self.archive, 'myorg-mychannel-0.1.0')
+        # the skeleton and the FileManager both create files/
+        sink.mkdir('files')
+        sink.mkdir('manifests')
+        sink.mkdir('files')
+        sink.write('files/_etc_motd', 'Welcome\n')
+        sink.close()
+        self.assertEqual(self.members(), [('myorg-mychannel-0.1.0', 'directory'),
+                                          ('myorg-mychannel-0.1.0/files', 'directory'),
+                                          ('myorg-mychannel-0.1.0/manifests', 'directory'),
+                                          ('myorg-mychannel-0.1.0/files/_etc_motd', 'Welcome\n')])
+
+    def test_buffered(self):
+        sink = sinks.TarSink(self.archive, 'mychannel')
+        sink.open('manifests/init.pp').write('class mychannel {\n')
+        spool = os.path.join(self.path, 'spool')
+        write(spool, 'spooled\n')
+        sink.move('files/_etc_issue', spool)
+        sink.open('manifests/init.pp', append=True).write('}\n')
+        # not in place before it is closed
+        self.assertFalse(os.path.exists(self.archive))
+        sink.close()
+        self.assertFalse(os.path.exists(spool))
+        self.assertEqual(self.members(), [('mychannel', 'directory'),
+                                          ('mychannel/files/_etc_issue', 'spooled\n'),
+                                          ('mychannel/manifests/init.pp', 'class mychannel {\n}\n')])
+        self.assertEqual(os.listdir(self.path), ['myorg-mychannel-0.1.0.tar.gz'])
+
+    def test_abort(self):
+        sink = sinks.TarSink(self.archive, 'mychannel')
+        sink.write('files/_etc_motd', 'Welcome\n')
+        sink.abort()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_pack(self):
+        module = os.path.join(self.path, 'mychannel')
+        write(os.path.join(module, 'files', '_etc_motd'), 'Welcome\n')
+        write(os.path.join(module, 'manifests', 'init.pp'), 'class mychannel {\n}\n')
+        sinks.pack(module, self.archive, 'myorg-mychannel-0.1.0')
+        self.assertEqual(self.members(), [('myorg-mychannel-0.1.0', 'directory'),
+                                          ('myorg-mychannel-0.1.0/files', 'directory'),
+                                          ('myorg-mychannel-0.1.0/manifests', 'directory'),
+                                          ('myorg-mychannel-0.1.0/files/_etc_motd', 'Welcome\n'),
+                                          ('myorg-mychannel-0.1.0/manifests/init.pp', 'class mychannel {\n}\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import tempfile
+import unittest
+import pfile
+import sinks
+import skeleton
+
+#
+# Constants
+#
+
+# The module ModuleSkeletonTest.test_write() is expected to write.
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'mychannel')
+
+
+def read_tree(path):
+    """
+    Returns the contents of the files under path, by relative path.
+
+    """
+    tree = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            fpath = os.path.join(root, name)
+            fh = open(fpath, "rb")
+            try:
+                tree[os.path.relpath(fpath, path)] = fh.read()
+            finally:
+                fh.close()
+    return tree
+
+
+class ModuleSkeletonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.module = skeleton.ModuleSkeleton('myorg-mychannel', 'https://spacewalk.example.com',
+                                              dependencies=[('myorg-common', '0.1.0')])
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_write(self):
+        self.module.write(self.path)
+        manifest = pfile.Manifest(sinks.sink(self.path), self.module)
+        manifest.write(pfile.File('_etc_myapp', 'directory', '/etc/myapp', '755', 'root', 'root'))
+        manifest.write(pfile.File('_etc_myapp_conf.d', 'directory', '/etc/myapp/conf.d', '755', 'root', 'root'))
+        manifest.write(pfile.File('_etc_myapp_private', 'directory', '/etc/myapp/private', '700', 'root', 'myapp'))
+        manifest.write(pfile.File('_etc_myapp_current', 'symlink', '/etc/myapp/current',
+                                  target='/etc/myapp/conf.d'))
+        manifest.close()
+
+        expected = read_tree(FIXTURE)
+        written = read_tree(self.path)
+        self.assertEqual(sorted(written), sorted(expected))
+        for name in sorted(expected):
+            self.assertEqual(written[name], expected[name], name)
+        for directory in skeleton.DIRECTORIES:
+            self.assertTrue(os.path.isdir(os.path.join(self.path, directory)), directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import unittest
+import xmlrpclib
+import fetch
+import mockserver
+import spacewalk
+
+
+class CountingConnector(fetch.Connector):
+    """
+    Counts the proxies opened and released.
+    """
+
+    def __init__(self, url):
+        fetch.Connector.__init__(self, url)
+        self.opened = 0
+        self.released = 0
+
+    def server(self):
+        self.opened += 1
+        return fetch.Connector.server(self)
+
+    def release(self, server):
+        self.released += 1
+        fetch.Connector.release(self, server)
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mockserver.MockSpacewalk().start()
+        self.connector = CountingConnector(self.server.url)
+        self.client = spacewalk.Client(self.connector, 'admin', 'secret', size=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_session_key(self):
+        self.assertEqual(self.client.login(), 'mock-session-1')
+        self.assertEqual(self.client.configchannel.getDetails('synthetic')['label'], 'synthetic')
+        self.assertEqual(self.client.call('configchannel.getDetails', 'synthetic')['label'], 'synthetic')
+        # the connection is kept for the following calls
+        self.assertEqual(self.connector.opened, 1)
+
+    def test_relogin(self):
+        self.client.login()
+        self.server.expire_sessions()
+        self.assertEqual(self.client.configchannel.getDetails('synthetic')['label'], 'synthetic')
+        self.assertEqual(self.client.key, 'mock-session-2')
+        self.assertEqual(self.server.calls['auth.login'], 2)
+        self.assertEqual(self.server.calls['configchannel.getDetails'], 2)
+
+    def test_relogin_once(self):
+        self.client.login()
+        self.server.expire_sessions()
+        # the calls failing with the same expired key log in again only once
+        results = [self.client.call_async('configchannel.getDetails', 'synthetic') for i in range(8)]
+        self.assertEqual([result.get()['label'] for result in results], ['synthetic'] * 8)
+        self.assertEqual(self.server.calls['auth.login'], 2)
+
+    def test_fault(self):
+        self.client.login()
+        self.assertRaises(xmlrpclib.Fault, self.client.configchannel.getDetails, 'missing')
+        self.assertEqual(self.server.calls['auth.login'], 1)
+        # a fault leaves the connection usable
+        self.assertEqual(self.client.configchannel.getDetails('synthetic')['label'], 'synthetic')
+        self.assertEqual(self.connector.opened, 1)
+
+    def test_imap(self):
+        self.client.login()
+        labels = list(self.client.imap('configchannel.getDetails', [('synthetic',)] * 5))
+        self.assertEqual([details['label'] for details in labels], ['synthetic'] * 5)
+
+    def test_close(self):
+        self.client.login()
+        self.client.call_async('configchannel.getDetails', 'synthetic').get()
+        self.client.close()
+        self.assertEqual(self.connector.released, self.connector.opened)
+        self.assertTrue(self.connector.opened <= 2)
+
+    def test_session_expired(self):
+        self.assertTrue(spacewalk.session_expired(xmlrpclib.Fault(2950, 'Could not find session: 1')))
+        self.assertFalse(spacewalk.session_expired(xmlrpclib.Fault(1023, 'No such configuration channel')))
+
+
+if __name__ == '__main__':
+    unittest.main()
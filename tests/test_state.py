@@ -0,0 +1,72 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import shutil
+import tempfile
+import unittest
+import xmlrpclib
+import pfile
+import state
+
+
+def entry(path, modified='20141001T00:00:00'):
+    """
+    Returns a configchannel.listFiles entry, as Spacewalk returns it.
+
+    """
+    return {'path': path, 'type': 'file', 'last_modified': xmlrpclib.DateTime(modified)}
+
+
+class ChannelStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.state = state.ChannelState.load(self.working_dir, 'mychannel')
+        self.listing = dict((path, entry(path)) for path in ['/etc/motd', '/etc/issue'])
+        files = [pfile.File('_etc_motd', 'file', '/etc/motd', '644', 'root', 'root', 'Welcome\n'),
+                 pfile.File('_etc_issue', 'file', '/etc/issue', '644', 'root', 'root', 'Welcome\n')]
+        files[1].source = '_etc_motd'
+        self.state.update('myorg-mychannel', {}, self.listing, files)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir, True)
+
+    def test_stamp(self):
+        self.assertEqual(state.stamp(entry('/etc/motd')), '20141001T00:00:00')
+        self.assertNotEqual(state.stamp(entry('/etc/motd')), state.stamp(entry('/etc/motd', '20141002T00:00:00')))
+
+    def test_unchanged(self):
+        self.assertEqual(self.state.changes(self.listing), (set(), set()))
+
+    def test_modified(self):
+        self.listing['/etc/issue'] = entry('/etc/issue', '20141002T00:00:00')
+        self.assertEqual(self.state.changes(self.listing), (set(['/etc/issue']), set()))
+
+    def test_added_and_removed(self):
+        del self.listing['/etc/issue']
+        self.listing['/etc/hosts'] = entry('/etc/hosts')
+        self.assertEqual(self.state.changes(self.listing), (set(['/etc/hosts']), set(['/etc/issue'])))
+
+    def test_shared_body(self):
+        # /etc/issue shares the body written for /etc/motd, it is written again with it
+        self.listing['/etc/motd'] = entry('/etc/motd', '20141002T00:00:00')
+        self.assertEqual(self.state.changes(self.listing), (set(['/etc/motd', '/etc/issue']), set()))
+
+    def test_saved(self):
+        self.state.save()
+        state.LOADED.clear()
+        loaded = state.ChannelState.load(self.working_dir, 'mychannel')
+        self.assertEqual(loaded.module_name, 'myorg-mychannel')
+        self.assertEqual(loaded.changes(self.listing), (set(), set()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import os
+import shutil
+import tempfile
+import unittest
+import verify
+
+#
+# Constants
+#
+
+# A class manifest referring to a template, a file of its own, a file of
+# another module and a file missing.
+MANIFEST = """class mychannel {
+
+File {
+  owner => 'root',
+  group => 'root',
+  mode => '644',
+}
+
+file { '/etc/myapp':
+  ensure => 'directory',
+}
+
+file { '_etc_motd':
+  path => '/etc/motd',
+  ensure => 'file',
+  content => template('mychannel/_etc_motd.erb'),
+}
+
+file { '_etc_issue':
+  path => '/etc/issue',
+  source => 'puppet:///modules/mychannel/_etc_issue',
+  ensure => 'file',
+}
+
+file { '_etc_hosts':
+  path => '/etc/hosts',
+  source => 'puppet:///modules/common/_etc_hosts',
+  ensure => 'file',
+}
+
+file { '_etc_gone':
+  path => '/etc/gone',
+  source => 'puppet:///modules/mychannel/_etc_gone',
+  ensure => 'file',
+}
+
+}
+"""
+
+
+def write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fh = open(path, "wb")
+    try:
+        fh.write(contents)
+    finally:
+        fh.close()
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_variables(self):
+        self.assertEqual(verify.render('host = <%=  @fqdn  %>\nup = <%= @up %>\n', {'fqdn': 'web1', 'up': True}),
+                         ('host = web1\nup = true\n', []))
+        self.assertEqual(verify.render('<%= @sid %>|<%= @ips %>', {'sid': None, 'ips': ['10.0.0.1']}),
+                         ('|["10.0.0.1"]', []))
+        self.assertEqual(verify.render('<%= @name %>', {'name': u'caf\xe9'}), ('caf\xc3\xa9', []))
+
+    def test_trim_and_comments(self):
+        self.assertEqual(verify.render('a <%= @x -%>\nb <%%= y %> <%# c %>d', {'x': 1}),
+                         ('a 1b <%= y %> d', []))
+
+    def test_errors(self):
+        template = 'a\n<%= @nope %>\n<% if x %>\n<%= @fqdn.upcase %>\nopen <%= @fqdn\n'
+        self.assertEqual(verify.render(template, {'fqdn': 'web1'})[1],
+                         ['line 2: undefined variable @nope',
+                          'line 3: unsupported ERB <% if x %>',
+                          'line 4: unsupported ERB <%= @fqdn.upcase %>',
+                          'line 5: unclosed ERB tag'])
+
+
+class VerifyModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='puppetize-test-')
+        self.module = os.path.join(self.path, 'myorg-mychannel')
+        write(os.path.join(self.module, 'manifests', 'init.pp'), MANIFEST)
+        write(os.path.join(self.module, 'templates', '_etc_motd.erb'), 'Welcome to <%= @fqdn %>\n<%= @sid %>\n')
+        write(os.path.join(self.module, 'files', '_etc_issue'), 'Welcome\n')
+        self.common = os.path.join(self.path, 'myorg-common')
+        write(os.path.join(self.common, 'files', '_etc_hosts'), '127.0.0.1 localhost\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def test_verify(self):
+        report = verify.verify_module(self.module, {'mychannel': self.module, 'common': self.common},
+                                      {'fqdn': 'web1'})
+        self.assertEqual((report.resources, report.rendered), (5, 1))
+        self.assertEqual(report.errors, {
+            'manifests/init.pp': ['/etc/gone: missing source %s' % os.path.join(self.module, 'files', '_etc_gone')],
+            'templates/_etc_motd.erb': ['line 2: undefined variable @sid']})
+        self.assertEqual(report.count(), 2)
+        self.assertTrue(report.text().endswith('5 resources, 1 templates rendered, 2 errors in 2 files'))
+
+    def test_unknown_module(self):
+        report = verify.verify_module(self.module, {'mychannel': self.module}, {'fqdn': 'web1', 'sid': '1'})
+        self.assertEqual(report.errors, {
+            'manifests/init.pp': ['/etc/gone: missing source %s' % os.path.join(self.module, 'files', '_etc_gone'),
+                                  '/etc/hosts: source of unknown module common']})
+
+    def test_load_facts(self):
+        facts = os.path.join(self.path, 'facts.json')
+        write(facts, '{"fqdn": "web1", "processorcount": 2}')
+        self.assertEqual(verify.load_facts(facts), {'fqdn': 'web1', 'processorcount': 2})
+        write(facts, '["fqdn"]')
+        self.assertRaises(ValueError, verify.load_facts, facts)
+
+
+if __name__ == '__main__':
+    unittest.main()
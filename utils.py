@@ -12,8 +12,13 @@
 #
 # Imports
 #
-import sys
+import errno
 import os
+import shlex
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
 from subprocess import Popen, PIPE
 
 def shell(command, exit_on_err=True):
@@ -21,19 +26,25 @@ def shell(command, exit_on_err=True):
     Invoke shell commands and return the exit-code and any
     output written by the command to stdout.
 
-    :param command: The command to invoke.
-    :type command: str
+    :param command: The command to invoke, quoted like in a shell, or its arguments.
+    :type command: str|list
     :param exit_on_err: Exit the script if the command fails.
     :type exit_on_err: bool
     :return: (exit-code, output)
     :rtype: tuple
     """
+    if isinstance(command, basestring):
+        call = shlex.split(command)
+    else:
+        call = list(command)
+        command = ' '.join(call)
     print command
-    call = command.split()
     p = Popen(call, stdout=PIPE, stderr=PIPE)
-    status, output = p.wait(), p.stdout.read()
+    # reading both pipes to the end before waiting, a full pipe would block the command
+    output, error = p.communicate()
+    status = p.returncode
     if exit_on_err and status != os.EX_OK:
-        print p.stderr.read()
+        print error
         sys.exit(status)
     return status, output
 
@@ -57,9 +68,112 @@ def mkdir(path):
     :param path: A directory path.
     :type path: str
     """
-    if path:
+    if path and not os.path.isdir(path):
         print 'mkdir -p %s' % path
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError, err:
+            # created concurrently, i.e. by another bulk worker
+            if err.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+
+
+def atomic_write(path, contents):
+    """
+    Write contents to the file at path, which is either left untouched or
+    completely written, never partially.
+
+    :param path: A file path.
+    :type path: str
+    :param contents: The file contents.
+    :type contents: str
+    """
+    fd, spool = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(path) or '.')
+    try:
+        fh = os.fdopen(fd, "wb")
+        try:
+            fh.write(contents)
+        finally:
+            fh.close()
+        os.chmod(spool, 0644)
+        os.rename(spool, path)
+    except:
+        os.remove(spool)
+        raise
+
+
+def utf8(value):
+    """
+    Returns value with its unicode strings, i.e. those xmlrpclib and json
+    return for non-ASCII text, encoded to UTF-8, in lists and dicts too.
+
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict((utf8(key), utf8(item)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [utf8(item) for item in value]
+    return value
+
+
+def link_tree(source, target):
+    """
+    Copy the directory tree at source to target, hard linking the files.
+    Files of the copy must then be replaced, never rewritten in place.
+
+    :param source: An existing directory path.
+    :type source: str
+    :param target: A directory path that does not exist.
+    :type target: str
+    """
+    for root, directories, files in os.walk(source):
+        copy = os.path.normpath(os.path.join(target, os.path.relpath(root, source)))
+        os.mkdir(copy)
+        for name in files:
+            fpath = os.path.join(root, name)
+            if os.path.islink(fpath):
+                os.symlink(os.readlink(fpath), os.path.join(copy, name))
+                continue
+            try:
+                os.link(fpath, os.path.join(copy, name))
+            except OSError:
+                # i.e. a file system without hard links
+                shutil.copy2(fpath, os.path.join(copy, name))
+
+
+@contextmanager
+def staging(path, existing=False):
+    """
+    Build the directory at path in a temporary directory next to it, which
+    replaces path once the block completes and is removed if it fails, so
+    that a partially written directory is never left at path.
+
+    :param path: A directory path.
+    :type path: str
+    :param existing: Start from a copy of the existing directory at path.
+    :type existing: bool
+    :return: The path of the temporary directory to build in.
+    :rtype: str
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    build = tempfile.mkdtemp(prefix='.%s.' % name, dir=parent)
+    try:
+        if existing and os.path.isdir(path):
+            os.rmdir(build)
+            link_tree(path, build)
+        yield build
+    except:
+        shutil.rmtree(build, True)
+        raise
+    os.chmod(build, 0755)
+    if os.path.lexists(path):
+        old = tempfile.mkdtemp(prefix='.%s.old.' % name, dir=parent)
+        os.rename(path, os.path.join(old, name))
+        os.rename(build, path)
+        shutil.rmtree(old, True)
+    else:
+        os.rename(build, path)
 
 
 class Singleton:
@@ -0,0 +1,233 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import multiprocessing
+import os
+import re
+import plan
+from stats import Stats
+
+#
+# Constants
+#
+
+# An ERB tag: an expression (<%= %>), a comment (<%# %>) or code (<% %>),
+# closed by -%> to drop the newline that follows.  <%% is a literal <%.
+TAG = re.compile(r'<%(?!%)([=#]?)(.*?)(-?)%>', re.S)
+OPENING = re.compile(r'<%(?!%)')
+
+# The only expression the conversion writes, see ptags.TagManager.expand().
+VARIABLE = re.compile(r'^\s*@(\w+)\s*$')
+
+# The file contents of a resource, see pfile.RESOURCES.
+SOURCE = re.compile(r"^'puppet:///modules/([^/']+)/([^']+)'$")
+TEMPLATE = re.compile(r"^template\('([^/']+)/([^']+)'\)$")
+
+# Number of templates a worker process renders at a time.
+RENDER_CHUNK = 64
+
+
+def load_facts(path):
+    """
+    Returns the facts, and class parameters, the templates are rendered
+    against, read from a JSON object such as the output of `facter --json`.
+
+    :raises ValueError: When the file is not a JSON object.
+    """
+    fh = open(path, "r")
+    try:
+        facts = json.load(fh)
+    finally:
+        fh.close()
+    if not isinstance(facts, dict):
+        raise ValueError('%s is not a JSON object of facts' % path)
+    return facts
+
+
+def to_s(value):
+    """
+    Returns a fact as ERB prints it: nil as nothing, booleans in lower case.
+
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _line(template, position):
+    return template.count('\n', 0, position) + 1
+
+
+def render(template, facts):
+    """
+    Render template, the contents of an .erb file, against facts.  Only
+    the expressions the conversion writes, <%= @fact %>, are evaluated.
+
+    :return: The rendered contents and the errors found.
+    :rtype: tuple
+    """
+    parts = []
+    errors = []
+    position = 0
+    for match in TAG.finditer(template):
+        parts.append(template[position:match.start()].replace('<%%', '<%'))
+        kind, code, trim = match.groups()
+        position = match.end()
+        if trim and template.startswith('\n', position):
+            position += 1
+        if kind == '#':
+            continue
+        variable = kind == '=' and VARIABLE.match(code)
+        if not variable:
+            errors.append('line %d: unsupported ERB %s' % (_line(template, match.start()), match.group(0)))
+        elif variable.group(1) not in facts:
+            errors.append('line %d: undefined variable @%s' % (_line(template, match.start()), variable.group(1)))
+        else:
+            parts.append(to_s(facts[variable.group(1)]))
+    rest = template[position:]
+    opening = OPENING.search(rest)
+    if opening:
+        errors.append('line %d: unclosed ERB tag' % _line(template, position + opening.start()))
+    parts.append(rest.replace('<%%', '<%'))
+    return ''.join(parts), errors
+
+
+# The facts of a render worker process.
+_worker = {}
+
+
+def _init_render_worker(facts):
+    _worker['facts'] = facts
+
+
+def _render(task):
+    """
+    Render one template inside a render worker process.
+
+    :return: The name of the template and its errors.
+    :rtype: tuple
+    """
+    name, fpath = task
+    fh = open(fpath, "rb")
+    try:
+        template = fh.read()
+    finally:
+        fh.close()
+    return name, render(template, _worker['facts'])[1]
+
+
+class Report(object):
+    """
+    The errors found in a module, by file: its manifests for the missing
+    sources and templates, and its templates for those that fail to render.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.resources = 0
+        self.rendered = 0
+        self.errors = {}
+
+    def add(self, name, error):
+        self.errors.setdefault(name, []).append(error)
+
+    def count(self):
+        return sum([len(errors) for errors in self.errors.itervalues()])
+
+    def text(self):
+        """
+        Returns the report, one line per error, grouped by file.
+
+        """
+        lines = []
+        for name in sorted(self.errors):
+            lines.append('  %s:' % name)
+            lines.extend('      %s' % error for error in self.errors[name])
+        lines.append('Verified %s: %d resources, %d templates rendered, %d errors in %d files' %
+                     (self.path, self.resources, self.rendered, self.count(), len(self.errors)))
+        return '\n'.join(lines)
+
+
+def verify_module(path, modules, facts, jobs=1):
+    """
+    Check that every file resource of the module at path refers to a
+    source or template on disk, then render its templates against facts,
+    `jobs` processes at a time.
+
+    :param modules: The directories of the modules the resources may
+                    refer to, by name, i.e. {'myclass': '/tmp/org-myclass'}.
+    :type modules: dict
+
+    :return: The errors found.
+    :rtype: Report
+    """
+    stats = Stats.Instance()
+    report = Report(path)
+    templates = {}
+    with stats.stage('verify'):
+        manifests = os.path.join(path, 'manifests')
+        for entry in sorted(os.listdir(manifests)):
+            if not entry.endswith('.pp'):
+                continue
+            fh = open(os.path.join(manifests, entry), "r")
+            try:
+                resources = plan.parse_resources(fh.read())
+            finally:
+                fh.close()
+            name = 'manifests/' + entry
+            report.resources += len(resources)
+            for title, attributes in sorted(resources.iteritems()):
+                for attribute, pattern, directory in [('source', SOURCE, 'files'), ('content', TEMPLATE, 'templates')]:
+                    value = attributes.get(attribute)
+                    if value is None:
+                        continue
+                    match = pattern.match(value)
+                    if not match:
+                        report.add(name, '%s: unexpected %s %s' % (title, attribute, value))
+                        continue
+                    module, source = match.groups()
+                    if module not in modules:
+                        report.add(name, '%s: %s of unknown module %s' % (title, attribute, module))
+                        continue
+                    fpath = os.path.join(modules[module], directory, source)
+                    if not os.path.isfile(fpath):
+                        report.add(name, '%s: missing %s %s' % (title, attribute, fpath))
+                    elif attribute == 'content':
+                        templates['%s/%s' % (directory, source)] = fpath
+
+    with stats.stage('render'):
+        tasks = sorted(templates.iteritems())
+        if jobs > 1 and len(tasks) > RENDER_CHUNK:
+            pool = multiprocessing.Pool(jobs, _init_render_worker, (facts,))
+            try:
+                results = pool.imap_unordered(_render, tasks, RENDER_CHUNK)
+                for name, errors in results:
+                    for error in errors:
+                        report.add(name, error)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_render_worker(facts)
+            for name, errors in map(_render, tasks):
+                for error in errors:
+                    report.add(name, error)
+        report.rendered = len(tasks)
+    stats.add('templates_rendered', report.rendered)
+    stats.add('verify_errors', report.count())
+    return report
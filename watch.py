@@ -0,0 +1,176 @@
+# Copyright (c) 2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public
+# License as published by the Free Software Foundation; either version
+# 2 of the License (GPLv2) or (at your option) any later version.
+# There is NO WARRANTY for this software, express or implied,
+# including the implied warranties of MERCHANTABILITY,
+# NON-INFRINGEMENT, or FITNESS FOR A PARTICULAR PURPOSE. You should
+# have received a copy of GPLv2 along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import state
+import utils
+from stats import Stats
+
+#
+# Constants
+#
+
+# The status of the watcher, next to the state of the channels.
+STATUS_FILE = 'status.json'
+
+log = logging.getLogger('puppetize')
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """
+    Serves the status of the watcher as JSON, on any path.
+    """
+
+    def do_GET(self):
+        body = json.dumps(self.server.watcher.status(), indent=2, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class Watcher(object):
+    """
+    Keeps the modules of channels in sync with Spacewalk: polls the
+    channels every `interval` seconds within one session and converts
+    those that changed, incrementally.  The compiled mapping, the
+    substitution workers and the channel states stay loaded between polls.
+    """
+
+    def __init__(self, convert, select, working_dir, interval, cycles=None, status_port=None):
+        """
+        :param convert: Converts a channel, given its label, and returns
+                        whether it changed.
+        :type convert: callable
+
+        :param select: Returns the labels of the channels to watch.
+        :type select: callable
+
+        :param cycles: The number of polls after which to stop, forever if None.
+        :type cycles: int
+
+        :param status_port: The port serving the status over HTTP, if any.
+        :type status_port: int
+        """
+        self.convert = convert
+        self.select = select
+        self.interval = interval
+        self.cycles = cycles
+        self.status_path = os.path.join(working_dir, state.STATE_DIR, STATUS_FILE)
+        self.status_port = status_port
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {'pid': os.getpid(), 'state': 'starting', 'started': time.time(), 'cycles': 0,
+                        'interval': interval, 'last_sync': None, 'last_sync_seconds': None,
+                        'failures': 0, 'channels': {}}
+
+    def status(self):
+        """
+        Returns the status of the watcher: the time and latency of the last
+        sync, and for each channel when it was last checked and changed.
+
+        """
+        self._lock.acquire()
+        try:
+            status = json.loads(json.dumps(self._status))
+        finally:
+            self._lock.release()
+        if status['last_sync']:
+            status['seconds_since_sync'] = time.time() - status['last_sync']
+        return status
+
+    def _update(self, **values):
+        self._lock.acquire()
+        try:
+            self._status.update(values)
+            utils.mkdir(os.path.dirname(self.status_path))
+            utils.atomic_write(self.status_path, json.dumps(self._status, indent=2, sort_keys=True))
+        finally:
+            self._lock.release()
+
+    def stop(self, *args):
+        """
+        Stop after the current poll, also installed as the SIGTERM handler.
+
+        """
+        self.stopped.set()
+
+    def sync(self):
+        """
+        Poll every channel once and convert those that changed.
+
+        :return: The number of channels that failed.
+        :rtype: int
+        """
+        began = time.time()
+        self._update(state='syncing')
+        failures = 0
+        channels = dict(self._status['channels'])
+        for channel in self.select():
+            if self.stopped.is_set():
+                break
+            entry = dict(channels.get(channel, {}), checked=time.time())
+            try:
+                with Stats.Instance().stage('sync'):
+                    if self.convert(channel):
+                        entry['changed'] = entry['checked']
+                entry['error'] = None
+            except (Exception, SystemExit), err:
+                log.exception('Channel %s failed', channel)
+                entry['error'] = str(err) or err.__class__.__name__
+                failures += 1
+            entry['seconds'] = time.time() - entry['checked']
+            channels[channel] = entry
+        finished = time.time()
+        self._update(state='idle', cycles=self._status['cycles'] + 1, channels=channels,
+                     last_sync=finished, last_sync_seconds=finished - began,
+                     failures=self._status['failures'] + failures)
+        log.info('Synced %d channels in %.1fs, %d failed', len(channels), finished - began, failures)
+        return failures
+
+    def run(self):
+        """
+        Poll until stopped, by SIGTERM, an interrupt or after `cycles` polls.
+
+        """
+        server = None
+        if self.status_port is not None:
+            server = HTTPServer(('', self.status_port), StatusHandler)
+            server.watcher = self
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            log.info('Serving the status on port %d', server.server_address[1])
+        previous = signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopped.is_set():
+                self.sync()
+                if self.cycles and self._status['cycles'] >= self.cycles:
+                    break
+                self.stopped.wait(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self._update(state='stopped')
+            if server is not None:
+                server.shutdown()
+                server.server_close()